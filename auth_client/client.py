@@ -2,9 +2,13 @@ import json
 import time
 import traceback
 import urllib
+from concurrent.futures import ThreadPoolExecutor
 from django.conf import settings
 import requests
 
+from priyomoney_client.cache_fill import SingleFlightCache
+from priyomoney_client.http_transport import PooledHttpTransport
+
 # from accounts.utils import Address
 
 
@@ -41,41 +45,50 @@ def require(params):  # pragma: no cover
 
 
 class PriyoClient(object):  # pragma: no cover
+    """
+    One auth API client. Calls carry their path and params explicitly, so an instance can be shared between threads,
+    and go through a pooled keep-alive transport with timeouts, retries of idempotent calls and a circuit breaker.
+    """
+    transport = PooledHttpTransport(
+        name='one-auth',
+        pool_size=settings.AUTH_API_POOL_SIZE,
+        timeout=(settings.AUTH_API_CONNECT_TIMEOUT, settings.EXTERNAL_API_TIMEOUT),
+    )
+    endpoint_timeouts = {
+        '/auth/api/v1/file-upload/': (settings.AUTH_API_CONNECT_TIMEOUT, 60),
+    }
+    profile_cache = SingleFlightCache('profile-by-uid', 'auth-profile-by-uid:', timeout=settings.AUTH_PROFILE_BY_UUID_TTL)
+
     def __init__(self, api_key, raise_on_error_status=False):
         # self.uri = 'http://127.0.0.1:8010'
         self.uri = settings.AUTH_API_BASE
-        self.endpoint = '/accounts'
-        self.edge = ''
         self.header_key = 'TOKEN'
         self.api_key_header = 'APIKEY'
         self.token_key = 'Authorization'
         self.api_key = api_key
         self.token = ''
-        self.params = {}
-        self.get_params = None
         self.raise_on_error_status = raise_on_error_status
 
     def add_token(self, token):
         self.token = token
         return self
 
-    def __remote_call(self, method, token):
-        url = self.uri + self.endpoint + self.edge + '/'
+    def __remote_call(self, method, path, token=None, params=None, get_params=None):
+        url = self.uri + path + '/'
         headers = {
             self.api_key_header: self.api_key,
             "Content-Type": "application/json",
         }
 
-        if method.upper() == 'GET' and self.get_params:
-            q_params = urllib.parse.urlencode(self.get_params)
+        if method.upper() == 'GET' and get_params:
+            q_params = urllib.parse.urlencode(get_params)
             url += "?"+q_params
-            self.get_params = None
 
         if token:
             headers[self.token_key] = "Token "+str(token)
-        # print(url)
-        payload = json.dumps(self.params, default=str)
-        response = requests.request(method.upper(), url, data=payload, headers=headers)
+        payload = json.dumps(params or {}, default=str)
+        response = self.transport.request(method, url, endpoint=path, timeout=self.endpoint_timeouts.get(path + '/'),
+                                          data=payload, headers=headers)
 
         if self.raise_on_error_status:
             response.raise_for_status()
@@ -90,67 +103,51 @@ class PriyoClient(object):  # pragma: no cover
     # @require(['mobile'])
     # @process('post')
     def register(self, **kwargs):
-        self.endpoint = '/accounts'
-        self.edge = '/registration'
-        self.params = kwargs
-        response = self.__remote_call('post')
-        return response
+        return self.__remote_call('post', '/accounts/registration', params=kwargs)
 
     # @require(['mobile'])
     # @process('post')
     def login(self, **kwargs):
-        self.endpoint = '/auth/api/v1'
-        self.edge = '/login'
-        self.params = kwargs
-        return self.__remote_call('post', self.token)
+        return self.__remote_call('post', '/auth/api/v1/login', self.token, params=kwargs)
 
     def logout(self, token):
-        self.endpoint = '/auth/api/v1'
-        self.edge = '/logout'
-        return self.__remote_call('post', token)
+        return self.__remote_call('post', '/auth/api/v1/logout', token)
 
     def get_profile(self, token):
-        self.endpoint = '/auth/api/v1'
-        self.edge = '/user-profile'
-        return self.__remote_call('get', token)
+        return self.__remote_call('get', '/auth/api/v1/user-profile', token)
 
     def profile_update(self, token, **kwargs):
-        self.endpoint = '/auth/api/v1'
-        self.edge = '/update-user-profile'
-        self.params = kwargs
-        return self.__remote_call('put', token)
+        return self.__remote_call('put', '/auth/api/v1/update-user-profile', token, params=kwargs)
 
     @require(['password'])
     # @process('post')
     def set_password(self, **kwargs):
-        self.endpoint = '/accounts'
-        self.edge = '/set-password'
-        self.params = kwargs
-        return self.__remote_call('post')
+        return self.__remote_call('post', '/accounts/set-password', params=kwargs)
 
     @require(['token'])
     # @process('get')
     def is_authenticated(self, **kwargs):
-        self.endpoint = '/accounts'
-        self.edge = '/status'
         self.token = kwargs.get('token')
-        return self.__remote_call('get')
+        return self.__remote_call('get', '/accounts/status')
+
+    def fetch_user_profile_by_uuid(self, uuid):
+        """Like get_user_profile_by_uuid, but raises instead of returning None when the auth service fails"""
+        response = self.__remote_call('get', '/auth/api/v1/user-profile-by-uid', get_params={"uid": uuid})
+        if response['status_code'] >= 500:
+            raise requests.HTTPError(f"Auth service returned {response['status_code']} for profile of {uuid}")
+        if response['status_code'] == 200:
+            return response
+        return None
 
     def get_user_profile_by_uuid(self, uuid):
         try:
-            self.endpoint = ''
-            self.edge = '/auth/api/v1/user-profile-by-uid'
-            self.get_params = {"uid": uuid}
-            response = self.__remote_call('get', None)
-            if response['status_code'] == 200:
-                return response
-            return None
+            return self.fetch_user_profile_by_uuid(uuid)
         except Exception as e:
             traceback.print_exc()
             return None
 
-    def get_profile_summary_by_uuid(self, uuid):
-        profile = self.get_user_profile_by_uuid(uuid=uuid)
+    @staticmethod
+    def build_profile_summary(uuid, profile):
         if profile and profile.get('is_active', False):
             return {
                 "name": profile['profile']['name'],
@@ -161,13 +158,41 @@ class PriyoClient(object):  # pragma: no cover
             }
         return None
 
+    def get_profile_summary_by_uuid(self, uuid):
+        return self.build_profile_summary(uuid, self.get_user_profile_by_uuid(uuid=uuid))
+
+    def get_user_profiles_by_uuids(self, uuids):
+        """
+        Returns uuid -> profile (None if not found or not fetched). Profiles are cached for AUTH_PROFILE_BY_UUID_TTL,
+        misses are fetched concurrently on at most AUTH_API_BATCH_WORKERS threads and a uuid being fetched by another
+        caller is waited for instead of fetched again.
+        """
+        uuids = list(dict.fromkeys(uuids))
+        profiles = self.profile_cache.get_many(uuids)
+        missing_uuids = [uuid for uuid in uuids if uuid not in profiles]
+        if not missing_uuids:
+            return profiles
+
+        def get_profile(uuid):
+            try:
+                return self.profile_cache.get_or_fill(uuid, lambda: self.fetch_user_profile_by_uuid(uuid))
+            except Exception:
+                traceback.print_exc()
+                return None
+
+        with ThreadPoolExecutor(max_workers=min(settings.AUTH_API_BATCH_WORKERS, len(missing_uuids))) as executor:
+            profiles.update(zip(missing_uuids, executor.map(get_profile, missing_uuids)))
+        return profiles
+
+    def get_profile_summaries_by_uuids(self, uuids):
+        profiles = self.get_user_profiles_by_uuids(uuids)
+        return {uuid: self.build_profile_summary(uuid, profile) for uuid, profile in profiles.items()}
+
 
     def get_other_user_profile_by_uuid(self, uuid, token):
         try:
-            self.endpoint = ''
-            self.edge = '/auth/api/v1/other-user-profile-by-uid/summary'
-            self.get_params = {"uid": uuid}
-            response = self.__remote_call('get', token)
+            response = self.__remote_call('get', '/auth/api/v1/other-user-profile-by-uid/summary', token,
+                                          get_params={"uid": uuid})
             if response['status_code'] == 200:
                 return response
             return None
@@ -176,10 +201,8 @@ class PriyoClient(object):  # pragma: no cover
             return None
 
     def get_user_by_mobile(self, mobile, token):
-        self.endpoint = ''
-        self.edge = '/auth/api/v1/other-user-profile-by-phone'
-        self.get_params = {"mobile": mobile}
-        response = self.__remote_call('get', token=token)
+        response = self.__remote_call('get', '/auth/api/v1/other-user-profile-by-phone', token,
+                                      get_params={"mobile": mobile})
         if response['status_code'] == 200:
             return response
         return None
@@ -187,31 +210,23 @@ class PriyoClient(object):  # pragma: no cover
 
     def verify_token(self, token):
         try:
-            self.endpoint = ''
-            self.edge = '/auth/api/v1/verify-token'
-            return self.__remote_call('GET', token)
+            return self.__remote_call('GET', '/auth/api/v1/verify-token', token)
         except Exception as e:
             print(e)
             return None
 
+    def get_signing_keys(self):
+        return self.__remote_call('get', '/auth/api/v1/jwks')
+
     def create_address(self, token, **kwargs):
-        self.endpoint = '/auth/api/v1'
-        self.edge = '/address'
         kwargs['address_type'] = 'shipping'
-        self.data = kwargs
-        return self.__remote_call('post', token)
+        return self.__remote_call('post', '/auth/api/v1/address', token, params=kwargs)
 
     def update_address(self,token, address_id, **kwargs):
-        self.endpoint = '/auth/api/v1'
-        self.edge = '/address/{}'.format(address_id)
-        self.params = kwargs
-        return self.__remote_call('put', token)
+        return self.__remote_call('put', '/auth/api/v1/address/{}'.format(address_id), token, params=kwargs)
 
     def update_mobile(self, token,  **kwargs):
-        self.endpoint = '/auth/api/v1'
-        self.edge = '/update-email-phone'
-        self.params = kwargs
-        response = self.__remote_call('post', token)
+        response = self.__remote_call('post', '/auth/api/v1/update-email-phone', token, params=kwargs)
         return response
 
     def upload_image(self, token,  image):
@@ -219,9 +234,10 @@ class PriyoClient(object):  # pragma: no cover
             self.token_key: "token {}".format(token),
             self.api_key_header: self.api_key
         }
-        image_upload_response = requests.post("{}/auth/api/v1/file-upload/".format(settings.AUTH_API_BASE),
-                                              files={'file': (image.name, image)},
-                                              headers=headers)
+        image_upload_response = self.transport.request(
+            'post', "{}/auth/api/v1/file-upload/".format(settings.AUTH_API_BASE), endpoint='/auth/api/v1/file-upload',
+            timeout=self.endpoint_timeouts['/auth/api/v1/file-upload/'], files={'file': (image.name, image)},
+            headers=headers)
         if not image_upload_response.status_code == 201:
             raise Exception("Exception in uploading image")
 
@@ -361,3 +361,10 @@ class EmploymentStatus(AbstractEnumChoices):
     CONTRACTUAL = "CONTRACTUAL"
     INTERNSHIP = "INTERNSHIP"
     OTHER = "OTHER"
+
+
+class EmailOutboxStatus(AbstractEnumChoices):
+    PENDING = 'PENDING'
+    SENDING = 'SENDING'  # claimed by a drain until next_attempt_at, a drain that died is taken over after it
+    SENT = 'SENT'
+    FAILED = 'FAILED'  # gave up after EMAIL_OUTBOX_MAX_ATTEMPTS
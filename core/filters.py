@@ -1,3 +1,5 @@
+from django.contrib.postgres.search import TrigramWordSimilarity
+from django.db import connection
 from django.db.models import Q, Subquery
 from django_filters.rest_framework import filters, FilterSet
 
@@ -24,20 +26,27 @@ class UserFilter(FilterSet):
     last_onboarding_step = filters.ChoiceFilter(method='filter_by_last_onboarding_step',
                                                 choices=OnboardingSteps.choices())
     admin_approved = filters.CharFilter(method='filter_by_admin_approved')
+    ordering = filters.OrderingFilter(fields=(
+        ('created_at', 'created_at'),
+        ('onboarding_progress__last_step_order', 'onboarding_stage'),
+    ))
 
     def filter_by_last_onboarding_step(self, queryset, name, value):
-        steps_after = OnboardingSteps.get_possible_steps_after(value)
-        users_in_later_steps = UserOnboardingStep.objects.filter(step__in=steps_after).values('user')
-        users_in_step = (UserOnboardingStep.objects.filter(step=value).values('user').difference(users_in_later_steps))
-        return queryset.filter(id__in=Subquery(users_in_step))
+        return queryset.filter(onboarding_progress__last_step=value)
 
     def filter_by_search_text(self, queryset, name, value):
+        # search_document is already lowercased, a plain LIKE on it is served by the trigram index
+        tokens = value.lower().split()
+        if not tokens:
+            return queryset
         q = Q()
-        for token in value.split():
-            q |= Q(first_name__icontains=token) | Q(middle_name__icontains=token) | \
-                 Q(last_name__icontains=token) | Q(email_address__icontains=token) | \
-                 Q(user_mobile_number__mobile_number__icontains=token)
-        return queryset.filter(q)
+        for token in tokens:
+            q |= Q(search_document__contains=token)
+        queryset = queryset.filter(q)
+        if connection.vendor == 'postgresql':
+            queryset = (queryset.annotate(search_rank=TrigramWordSimilarity(' '.join(tokens), 'search_document'))
+                        .order_by('-search_rank', '-id'))
+        return queryset
 
     def filter_by_profile_status(self, queryset, name, value):
         signup_complete_status = ProfileApprovalStatus.AWAITING_SIGNUP_COMPLETION.value
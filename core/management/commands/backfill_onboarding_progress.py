@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+
+from core.models import PriyoMoneyUser, UserOnboardingProgress
+
+
+class Command(BaseCommand):
+    help = ('Rebuilds UserOnboardingProgress of every user from their UserOnboardingStep rows, '
+            'existing rows are rebuilt as well')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000)
+        parser.add_argument('--start-id', type=int, default=0, help='Resume from this user id')
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        last_id = options['start_id'] - 1
+        total = 0
+
+        while True:
+            user_ids = list(PriyoMoneyUser.objects.filter(id__gt=last_id).order_by('id')
+                            .values_list('id', flat=True)[:chunk_size])
+            if not user_ids:
+                break
+
+            UserOnboardingProgress.rebuild_for_users(user_ids)
+
+            total += len(user_ids)
+            last_id = user_ids[-1]
+            self.stdout.write(f'Rebuilt {total} users, last user id {last_id}')
+
+        self.stdout.write(self.style.SUCCESS(f'Done, rebuilt onboarding progress of {total} users'))
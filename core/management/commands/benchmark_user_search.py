@@ -0,0 +1,47 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from core.filters import UserFilter
+from core.models import PriyoMoneyUser
+
+
+def legacy_search(queryset, value):
+    # The icontains search UserFilter used before search_document, kept here for comparison
+    q = Q()
+    for token in value.split():
+        q |= Q(first_name__icontains=token) | Q(middle_name__icontains=token) | \
+             Q(last_name__icontains=token) | Q(email_address__icontains=token) | \
+             Q(user_mobile_number__mobile_number__icontains=token)
+    return queryset.filter(q).order_by('-id')
+
+
+def indexed_search(queryset, value):
+    return UserFilter({'search_text': value}, queryset=queryset).qs
+
+
+class Command(BaseCommand):
+    help = 'Compares the latency of the legacy icontains user search with the indexed search'
+
+    def add_arguments(self, parser):
+        parser.add_argument('terms', nargs='+', help='Search texts to run, e.g. "john" "doe@gmail" "01700"')
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument('--page-size', type=int, default=20)
+
+    def measure(self, search, value, repeat, page_size):
+        timings = []
+        for _ in range(repeat):
+            started_at = time.perf_counter()
+            list(search(PriyoMoneyUser.objects.all(), value)[:page_size])
+            timings.append((time.perf_counter() - started_at) * 1000)
+        timings.sort()
+        return statistics.median(timings), timings[int(len(timings) * 0.95) - 1]
+
+    def handle(self, *args, **options):
+        self.stdout.write(f'{PriyoMoneyUser.objects.count()} users')
+        for value in options['terms']:
+            for label, search in [('legacy', legacy_search), ('indexed', indexed_search)]:
+                median, p95 = self.measure(search, value, options['repeat'], options['page_size'])
+                self.stdout.write(f'{value!r:24} {label:8} median {median:8.2f}ms  p95 {p95:8.2f}ms')
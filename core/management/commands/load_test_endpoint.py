@@ -0,0 +1,47 @@
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = ('Sends concurrent GET requests to an endpoint and prints latency percentiles. Run it against a server '
+            'started with DB_CONNECTION_MODE=per_request and again with persistent/pgbouncer to compare, e.g. '
+            'load_test_endpoint http://localhost:8000/v1/user/ --header "Authorization: Bearer <token>"')
+
+    def add_arguments(self, parser):
+        parser.add_argument('url')
+        parser.add_argument('--header', action='append', default=[], help='"Name: value", can be repeated')
+        parser.add_argument('--requests', type=int, default=500)
+        parser.add_argument('--concurrency', type=int, default=10)
+        parser.add_argument('--warmup', type=int, default=20)
+
+    @staticmethod
+    def percentile(sorted_values, percent):
+        return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * percent / 100))]
+
+    def handle(self, *args, **options):
+        headers = dict(header.split(':', 1) for header in options['header'])
+        headers = {name.strip(): value.strip() for name, value in headers.items()}
+        session = requests.Session()
+        session.mount('http', requests.adapters.HTTPAdapter(pool_maxsize=options['concurrency']))
+
+        def timed_request(_):
+            started_at = time.perf_counter()
+            response = session.get(options['url'], headers=headers, timeout=30)
+            return (time.perf_counter() - started_at) * 1000, response.status_code
+
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as executor:
+            list(executor.map(timed_request, range(options['warmup'])))
+            started_at = time.perf_counter()
+            results = list(executor.map(timed_request, range(options['requests'])))
+            elapsed = time.perf_counter() - started_at
+
+        timings = sorted(timing for timing, _ in results)
+        errors = sum(1 for _, status_code in results if status_code >= 400)
+        self.stdout.write(f'{len(results)} requests, {options["concurrency"]} concurrent, {errors} errors, '
+                          f'{len(results) / elapsed:.1f} req/s')
+        self.stdout.write(f'p50 {self.percentile(timings, 50):.1f}ms  p90 {self.percentile(timings, 90):.1f}ms  '
+                          f'p99 {self.percentile(timings, 99):.1f}ms  mean {statistics.mean(timings):.1f}ms')
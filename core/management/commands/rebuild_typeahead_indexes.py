@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from core.utility.typeahead import label_indexes
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the Redis label indexes behind the admin user, business and tariff typeahead endpoints'
+
+    def handle(self, *args, **options):
+        for index in label_indexes:
+            index.invalidate()
+            index.rebuild()
+            self.stdout.write(f'Rebuilt {index.name} typeahead index')
+        self.stdout.write(self.style.SUCCESS('Done'))
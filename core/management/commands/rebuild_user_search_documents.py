@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+
+from core.models import PriyoMoneyUser
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds PriyoMoneyUser.search_document used by the admin user search'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000)
+        parser.add_argument('--start-id', type=int, default=0, help='Resume from this user id')
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        last_id = options['start_id'] - 1
+        total = 0
+
+        while True:
+            users = list(PriyoMoneyUser.objects.select_related('user_mobile_number').filter(id__gt=last_id)
+                         .order_by('id')[:chunk_size])
+            if not users:
+                break
+
+            for user in users:
+                mobile_number = user.user_mobile_number.mobile_number if user.has_mobile_number() else None
+                user.search_document = user.build_search_document(mobile_number)
+            PriyoMoneyUser.objects.bulk_update(users, ['search_document'])
+
+            total += len(users)
+            last_id = users[-1].id
+            self.stdout.write(f'Rebuilt search document of {total} users, last user id {last_id}')
+
+        self.stdout.write(self.style.SUCCESS(f'Done, rebuilt search document of {total} users'))
@@ -0,0 +1,37 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from core.utility.onboarding_step_handler import BulkOnboardingStepReconciler
+
+
+class Command(BaseCommand):
+    help = 'Adds missing UserOnboardingStep rows for all users, chunk by chunk'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500)
+        parser.add_argument('--start-id', type=int, default=0, help='Resume from this user id')
+
+    def handle(self, *args, **options):
+        reconciler = BulkOnboardingStepReconciler(chunk_size=options['chunk_size'])
+        last_id = options['start_id'] - 1
+        total_users, total_steps = 0, 0
+        started_at = time.monotonic()
+
+        while True:
+            chunk_started_at = time.monotonic()
+            chunk_last_id, users_count, steps_count = reconciler.reconcile_chunk(last_id)
+            if chunk_last_id is None:
+                break
+
+            last_id = chunk_last_id
+            total_users += users_count
+            total_steps += steps_count
+            chunk_time = time.monotonic() - chunk_started_at
+            self.stdout.write(f'Reconciled {total_users} users, added {steps_count} steps in this chunk, '
+                              f'{users_count / chunk_time:.1f} users/s, last user id {last_id}')
+
+        elapsed = time.monotonic() - started_at
+        self.stdout.write(self.style.SUCCESS(
+            f'Done, reconciled {total_users} users and added {total_steps} steps in {elapsed:.1f}s '
+            f'({total_users / elapsed if elapsed else 0:.1f} users/s)'))
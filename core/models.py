@@ -1,10 +1,12 @@
+import re
 from _decimal import Decimal
 import phonenumbers
 from django.conf import settings
+from django.contrib.postgres.indexes import GinIndex
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
 from django.core.validators import MinValueValidator, MaxValueValidator
-from django.db import models
+from django.db import models, transaction
 from django.db.models import Q, UniqueConstraint
 from django.utils import timezone
 from phonenumbers import NumberParseException
@@ -12,7 +14,8 @@ from requests import RequestException
 
 from core.enums import ProfileApprovalStatus, SyncteraUserStatus, AddressType, ServiceList, DeviceType, ProfileType, \
     SocureProgressStatus, AllowedCountries, LocationTypes, OnboardingSteps, NoteType, EmploymentStatus, UserGender,\
-    UserSourceOfHearingOptions, SubServiceList, PlaidAuthorizationRequestStatus, AdminReviewStatus, MaritalStatus, BdDivisions
+    UserSourceOfHearingOptions, SubServiceList, PlaidAuthorizationRequestStatus, AdminReviewStatus, MaritalStatus, \
+    BdDivisions, EmailOutboxStatus
 from core.helpers import get_dial_code_list
 from dynamic_settings.helpers import global_dynamic_settings
 from core.dynamic_settings import AdminApprovalRequiredForBDUser, AdminApprovalRequiredForUSUser
@@ -84,8 +87,36 @@ class PriyoMoneyUser(PersonMixin, OnboardingMixin, TimeStampMixin, SoftDeleteMix
     nationality = models.CharField(max_length=64, null=True, blank=True)
     marital_status = models.CharField(max_length=32, choices=MaritalStatus.choices(), null=True, blank=True)
 
+    # Lowercased names, email and mobile number (as entered and as digits), searched by UserFilter through a trigram index
+    search_document = models.TextField(default='', blank=True, editable=False)
+
     objects = SoftDeleteManager()
     SYNCTERA_ID_FIELD = 'synctera_user_id'
+    SEARCH_DOCUMENT_FIELDS = ('first_name', 'middle_name', 'last_name', 'email_address')
+
+    class Meta:
+        indexes = [
+            GinIndex(fields=['search_document'], name='user_search_document_trgm', opclasses=['gin_trgm_ops']),
+        ]
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or set(update_fields) & set(self.SEARCH_DOCUMENT_FIELDS):
+            mobile_number = self.user_mobile_number.mobile_number if self.pk and self.has_mobile_number() else None
+            self.search_document = self.build_search_document(mobile_number)
+            if update_fields is not None:
+                kwargs['update_fields'] = {*update_fields, 'search_document'}
+        super().save(*args, **kwargs)
+
+    def build_search_document(self, mobile_number=None):
+        values = [getattr(self, field) for field in self.SEARCH_DOCUMENT_FIELDS]
+        if mobile_number:
+            values.extend([mobile_number, re.sub(r'\D', '', mobile_number)])
+        return ' '.join(str(value) for value in values if value).lower()
+
+    def update_search_document(self, mobile_number=None):
+        self.search_document = self.build_search_document(mobile_number)
+        PriyoMoneyUser.objects.filter(pk=self.pk).update(search_document=self.search_document)
 
     _required_fields_for_onboarding = ('first_name', 'email_address', 'date_of_birth', 'one_auth_uuid')
     _country_specific_required_docs_for_onboarding = {
@@ -126,7 +157,8 @@ class PriyoMoneyUser(PersonMixin, OnboardingMixin, TimeStampMixin, SoftDeleteMix
         if force_overwrite or self.shipping_address is None:
             if self.shipping_address is not None:
                 self.shipping_address.delete()
-            address = self.legal_address
+            # Copy from a fresh row so the legal address held in the snapshot isn't mutated in place
+            address = UserAddress.objects.get(pk=self.legal_address.pk)
             address.pk = None
             address.address_type = AddressType.SHIPPING.value
             address.save()
@@ -137,24 +169,47 @@ class PriyoMoneyUser(PersonMixin, OnboardingMixin, TimeStampMixin, SoftDeleteMix
     def is_mobile_data_complete(self):
         return self.has_mobile_number() and self.user_mobile_number.is_complete()
 
+    def is_prefetched(self, relation):
+        return relation in getattr(self, '_prefetched_objects_cache', {})
+
+    def get_address_snapshot(self):
+        """
+        Returns the user's addresses bucketed by address_type, loaded with a single query (or from the prefetch
+        cache) and memoized on this instance. UserAddress.save()/delete() invalidate it.
+        """
+        if getattr(self, '_address_snapshot', None) is None:
+            snapshot = {}
+            for address in sorted(self.user_addresses.all(), key=lambda address: address.pk):
+                snapshot.setdefault(address.address_type, address)
+            self._address_snapshot = snapshot
+        return self._address_snapshot
+
+    def invalidate_address_snapshot(self):
+        self._address_snapshot = None
+        getattr(self, '_prefetched_objects_cache', {}).pop('user_addresses', None)
+
+    def get_address(self, address_type):
+        return self.get_address_snapshot().get(address_type)
+
     @property
     def legal_address(self):
-        return self.user_addresses.filter(address_type=AddressType.LEGAL.value).first()
+        return self.get_address(AddressType.LEGAL.value)
 
     @property
     def shipping_address(self):
-        return self.user_addresses.filter(address_type=AddressType.SHIPPING.value).first()
+        return self.get_address(AddressType.SHIPPING.value)
 
     @property
     def billing_address(self):
-        return self.user_addresses.filter(address_type=AddressType.BILLING.value).first()
+        return self.get_address(AddressType.BILLING.value)
 
     def has_legal_address(self):
-        return self.user_addresses.filter(address_type=AddressType.LEGAL.value).exists()
+        return self.legal_address is not None
 
     def is_address_complete(self):
-        return (self.legal_address and self.legal_address.is_complete() and
-                self.shipping_address and self.shipping_address.is_complete())
+        legal_address, shipping_address = self.legal_address, self.shipping_address
+        return (legal_address and legal_address.is_complete() and
+                shipping_address and shipping_address.is_complete())
 
     def has_additional_info(self):
         return hasattr(self, 'bd_user_additional_info') and self.bd_user_additional_info is not None
@@ -169,8 +224,15 @@ class PriyoMoneyUser(PersonMixin, OnboardingMixin, TimeStampMixin, SoftDeleteMix
 
     def has_document(self, doc_type: DocumentType):
         from file_uploader.models import Documents
+        if 'documents' in getattr(self.profile, '_prefetched_objects_cache', {}):
+            return any(document.doc_type == doc_type for document in self.profile.documents.all())
         return Documents.objects.filter(profile=self.profile, doc_type=doc_type).exists()
 
+    def has_any_document(self):
+        if 'documents' in getattr(self.profile, '_prefetched_objects_cache', {}):
+            return len(self.profile.documents.all()) > 0
+        return self.profile.documents.exists()
+
     def has_necessary_documents(self):
         required_docs = self._country_specific_required_docs_for_onboarding.get(self.get_country(), ())
         return all(self.has_document(doc) for doc in required_docs)
@@ -182,13 +244,23 @@ class PriyoMoneyUser(PersonMixin, OnboardingMixin, TimeStampMixin, SoftDeleteMix
         return hasattr(self, 'user_meta_data') and self.user_meta_data is not None
 
     def has_browser_location(self):
+        if self.is_prefetched('userlocation_set'):
+            return any(location.type == LocationTypes.BROWSER.value for location in self.userlocation_set.all())
         saved_locations = UserLocation.objects.filter(Q(user=self) & Q(type=LocationTypes.BROWSER.value))
         return saved_locations.count() != 0
 
     def get_active_subscriptions(self):
         return self.subscriptions.select_related('package').filter(is_active=True)
 
+    def has_active_subscription(self):
+        if self.is_prefetched('subscriptions'):
+            return any(subscription.is_active for subscription in self.subscriptions.all())
+        return self.get_active_subscriptions().exists()
+
     def get_active_onboarding_subscription(self):
+        if self.is_prefetched('subscriptions'):
+            return next((subscription for subscription in self.subscriptions.all()
+                         if subscription.is_active and subscription.package.type == PackageType.ONBOARDING.value), None)
         return self.subscriptions.select_related('package').filter(is_active=True,
                                                                    package__type=PackageType.ONBOARDING.value).first()
 
@@ -196,6 +268,9 @@ class PriyoMoneyUser(PersonMixin, OnboardingMixin, TimeStampMixin, SoftDeleteMix
         return self.referral_code_usage.referral_code if hasattr(self, 'referral_code_usage') else None
 
     def get_active_persona_verification(self):
+        if self.is_prefetched('persona_verifications'):
+            return next((verification for verification in sorted(self.persona_verifications.all(), key=lambda v: v.pk)
+                         if verification.is_active), None)
         return self.persona_verifications.filter(is_active=True).first()
 
     def is_persona_verified(self):
@@ -259,6 +334,15 @@ class UserMobileNumber(PersonMixin, OnboardingMixin, TimeStampMixin, SoftDeleteM
     def get_user(self):
         return self.user
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        self.user.update_search_document(self.mobile_number)
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        self.user.update_search_document()
+        return result
+
     _required_fields_for_onboarding = ('mobile_number',)
 
     @classmethod
@@ -301,6 +385,20 @@ class UserAddress(PersonMixin, AddressMixin, TimeStampMixin, OnboardingMixin):
     def get_user(self):
         return self.user
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        self.invalidate_user_address_snapshot()
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        self.invalidate_user_address_snapshot()
+        return result
+
+    def invalidate_user_address_snapshot(self):
+        # Only the in-memory user instance this address is attached to holds a snapshot, don't load one from DB
+        if self._meta.get_field('user').is_cached(self) and self.user is not None:
+            self.user.invalidate_address_snapshot()
+
 
 class UserAdditionalAddress(PersonMixin, AddressMixin, TimeStampMixin):
     # common
@@ -641,6 +739,84 @@ class UserOnboardingStep(PersonMixin, TimeStampMixin):
         return self.user
 
 
+class UserOnboardingProgress(TimeStampMixin):
+    """
+    Denormalized onboarding progress of a user, kept in sync by OnboardingStepManager.add_step. last_step is the
+    finished step that comes last in OnboardingSteps order, last_step_order is its position in that order.
+    """
+    user = models.OneToOneField(PriyoMoneyUser, on_delete=models.CASCADE, related_name='onboarding_progress')
+    last_step = models.CharField(max_length=32, choices=OnboardingSteps.choices(), null=True, blank=True)
+    last_step_order = models.PositiveSmallIntegerField(null=True, blank=True)
+    steps_done = models.PositiveSmallIntegerField(default=0)
+    step_durations = models.JSONField(default=dict)  # step -> seconds taken to reach it from the previous step
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['last_step']),
+            models.Index(fields=['last_step_order']),
+        ]
+
+    def get_user(self):
+        return self.user
+
+    def record_step(self, onboarding_step: UserOnboardingStep):
+        if onboarding_step.step in self.step_durations:
+            return
+        self.steps_done += 1
+        self.step_durations[onboarding_step.step] = (onboarding_step.time_taken.total_seconds()
+                                                     if onboarding_step.time_taken else None)
+        step_order = OnboardingSteps.values().index(onboarding_step.step)
+        if self.last_step_order is None or step_order > self.last_step_order:
+            self.last_step, self.last_step_order = onboarding_step.step, step_order
+
+    def record_steps(self, onboarding_steps):
+        for onboarding_step in sorted(onboarding_steps, key=lambda step: step.created_at):
+            self.record_step(onboarding_step)
+
+    @classmethod
+    def record_step_for_user(cls, onboarding_step: UserOnboardingStep):
+        # Expected to run inside the transaction that created the step, the row lock serializes concurrent steps
+        progress, created = cls.objects.select_for_update().get_or_create(user_id=onboarding_step.user_id)
+        if created:
+            # The user may have steps from before their progress was kept, those count as well
+            progress.record_steps(UserOnboardingStep.objects.filter(user_id=onboarding_step.user_id))
+        progress.record_step(onboarding_step)
+        progress.save()
+        return progress
+
+    @classmethod
+    def build_for_user(cls, user_id, onboarding_steps):
+        progress = cls(user_id=user_id)
+        progress.record_steps(onboarding_steps)
+        return progress
+
+    @classmethod
+    def rebuild_for_users(cls, user_ids):
+        """
+        Rebuilds the progress of the users from their steps. Existing rows are locked and updated in place, so a step
+        recorded meanwhile waits for the rebuild and is then added to the rebuilt row.
+        """
+        with transaction.atomic():
+            existing_progresses = {progress.user_id: progress
+                                   for progress in cls.objects.select_for_update().filter(user_id__in=user_ids)}
+            steps_by_user = {}
+            for onboarding_step in UserOnboardingStep.objects.filter(user_id__in=user_ids):
+                steps_by_user.setdefault(onboarding_step.user_id, []).append(onboarding_step)
+
+            updated_progresses, new_progresses = [], []
+            for user_id in user_ids:
+                progress = cls.build_for_user(user_id, steps_by_user.get(user_id, []))
+                if user_id in existing_progresses:
+                    progress.pk, progress.updated_at = existing_progresses[user_id].pk, timezone.now()
+                    updated_progresses.append(progress)
+                else:
+                    new_progresses.append(progress)
+            cls.objects.bulk_update(updated_progresses, ['last_step', 'last_step_order', 'steps_done',
+                                                         'step_durations', 'updated_at'])
+            # A row created meanwhile by record_step_for_user already has all of its user's steps
+            cls.objects.bulk_create(new_progresses, ignore_conflicts=True)
+
+
 class UserSourceOfHearing(PersonMixin, TimeStampMixin):
     user = models.OneToOneField(PriyoMoneyUser, on_delete=models.CASCADE, related_name="user_source_of_hearing")
     source_of_hearing = models.CharField(max_length=32, choices=UserSourceOfHearingOptions.choices())
@@ -774,4 +950,29 @@ class UserFinancerInfo(TimeStampMixin):
         return self.user
 
     def get_user_set(self):
-        return [self.user]
\ No newline at end of file
+        return [self.user]
+
+
+class EmailOutbox(TimeStampMixin):
+    """
+    An email to send, written in the transaction of the change it is about and sent by the drain_email_outbox task
+    through EmailSender: EmailSender(user=user, admin=admin, kwargs=sender_kwargs).<method>(*args, **kwargs).
+    """
+    method = models.CharField(max_length=64)
+    args = models.JSONField(default=list)
+    kwargs = models.JSONField(default=dict)
+    user = models.ForeignKey(PriyoMoneyUser, on_delete=models.CASCADE, null=True, blank=True)
+    admin = models.ForeignKey(PayAdmin, on_delete=models.CASCADE, null=True, blank=True)
+    sender_kwargs = models.JSONField(null=True, blank=True)
+
+    status = models.CharField(max_length=16, choices=EmailOutboxStatus.choices(),
+                              default=EmailOutboxStatus.PENDING.value)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(null=True, blank=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at']),
+        ]
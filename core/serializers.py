@@ -1,18 +1,20 @@
 import logging
 from _decimal import Decimal
 import zipcodes
-from django.core.files.storage import default_storage
+from django.conf import settings
 from django.core.validators import RegexValidator
+from django.db.models import Prefetch
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError, PermissionDenied
-from common.helpers import google_bucket_file_url
 from rest_framework.serializers import ModelSerializer
 from core.helpers import get_note_item_choices, ContentTypeField
 from core.permissions import is_admin, is_client
 from core.utility.onboarding_step_handler import OnboardingStepManager
 from external_payment.models import ExternalPayment
 from external_payment.serializers import ExternalPaymentSerializer
+from file_uploader.bucket import get_signed_url
 from file_uploader.enums import DocumentType
+from file_uploader.models import Documents
 from file_uploader.validators import FileValidator
 from pay_admin.serializers import AdminUserSerializer
 from utilities.enums import RequestMethod
@@ -24,6 +26,7 @@ from core.models import PriyoMoneyUser, UserMobileNumber, UserAddress, Profile,
     UserOnboardingStep, UserSourceOfIncome, UserSourceOfHearing, PlaidAuthorizationRequest, Note, UserContactReference, \
     ExternalCustomerIdentification
 from invitation.models import InvitationToken
+from subscription.models import Subscription
 from utilities.serializer_mixin import WritableFieldsMixin
 from verifications.serializers import PersonaVerificationSerializer
 
@@ -195,6 +198,31 @@ class PriyoMoneyUserSerializer(ModelSerializer):
     last_onboarding_step = serializers.SerializerMethodField(read_only=True)
     profile_image_icon = serializers.SerializerMethodField(read_only=True)
 
+    @staticmethod
+    def setup_eager_loading(queryset):
+        """
+        Loads every relation read by this serializer in a constant number of queries, so that a page of users
+        is serialized without per-row queries. Serializer methods read from these caches when they are present.
+        """
+        payments_accessor = ExternalPayment._meta.get_field('user').remote_field.get_accessor_name()
+        return queryset.select_related(
+            'user_mobile_number',
+            'bd_user_additional_info',
+            'used_token',
+            'user_meta_data__profile_approved_by',
+            'user_meta_data__profile_verified_by',
+        ).prefetch_related(
+            'user_addresses',
+            'related_identifications',
+            'persona_verifications',
+            'onboarding_steps',
+            Prefetch('subscriptions', queryset=Subscription.objects.select_related('package').order_by('id')),
+            Prefetch(payments_accessor, queryset=ExternalPayment.objects.all(), to_attr='prefetched_payments'),
+            Prefetch('documents_uploader',
+                     queryset=Documents.objects.filter(doc_type=DocumentType.PROFILE_IMAGE.value).order_by('id'),
+                     to_attr='prefetched_profile_images'),
+        )
+
     def get_last_onboarding_step(self, instance):
         return OnboardingStepManager(instance).get_last_finished_step()
 
@@ -291,16 +319,18 @@ class PriyoMoneyUserSerializer(ModelSerializer):
         return UserMetaDataSerializer(meta_data, context={'exclude_metadata': True}).data if meta_data else None
 
     def get_payments(self, instance: PriyoMoneyUser):
-        payments = ExternalPayment.objects.filter(user=instance)
+        payments = getattr(instance, 'prefetched_payments', None)
+        if payments is None:
+            payments = ExternalPayment.objects.filter(user=instance)
         return ExternalPaymentSerializer(instance=payments, many=True).data
 
     def get_identifications(self, instance: PriyoMoneyUser):
-        identifications = UserIdentification.objects.filter(user=instance)
+        identifications = instance.related_identifications.all()
         return UserIdentificationSerializer(instance=identifications, many=True).data
 
     def get_verifications(self, instance: PriyoMoneyUser):
         if self.context and is_admin(self.context.get('request')):
-            verifications = instance.persona_verifications
+            verifications = instance.persona_verifications.all()
             return PersonaVerificationSerializer(instance=verifications, many=True).data
         else:
             return None
@@ -309,9 +339,14 @@ class PriyoMoneyUserSerializer(ModelSerializer):
         if not self.context.get('include_profile_image_icon'):
             return None
         from file_uploader.manager import ImageCompressManager
-        return ImageCompressManager.get_compressed_image_url(
-            document=instance.documents_uploader.filter(doc_type=DocumentType.PROFILE_IMAGE.value).first()
-        )
+        return ImageCompressManager.get_compressed_image_url(document=get_profile_image_document(instance))
+
+
+def get_profile_image_document(user: PriyoMoneyUser):
+    profile_images = getattr(user, 'prefetched_profile_images', None)
+    if profile_images is not None:
+        return profile_images[0] if profile_images else None
+    return user.documents_uploader.filter(doc_type=DocumentType.PROFILE_IMAGE.value).order_by('id').first()
 
 
 class UserIdentificationSerializer(ModelSerializer):
@@ -339,9 +374,7 @@ class UserBasicInfoSerializer(ModelSerializer):
         if not self.context.get('include_profile_image_icon'):
             return None
         from file_uploader.manager import ImageCompressManager
-        return ImageCompressManager.get_compressed_image_url(
-            document=instance.documents_uploader.filter(doc_type=DocumentType.PROFILE_IMAGE.value).first()
-        )
+        return ImageCompressManager.get_compressed_image_url(document=get_profile_image_document(instance))
 
     class Meta:
         model = PriyoMoneyUser
@@ -586,7 +619,7 @@ class UserOnboardingStepClientSerializer(WritableFieldsMixin, ModelSerializer):
     def create(self, validated_data):
         user = self.context['request'].user
         step = validated_data['step']
-        onboarding_step, created = UserOnboardingStep.objects.get_or_create(user=user, step=step)
+        onboarding_step, created = OnboardingStepManager(user).add_step(step, check_completion=False)
         return onboarding_step
 
     class Meta:
@@ -596,6 +629,12 @@ class UserOnboardingStepClientSerializer(WritableFieldsMixin, ModelSerializer):
 
 
 class UserOnboardingStepAdminSerializer(ModelSerializer):
+    def create(self, validated_data):
+        # Through the manager like the client serializer, so the user's onboarding progress is kept up to date
+        manager = OnboardingStepManager(validated_data['user'])
+        onboarding_step, created = manager.add_step(validated_data['step'], check_completion=False)
+        return onboarding_step
+
     class Meta:
         model = UserOnboardingStep
         fields = '__all__'
@@ -656,10 +695,7 @@ class NoteSerializer(ModelSerializer):
             rep['created_by'] = AdminUserSerializer(instance.created_by).data
         if instance.document:
             file_name = instance.document.uploaded_file_name
-            if default_storage.exists(file_name):
-                rep['gcp_url'] = google_bucket_file_url(file_name)
-            else:
-                rep['gcp_url'] = ""
+            rep['gcp_url'] = get_signed_url(file_name, check_exists=True)
         return rep
 
     def validate(self, attrs):
@@ -677,5 +713,14 @@ class NoteSerializer(ModelSerializer):
         read_only_fields = ['created_by', 'note_type']
 
 
+class BulkProfileApprovalSerializer(serializers.Serializer):
+    APPROVE = 'approve'
+    REJECT = 'reject'
+
+    action = serializers.ChoiceField(choices=[APPROVE, REJECT])
+    user_ids = serializers.ListField(child=serializers.IntegerField(), allow_empty=False,
+                                     max_length=settings.BULK_PROFILE_APPROVAL_LIMIT)
+
+
 class UserFullAccessSerializer(serializers.Serializer):
     user = serializers.PrimaryKeyRelatedField(queryset=PriyoMoneyUser.objects.filter(is_full_access_given=False))
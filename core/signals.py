@@ -1,12 +1,17 @@
+import logging
 import uuid
-from django.db.models.signals import pre_save
+from django.db import transaction
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.dispatch import receiver
 
 from business.models import Business
 from core.enums import ProfileType
 from core.models import PriyoMoneyUser, Profile
+from core.utility.typeahead import label_indexes
 from linked_business.models import LinkedBusiness
 
+logger = logging.getLogger(__name__)
+
 
 def attach_profile_on_instance(instance, profile_type):
     if hasattr(instance, 'profile'):
@@ -30,3 +35,29 @@ def create_profile_on_business_creation(instance, **kwargs):
 @receiver(pre_save, sender=LinkedBusiness, dispatch_uid=uuid.uuid4())
 def create_profile_on_linked_business_creation(instance, **kwargs):
     attach_profile_on_instance(instance, profile_type=ProfileType.LINKED_BUSINESS.value)
+
+
+def run_label_index_update(index, action, object_id):
+    def update():
+        try:
+            action(object_id)
+        except Exception as ex:
+            logger.exception(f'Could not update {index.name} typeahead index for {object_id}: {ex}')
+    transaction.on_commit(update)
+
+
+def update_label_index_on_save(sender, instance, update_fields=None, **kwargs):
+    index = label_index_by_model[sender]
+    if index.is_relevant_save(update_fields):
+        run_label_index_update(index, index.update, instance.pk)
+
+
+def update_label_index_on_delete(sender, instance, **kwargs):
+    index = label_index_by_model[sender]
+    run_label_index_update(index, index.remove, instance.pk)
+
+
+label_index_by_model = {index.model: index for index in label_indexes}
+for model in label_index_by_model:
+    post_save.connect(update_label_index_on_save, sender=model, dispatch_uid=f'label_index_save_{model.__name__}')
+    post_delete.connect(update_label_index_on_delete, sender=model, dispatch_uid=f'label_index_delete_{model.__name__}')
@@ -0,0 +1,44 @@
+import logging
+
+from celery import shared_task
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+@shared_task
+def refresh_auth_signing_keys():
+    if settings.JWT_VERIFICATION_MODE != 'local':
+        return
+    from priyomoney_client.jwt_verification import AuthSigningKeys
+    jwks = AuthSigningKeys.fetch()
+    logger.info(f'Refreshed {len(jwks["keys"])} auth signing keys')
+
+
+@shared_task
+def flush_user_activity():
+    from core.utility.activity import user_activity_buffer
+    flushed = user_activity_buffer.flush()
+    logger.info(f'Flushed last_active_at of {flushed} users')
+
+
+@shared_task
+def run_person_transition_side_effects(requested_state, previous_status, new_status, user_ids):
+    from core.utility.state_manager import PersonManager
+    PersonManager.run_side_effects(requested_state, previous_status, new_status, user_ids)
+    logger.info(f'Ran {requested_state} side effects for {len(user_ids)} users')
+
+
+@shared_task
+def drain_email_outbox():
+    from core.utility.email_outbox import drain_outbox
+    processed = drain_outbox()
+    if processed:
+        logger.info(f'Processed {processed} outbox emails')
+
+
+@shared_task
+def rebuild_typeahead_index(name):
+    from core.utility.typeahead import label_indexes
+    index = next(index for index in label_indexes if index.name == name)
+    index.rebuild()
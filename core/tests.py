@@ -0,0 +1,462 @@
+import os
+from unittest import mock
+
+from django.db import connection
+import requests
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.test import TestCase, RequestFactory, override_settings
+from django_redis import get_redis_connection
+from external_payment.enums import ExternalPaymentStatus, ExternalPaymentType
+from external_payment.models import ExternalPayment
+from file_uploader.enums import DocumentType, RelatedResourceType
+from file_uploader.models import Documents
+from verifications.enums import IDType, PersonaInquiryStatus
+from verifications.models import PersonaVerification
+from django.test.utils import CaptureQueriesContext
+
+from core.enums import AddressType, AllowedCountries, OnboardingSteps, ServiceList, ProfileApprovalStatus, \
+    AdminReviewStatus, EmailOutboxStatus
+from core.filters import UserFilter
+from core.models import PriyoMoneyUser, UserAddress, UserMobileNumber, UserOnboardingStep, UserOnboardingProgress, \
+    EmailOutbox, UserMetaData, UserIdentification
+from core.serializers import PriyoMoneyUserSerializer, UserOnboardingStepAdminSerializer
+from core.utility.email_outbox import OutboxEmailSender, drain_outbox
+from core.utility.onboarding_step_handler import OnboardingStepManager, BulkOnboardingStepReconciler
+from core.utility.state_manager import PersonManager
+from core.utility.typeahead import user_label_index
+from middlewares.replica_routing import ReplicaRoutingMiddleware
+from pay_admin.models import PayAdmin
+from priyomoney_client.cache_fill import SingleFlightCache
+from priyomoney_client.http_transport import PooledHttpTransport
+from priyomoney_client.rate_limit import RedisTokenBucket, RateLimitTimeout, priority, call_priority, BACKGROUND, \
+    INTERACTIVE
+from priyomoney_client.request_config import request_config
+from priyomoney_client.routes import CustomRouter, ReplicaPool, ReplicaLagMonitor
+from utilities.helpers import make_dummy_request
+
+
+def create_sample_user(index):
+    user = PriyoMoneyUser.objects.create(
+        one_auth_uuid=f'uuid-{index}',
+        first_name='John',
+        last_name=f'Doe{index}',
+        email_address=f'john.doe{index}@example.com',
+    )
+    for address_type in [AddressType.LEGAL.value, AddressType.SHIPPING.value]:
+        UserAddress.objects.create(user=user, address_type=address_type, address_line_1='House 1, Road 1',
+                                   postal_code='1212', country=AllowedCountries.BD.value)
+    UserMobileNumber.objects.create(user=user, mobile_number=f'+8801700000{index:03d}',
+                                    mobile_number_country_prefix='+880')
+    UserOnboardingStep.objects.create(user=user, step=OnboardingSteps.LOG_IN.value)
+    UserOnboardingStep.objects.create(user=user, step=OnboardingSteps.COUNTRY.value)
+    return user
+
+
+def create_sample_user_relations(user, index):
+    """Rows of every relation PriyoMoneyUserSerializer reads, so eager loading is exercised with data"""
+    UserMetaData.objects.create(user=user, signup_meta_data={'source': 'test'}, http_user_agent='test')
+    UserIdentification.objects.create(user=user, identification_class=IDType.id.value,
+                                      identification_number=f'{index:010d}')
+    PersonaVerification.objects.create(user=user, status=PersonaInquiryStatus.success_statuses()[0], is_active=True)
+    ExternalPayment.objects.create(user=user, status=ExternalPaymentStatus.choices()[0][0], is_active=True,
+                                   payment_type=ExternalPaymentType.ONBOARDING_FEE.value)
+    for name in ['profile_image', 'profile_image_old']:
+        Documents.objects.create(uploader=user, doc_type=DocumentType.PROFILE_IMAGE.value, doc_name=name,
+                                 related_resource_type=RelatedResourceType.CUSTOMER.value,
+                                 uploaded_file_name=f'customer/u{user.id}/{name}.png',
+                                 uploaded_compressed_file_name=f'compressed/customer/u{user.id}/{name}.webp')
+
+
+@mock.patch('file_uploader.bucket.google_bucket_file_url',
+            mock.MagicMock(side_effect=lambda file_name, *args: f'https://bucket/{file_name}'))
+class PriyoMoneyUserSerializerQueryCountTest(TestCase):
+    def serialize_users(self):
+        queryset = PriyoMoneyUserSerializer.setup_eager_loading(PriyoMoneyUser.objects.order_by('-created_at'))
+        context = {
+            'request': make_dummy_request(service=ServiceList.ADMIN.value),
+            'include_profile_image_icon': True,
+        }
+        with CaptureQueriesContext(connection) as captured:
+            data = PriyoMoneyUserSerializer(queryset, many=True, context=context).data
+        return data, len(captured.captured_queries)
+
+    def test_query_count_does_not_grow_with_number_of_users(self):
+        for index in range(2):
+            create_sample_user_relations(create_sample_user(index), index)
+        _, queries_for_two_users = self.serialize_users()
+
+        for index in range(2, 10):
+            create_sample_user_relations(create_sample_user(index), index)
+        data, queries_for_ten_users = self.serialize_users()
+
+        self.assertEqual(len(data), 10)
+        self.assertEqual(queries_for_two_users, queries_for_ten_users)
+        self.assertEqual(data[0]['last_onboarding_step'], OnboardingSteps.COUNTRY.value)
+        self.assertEqual(data[0]['legal_address']['country'], AllowedCountries.BD.value)
+        for field in ['payments', 'identifications', 'verifications']:
+            self.assertEqual(len(data[0][field]), 1)
+        self.assertIsNotNone(data[0]['signup_meta_data'])
+        # The first profile image by id, as without eager loading
+        self.assertTrue(data[0]['profile_image_icon'].endswith('/profile_image.webp'))
+
+
+class AddressSnapshotTest(TestCase):
+    def test_address_accessors_share_one_query(self):
+        user = PriyoMoneyUser.objects.get(pk=create_sample_user(0).pk)
+        with CaptureQueriesContext(connection) as captured:
+            self.assertTrue(user.has_legal_address())
+            self.assertTrue(user.is_address_complete())
+            self.assertEqual(user.get_country(), AllowedCountries.BD.value)
+            self.assertIsNone(user.billing_address)
+        self.assertEqual(len(captured.captured_queries), 1)
+
+    def test_snapshot_is_invalidated_on_address_save_and_delete(self):
+        user = PriyoMoneyUser.objects.get(pk=create_sample_user(0).pk)
+        self.assertIsNone(user.billing_address)
+
+        UserAddress.objects.create(user=user, address_type=AddressType.BILLING.value,
+                                   address_line_1='House 2, Road 2', postal_code='1212',
+                                   country=AllowedCountries.BD.value)
+        self.assertIsNotNone(user.billing_address)
+
+        user.shipping_address.delete()
+        self.assertIsNone(user.shipping_address)
+
+        user.sync_shipping_address()
+        self.assertEqual(user.shipping_address.address_line_1, user.legal_address.address_line_1)
+        self.assertEqual(user.legal_address.address_type, AddressType.LEGAL.value)
+
+
+class UserOnboardingProgressTest(TestCase):
+    def test_add_step_updates_progress_used_by_user_filter(self):
+        user = PriyoMoneyUser.objects.create(one_auth_uuid='uuid-0', email_address='john.doe0@example.com')
+        other_user = PriyoMoneyUser.objects.create(one_auth_uuid='uuid-1', email_address='john.doe1@example.com')
+        for step in [OnboardingSteps.LOG_IN.value, OnboardingSteps.MOBILE.value, OnboardingSteps.COUNTRY.value,
+                     OnboardingSteps.MOBILE.value]:
+            OnboardingStepManager(user).add_step(step, check_completion=False)
+        OnboardingStepManager(other_user).add_step(OnboardingSteps.COUNTRY.value, check_completion=False)
+
+        progress = UserOnboardingProgress.objects.get(user=user)
+        self.assertEqual(progress.last_step, OnboardingSteps.MOBILE.value)
+        self.assertEqual(progress.steps_done, 3)
+        self.assertIsNone(progress.step_durations[OnboardingSteps.LOG_IN.value])
+
+        filtered_users = UserFilter({'last_onboarding_step': OnboardingSteps.MOBILE.value},
+                                    queryset=PriyoMoneyUser.objects.all()).qs
+        self.assertEqual(list(filtered_users), [user])
+
+    def test_admin_created_step_updates_progress(self):
+        user = PriyoMoneyUser.objects.create(one_auth_uuid='uuid-0', email_address='john.doe0@example.com')
+        serializer = UserOnboardingStepAdminSerializer(data={'user': user.id, 'step': OnboardingSteps.MOBILE.value})
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+
+        progress = UserOnboardingProgress.objects.get(user=user)
+        self.assertEqual(progress.last_step, OnboardingSteps.MOBILE.value)
+        self.assertEqual(progress.steps_done, 1)
+
+    def test_first_recorded_step_counts_earlier_steps(self):
+        user = create_sample_user(0)  # has LOG_IN and COUNTRY steps but no progress yet
+        OnboardingStepManager(user).add_step(OnboardingSteps.MOBILE.value, check_completion=False)
+
+        progress = UserOnboardingProgress.objects.get(user=user)
+        self.assertEqual(progress.steps_done, 3)
+        self.assertEqual(set(progress.step_durations), {OnboardingSteps.LOG_IN.value, OnboardingSteps.COUNTRY.value,
+                                                        OnboardingSteps.MOBILE.value})
+
+    def test_rebuild_updates_existing_progress(self):
+        user = create_sample_user(0)
+        UserOnboardingProgress.objects.create(user=user)
+
+        UserOnboardingProgress.rebuild_for_users([user.id])
+        self.assertEqual(UserOnboardingProgress.objects.get(user=user).steps_done, 2)
+
+
+class BulkOnboardingStepReconcilerTest(TestCase):
+    def test_reconcile_chunk_adds_missing_steps(self):
+        users = [create_sample_user(index) for index in range(3)]
+        reconciler = BulkOnboardingStepReconciler(chunk_size=2)
+
+        last_id, users_count, _ = reconciler.reconcile_chunk(0)
+        self.assertEqual((last_id, users_count), (users[1].id, 2))
+        last_id, users_count, _ = reconciler.reconcile_chunk(last_id)
+        self.assertEqual((last_id, users_count), (users[2].id, 1))
+        self.assertEqual(reconciler.reconcile_chunk(last_id), (None, 0, 0))
+
+        mobile_step = UserOnboardingStep.objects.get(user=users[0], step=OnboardingSteps.MOBILE.value)
+        self.assertIsNotNone(mobile_step.time_taken)
+        self.assertEqual(UserOnboardingProgress.objects.filter(user__in=users).count(), 3)
+
+    def test_steps_added_concurrently_are_not_counted(self):
+        user = create_sample_user(0)
+        # LOG_IN got added through add_step after the chunk was loaded
+        steps = [UserOnboardingStep(user=user, step=OnboardingSteps.LOG_IN.value),
+                 UserOnboardingStep(user=user, step=OnboardingSteps.MOBILE.value)]
+        with mock.patch.object(BulkOnboardingStepReconciler, 'get_missing_steps', return_value=steps):
+            self.assertEqual(BulkOnboardingStepReconciler().reconcile_chunk(0), (user.id, 1, 1))
+
+
+class UserSearchDocumentTest(TestCase):
+    def test_search_document_follows_name_and_mobile_changes(self):
+        user = create_sample_user(7)
+        user.refresh_from_db()
+        self.assertIn('doe7', user.search_document)
+        self.assertIn('8801700000007', user.search_document)
+
+        user.last_name = 'Smith'
+        user.save(update_fields=['last_name'])
+        search = UserFilter({'search_text': 'SMI 01700000007'}, queryset=PriyoMoneyUser.objects.all()).qs
+        self.assertEqual(list(search), [user])
+
+
+@override_settings(PROFILE_APPROVAL_ADMIN_STEP=2)
+@mock.patch('core.tasks.drain_email_outbox.delay', mock.MagicMock())
+class BulkProfileApprovalTest(TestCase):
+    @mock.patch('core.tasks.run_person_transition_side_effects.delay')
+    def test_second_admin_completes_profiles_in_bulk(self, run_side_effects):
+        admin, other_admin = [PayAdmin.objects.create(username=f'admin{index}', email=f'admin{index}@example.com')
+                              for index in range(2)]
+        users = [create_sample_user(index) for index in range(3)]
+        PriyoMoneyUser.objects.filter(id__in=[user.id for user in users[:2]]).update(
+            profile_approval_status=ProfileApprovalStatus.AWAITING_ADMIN_APPROVAL.value)
+        user_ids = [user.id for user in users]
+
+        with self.captureOnCommitCallbacks(execute=True):
+            result = PersonManager.bulk_approve(user_ids, admin=admin)
+        self.assertEqual(result['awaiting_second_approval'], user_ids[:2])
+        self.assertEqual(list(result['skipped']), [users[2].id])
+        run_side_effects.assert_not_called()
+
+        self.assertEqual(list(PersonManager.bulk_approve(user_ids[:1], admin=admin)['skipped']), user_ids[:1])
+        with self.captureOnCommitCallbacks(execute=True):
+            result = PersonManager.bulk_approve(user_ids, admin=other_admin)
+        self.assertEqual(result['completed'], user_ids[:2])
+        run_side_effects.assert_called_once_with(ProfileApprovalStatus.PROFILE_COMPLETED.value,
+                                                 ProfileApprovalStatus.AWAITING_ADMIN_APPROVAL.value,
+                                                 ProfileApprovalStatus.PROFILE_COMPLETED.value, user_ids[:2])
+        self.assertEqual(PriyoMoneyUser.objects.filter(
+            profile_approval_status=ProfileApprovalStatus.PROFILE_COMPLETED.value).count(), 2)
+        self.assertEqual(EmailOutbox.objects.filter(user_id__in=user_ids[:2]).count(), 4)
+
+    def test_bulk_reject_blocks_review(self):
+        users = [create_sample_user(index) for index in range(2)]
+        PriyoMoneyUser.objects.filter(id=users[0].id).update(
+            profile_approval_status=ProfileApprovalStatus.AWAITING_ADMIN_APPROVAL.value)
+
+        result = PersonManager.bulk_reject([user.id for user in users])
+        self.assertEqual(result['rejected'], [users[0].id])
+        self.assertEqual(list(result['skipped']), [users[1].id])
+        users[0].refresh_from_db()
+        self.assertEqual(users[0].admin_review_status, AdminReviewStatus.BLOCKED.value)
+
+
+@mock.patch('core.tasks.drain_email_outbox.delay', mock.MagicMock())
+class EmailOutboxTest(TestCase):
+    @override_settings(EMAIL_OUTBOX_MAX_ATTEMPTS=2, EMAIL_OUTBOX_RETRY_DELAY=0)
+    @mock.patch('core.utility.email_outbox.EmailSender')
+    def test_failed_send_is_retried_then_given_up(self, email_sender):
+        user = create_sample_user(0)
+        email = OutboxEmailSender(user=user).send_user_email(context='full_access_given')
+        email_sender.return_value.send_user_email.side_effect = [Exception('timeout'), None]
+
+        self.assertEqual(drain_outbox(), 1)
+        email.refresh_from_db()
+        self.assertEqual((email.status, email.attempts), (EmailOutboxStatus.PENDING.value, 1))
+
+        self.assertEqual(drain_outbox(), 1)
+        email.refresh_from_db()
+        self.assertEqual((email.status, email.attempts), (EmailOutboxStatus.SENT.value, 2))
+        email_sender.assert_called_with(user=user)
+        email_sender.return_value.send_user_email.assert_called_with(context='full_access_given')
+        self.assertEqual(drain_outbox(), 0)
+
+    @mock.patch('core.utility.email_outbox.EmailSender')
+    def test_expired_claim_is_taken_over(self, email_sender):
+        user = create_sample_user(0)
+        email = OutboxEmailSender(user=user).send_user_email(context='full_access_given')
+        # A drain claimed it and died while sending
+        EmailOutbox.objects.filter(id=email.id).update(status=EmailOutboxStatus.SENDING.value, attempts=1)
+
+        self.assertEqual(drain_outbox(), 1)
+        email.refresh_from_db()
+        self.assertEqual((email.status, email.attempts), (EmailOutboxStatus.SENT.value, 2))
+
+
+@override_settings(ENABLE_SLAVE_DB='only_get')
+@mock.patch('priyomoney_client.routes.CustomRouter.is_master_only', mock.MagicMock(return_value=False))
+@mock.patch('priyomoney_client.routes.is_user_pinned_to_master', mock.MagicMock(return_value=False))
+@mock.patch('priyomoney_client.routes.replica_pool.choose', mock.MagicMock(return_value='priyo_pay_slave'))
+@mock.patch('middlewares.replica_routing.pin_user_to_master')
+class ReplicaRoutingTest(TestCase):
+    def call(self, method, write):
+        user = create_sample_user(0)
+
+        def view(request):
+            # What JWTAuth does for every client request
+            request_config.user_id = user.id
+            priyo_money_user, _ = PriyoMoneyUser.objects.get_or_create(one_auth_uuid=user.one_auth_uuid)
+            if write:
+                priyo_money_user.save(update_fields=['first_name'])
+            return HttpResponse(CustomRouter().db_for_read(PriyoMoneyUser))
+
+        request = getattr(RequestFactory(), method)('/user/')
+        return user, ReplicaRoutingMiddleware(view)(request).content.decode()
+
+    def test_authenticated_get_reads_from_replica(self, pin_user_to_master):
+        _, alias = self.call('get', write=False)
+        self.assertEqual(alias, 'priyo_pay_slave')
+        pin_user_to_master.assert_not_called()
+
+    def test_reads_after_a_write_stay_on_master(self, pin_user_to_master):
+        with override_settings(ENABLE_SLAVE_DB='always'):
+            user, alias = self.call('patch', write=True)
+        self.assertEqual(alias, 'default')
+        pin_user_to_master.assert_called_once_with(user.id)
+
+
+@override_settings(SLAVE_DB_WEIGHTS={'priyo_pay_slave': 1}, REPLICA_MAX_LAG_SECONDS=2)
+class ReplicaPoolTest(TestCase):
+    def test_replica_is_skipped_until_sampled_and_ejected_only_when_sampling_fails(self):
+        pool = ReplicaPool(ReplicaLagMonitor())
+        pool._refresher_pid = os.getpid()  # refreshed by hand below
+        self.assertIsNone(pool.choose())
+        self.assertFalse(pool.is_ejected('priyo_pay_slave'))
+
+        with mock.patch.object(ReplicaLagMonitor, 'lag_query', 'SELECT 0.5'), \
+                mock.patch('priyomoney_client.routes.connections', {'priyo_pay_slave': connection}):
+            pool.refresh()
+        self.assertEqual(pool.choose(), 'priyo_pay_slave')
+
+        with mock.patch.object(pool.lag_monitor, 'sample', return_value=None):
+            pool.refresh()
+        self.assertTrue(pool.is_ejected('priyo_pay_slave'))
+        self.assertIsNone(pool.choose())
+
+
+def make_response(status_code, headers=None):
+    response = requests.Response()
+    response.status_code = status_code
+    response.headers.update(headers or {})
+    return response
+
+
+@mock.patch('priyomoney_client.http_transport.time.sleep')
+class PooledHttpTransportTest(TestCase):
+    def test_too_many_requests_pauses_the_rate_limit_and_retries_after_retry_after(self, sleep):
+        rate_limiter = mock.MagicMock()
+        transport = PooledHttpTransport('test', rate_limiter=rate_limiter)
+        responses = [make_response(429, {'Retry-After': '2'}), make_response(200)]
+        with mock.patch.object(transport.session, 'request', side_effect=responses) as request:
+            response = transport.request('post', 'https://api.example.com/v0/documents')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(request.call_count, 2)  # not idempotent, but the service did not process the first call
+        self.assertEqual(rate_limiter.acquire.call_count, 2)
+        rate_limiter.pause.assert_called_once_with(2.0)
+        sleep.assert_called_once_with(2.0)
+
+    def test_retry_after_is_capped_and_the_last_429_returned(self, sleep):
+        rate_limiter = mock.MagicMock()
+        transport = PooledHttpTransport('test', max_retries=1, rate_limiter=rate_limiter)
+        responses = [make_response(429, {'Retry-After': '3600'}), make_response(429, {'Retry-After': '3600'})]
+        with mock.patch.object(transport.session, 'request', side_effect=responses):
+            response = transport.request('get', 'https://api.example.com/v0/persons/42')
+
+        self.assertEqual(response.status_code, 429)
+        rate_limiter.pause.assert_called_with(transport.max_retry_after)
+        sleep.assert_called_once_with(transport.max_retry_after)
+
+
+class TaskPriorityTest(TestCase):
+    def test_eager_task_takes_tokens_in_background_and_restores_the_caller_priority(self):
+        from core.tasks import flush_user_activity
+        priorities = []
+        with mock.patch('core.utility.activity.user_activity_buffer.flush',
+                        side_effect=lambda: priorities.append(call_priority.value) or 0):
+            flush_user_activity.delay()
+        self.assertEqual(priorities, [BACKGROUND])
+        self.assertEqual(call_priority.value, INTERACTIVE)
+
+
+class RedisTokenBucketTest(TestCase):
+    def setUp(self):
+        # Refills one token every 100 seconds, so the bucket only holds what the test leaves in it
+        self.bucket = RedisTokenBucket('test', rate=0.01, burst=10, background_reserve=0.3,
+                                       timeouts={INTERACTIVE: 1, BACKGROUND: 1})
+        get_redis_connection('default').delete(self.bucket.tokens_key, self.bucket.paused_key)
+        self.addCleanup(get_redis_connection('default').delete, self.bucket.tokens_key, self.bucket.paused_key)
+
+    def test_background_calls_leave_the_reserve_to_interactive_ones(self):
+        with priority(BACKGROUND):
+            for _ in range(7):
+                self.bucket.acquire()
+            with self.assertRaises(RateLimitTimeout):
+                self.bucket.acquire()
+        for _ in range(3):
+            self.bucket.acquire()
+        with self.assertRaises(RateLimitTimeout):
+            self.bucket.acquire()
+
+    @mock.patch('priyomoney_client.rate_limit.time.sleep')
+    def test_paused_bucket_times_out_without_a_token(self, sleep):
+        self.bucket.pause(30)
+        with self.assertRaises(RateLimitTimeout):
+            self.bucket.acquire(INTERACTIVE)
+        sleep.assert_not_called()
+        self.assertEqual(float(get_redis_connection('default').hget(self.bucket.tokens_key, 'tokens') or 10), 10)
+
+
+class SingleFlightCacheTest(TestCase):
+    def make_cache(self, timeout):
+        single_flight_cache = SingleFlightCache('test', 'test-single-flight:', timeout=timeout, wait_timeout=1)
+        keys = [make_key('key') for make_key in (single_flight_cache.make_key, single_flight_cache.make_lock_key,
+                                                 single_flight_cache.make_result_key,
+                                                 single_flight_cache.make_deleted_key)]
+        self.addCleanup(cache.delete_many, keys)
+        return single_flight_cache
+
+    def test_waiter_gets_the_result_even_when_values_are_not_cached(self):
+        single_flight_cache = self.make_cache(timeout=0)
+        # Another process holds the lock and has just filled the key
+        cache.add(single_flight_cache.make_lock_key('key'), 1)
+        cache.set(single_flight_cache.make_result_key('key'), {'value': 'profile', 'expires_at': None})
+        fill = mock.MagicMock()
+
+        self.assertEqual(single_flight_cache.fill_across_processes('key', fill), ('profile', False))
+        fill.assert_not_called()
+
+    def test_fill_finishing_after_a_delete_is_not_cached(self):
+        single_flight_cache = self.make_cache(timeout=60)
+
+        def fill():
+            single_flight_cache.delete('key')  # e.g. logged out while the profile was being fetched
+            return 'profile'
+
+        self.assertEqual(single_flight_cache.get('key', fill), ('profile', False))
+        self.assertIsNone(single_flight_cache.read(single_flight_cache.make_key('key')))
+
+
+class LabelIndexSearchTest(TestCase):
+    def setUp(self):
+        for index in range(5):
+            create_sample_user(index)
+        for name, value in [('key_prefix', 'test-typeahead'), ('candidate_chunk_size', 2)]:
+            patcher = mock.patch.object(user_label_index, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(lambda: user_label_index.redis.delete(
+            *[user_label_index.key(suffix) for suffix in ('choices', 'terms', 'labels', 'ready', 'pending')]))
+        user_label_index.rebuild()
+
+    def test_short_prefix_ranks_every_match(self):
+        choices, is_truncated = user_label_index.search('j', limit=10)
+        self.assertFalse(is_truncated)
+        self.assertEqual([choice['label'].split(' - ')[0] for choice in choices],
+                         [f'John Doe{index}' for index in range(5)])
+
+    def test_prefix_matching_too_many_choices_is_truncated(self):
+        with mock.patch.object(user_label_index, 'max_candidates', 3):
+            choices, is_truncated = user_label_index.search('j', limit=10)
+        self.assertTrue(is_truncated)
+        self.assertEqual(len(choices), 3)
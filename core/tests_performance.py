@@ -0,0 +1,213 @@
+"""
+Query count, wall time and peak memory budgets of the main admin and client read endpoints.
+
+Endpoints run against a synthetic dataset with every outgoing HTTP call (Synctera, one auth, ...) answered by a
+canned offline response and bucket URL signing stubbed, so the suite needs no network. Each endpoint is called once
+to warm up, once to count queries and time it and once under tracemalloc for its peak memory.
+
+A measurement above its budget in core/performance_budgets.json fails the test. Query and external call counts get no
+slack, wall time and peak memory get PERFORMANCE_BUDGET_TOLERANCE (20% by default) on top
+of the headroom already in the budget. PERFORMANCE_BUDGET_TIME_FACTOR scales the wall time budgets on machines slower
+than the one they were measured on. After an intended change, run against Postgres with UPDATE_PERFORMANCE_BUDGETS=true
+to write the new measurements (with headroom for time and memory) to the budgets file.
+"""
+import json
+import os
+import time
+import tracemalloc
+from datetime import date
+from pathlib import Path
+from unittest import mock
+
+import requests
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from rest_framework import status
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from core.enums import ServiceList, NoteType, OnboardingSteps
+from core.models import PriyoMoneyUser, UserIdentification, Note
+from core.tests import create_sample_user
+from core.views import UserOnboardingFlowView
+from core.viewsets import PriyoMoneyUserViewSet, NoteViewSet
+from file_uploader.enums import DocumentType, RelatedResourceType
+from file_uploader.models import Documents
+from file_uploader.viewsets import FileUploaderViewSet
+from pay_admin.models import PayAdmin
+from students.models import StudentPrimaryInfo
+from students.viewsets import StudentUserViewSet
+from utilities.testutils import skip_if_sqlite
+from verifications.enums import IDType
+
+BUDGETS_FILE = Path(__file__).with_name('performance_budgets.json')
+UPDATE_BUDGETS = os.getenv('UPDATE_PERFORMANCE_BUDGETS', 'false').lower() == 'true'
+TIME_FACTOR = float(os.getenv('PERFORMANCE_BUDGET_TIME_FACTOR', '1'))
+TOLERANCE = float(os.getenv('PERFORMANCE_BUDGET_TOLERANCE', '1.2'))
+
+USER_COUNT = 40
+STUDENT_COUNT = 15
+DOCUMENTS_PER_USER = 3
+NOTES_PER_USER = 2
+
+
+def seed_dataset(admin):
+    user_type = ContentType.objects.get_for_model(PriyoMoneyUser)
+    users = []
+    for index in range(USER_COUNT):
+        user = create_sample_user(index)
+        UserIdentification.objects.create(user=user, identification_class=IDType.choices()[0][0],
+                                          identification_number=f'ID{index:06d}')
+        documents = [Documents.objects.create(
+            uploader=user,
+            profile=user.profile,
+            doc_type=DocumentType.IDENTITY_DOCUMENTATION.value,
+            doc_name=f'Document {number}',
+            related_resource_type=RelatedResourceType.CUSTOMER.value,
+            uploaded_file_name=f'{user.profile.profile_type}/p{user.profile.id}/document-{number}.pdf',
+        ) for number in range(DOCUMENTS_PER_USER)]
+        for number in range(NOTES_PER_USER):
+            Note.objects.create(item_type=user_type, item_id=user.id, note=f'Note {number} on user {index}',
+                                created_by=admin, note_type=NoteType.ADMIN.value,
+                                document=documents[number] if number == 0 else None)
+        if index < STUDENT_COUNT:
+            StudentPrimaryInfo.objects.create(user=user, passport_number=f'P{index:07d}',
+                                              passport_issue_date=date(2020, 1, 1),
+                                              passport_expiry_date=date(2030, 1, 1))
+        users.append(user)
+    return users
+
+
+def offline_response(adapter, request, *args, **kwargs):
+    """Answers every outgoing HTTP call with an empty 200 JSON response"""
+    response = requests.Response()
+    response.status_code = status.HTTP_200_OK
+    response._content = b'{}'
+    response.headers['Content-Type'] = 'application/json'
+    response.url = request.url
+    response.request = request
+    return response
+
+
+def measure(call):
+    """Returns the response and its query count, wall time (ms) and peak memory (KB) once warmed up"""
+    call()
+    with CaptureQueriesContext(connection) as captured:
+        started_at = time.perf_counter()
+        response = call()
+        wall_time_ms = (time.perf_counter() - started_at) * 1000
+
+    tracemalloc.start()
+    try:
+        call()
+        peak_memory_kb = tracemalloc.get_traced_memory()[1] / 1024
+    finally:
+        tracemalloc.stop()
+    return response, {
+        'queries': len(captured.captured_queries),
+        'wall_time_ms': round(wall_time_ms, 1),
+        'peak_memory_kb': round(peak_memory_kb),
+    }
+
+
+@skip_if_sqlite
+@mock.patch('requests.adapters.HTTPAdapter.send', autospec=True, side_effect=offline_response)
+@mock.patch('django.core.files.storage.default_storage.exists', mock.MagicMock(return_value=True))
+@mock.patch('file_uploader.bucket.google_bucket_file_url', mock.MagicMock(return_value='https://bucket/doc'))
+class EndpointPerformanceBudgetTest(TestCase):
+    measurements = {}
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = PayAdmin.objects.create(username='benchmark-admin', email='benchmark-admin@example.com')
+        cls.users = seed_dataset(cls.admin)
+        cls.factory = APIRequestFactory()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        if UPDATE_BUDGETS and cls.measurements:
+            budgets = json.loads(BUDGETS_FILE.read_text()) if BUDGETS_FILE.exists() else {}
+            for name, measured in cls.measurements.items():
+                budgets[name] = {
+                    'queries': measured['queries'],
+                    'wall_time_ms': round(max(measured['wall_time_ms'] * 2, 50)),
+                    'peak_memory_kb': round(measured['peak_memory_kb'] * 1.5),
+                    'external_calls': measured['external_calls'],
+                }
+            BUDGETS_FILE.write_text(json.dumps(dict(sorted(budgets.items())), indent=2) + '\n')
+
+    def get(self, view, path, service=ServiceList.ADMIN.value, user=None, **kwargs):
+        def call():
+            request = self.factory.get(path)
+            request.service = service
+            force_authenticate(request, user=user or self.admin)
+            return view(request, **kwargs).render()
+        return call
+
+    def assert_within_budget(self, name, call, http_send):
+        budgets = json.loads(BUDGETS_FILE.read_text())
+        http_send.reset_mock()
+        response, measured = measure(call)
+        measured['external_calls'] = http_send.call_count
+        self.measurements[name] = measured
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK, name)
+        if UPDATE_BUDGETS:
+            return
+        self.assertIn(name, budgets, f'{name} has no budget, run with UPDATE_PERFORMANCE_BUDGETS=true to add it')
+        budget = budgets[name]
+        self.assertLessEqual(measured['queries'], budget['queries'], f'{name} queries: {measured}')
+        self.assertLessEqual(measured['external_calls'], budget['external_calls'], f'{name} external calls: {measured}')
+
+        self.assertLessEqual(measured['wall_time_ms'], budget['wall_time_ms'] * TIME_FACTOR * TOLERANCE,
+                             f'{name} wall time: {measured}')
+        self.assertLessEqual(measured['peak_memory_kb'], budget['peak_memory_kb'] * TOLERANCE,
+                             f'{name} peak memory: {measured}')
+
+    def test_user_endpoints(self, http_send):
+        user = self.users[0]
+        self.assert_within_budget('user-list', self.get(
+            PriyoMoneyUserViewSet.as_view({'get': 'list'}), '/user/'), http_send)
+        self.assert_within_budget('user-detail', self.get(
+            PriyoMoneyUserViewSet.as_view({'get': 'retrieve'}), f'/user/{user.id}/', pk=user.id), http_send)
+        self.assert_within_budget('user-detail-client', self.get(
+            PriyoMoneyUserViewSet.as_view({'get': 'retrieve'}), f'/user/{user.id}/', service=ServiceList.CLIENT.value,
+            user=user, pk=user.id), http_send)
+
+    def test_student_user_endpoints(self, http_send):
+        student = self.users[0]
+        self.assert_within_budget('student-user-list', self.get(
+            StudentUserViewSet.as_view({'get': 'list'}), '/student-users/'), http_send)
+        self.assert_within_budget('student-user-detail', self.get(
+            StudentUserViewSet.as_view({'get': 'retrieve'}), f'/student-users/{student.id}/', pk=student.id),
+            http_send)
+
+    def test_document_endpoints(self, http_send):
+        user = self.users[0]
+        document = Documents.objects.filter(profile=user.profile).first()
+        self.assert_within_budget('file-upload-list', self.get(
+            FileUploaderViewSet.as_view({'get': 'list'}), '/file-upload/'), http_send)
+        self.assert_within_budget('file-upload-list-client', self.get(
+            FileUploaderViewSet.as_view({'get': 'list'}), '/file-upload/', service=ServiceList.CLIENT.value,
+            user=user), http_send)
+        self.assert_within_budget('file-upload-detail', self.get(
+            FileUploaderViewSet.as_view({'get': 'retrieve'}), f'/file-upload/{document.id}/', pk=document.id),
+            http_send)
+
+    def test_note_endpoints(self, http_send):
+        note = Note.objects.filter(document__isnull=False).first()
+        self.assert_within_budget('note-list', self.get(
+            NoteViewSet.as_view({'get': 'list'}), '/note/'), http_send)
+        self.assert_within_budget('note-detail', self.get(
+            NoteViewSet.as_view({'get': 'retrieve'}), f'/note/{note.id}/', pk=note.id), http_send)
+
+    def test_onboarding_flow_endpoints(self, http_send):
+        user = self.users[0]
+        call = self.get(UserOnboardingFlowView.as_view(), f'/user-onboarding-flow/{user.id}/', user_id=user.id)
+        self.assert_within_budget('user-onboarding-flow', call, http_send)
+        self.assertIn(OnboardingSteps.LOG_IN.value, [step['step'] for step in call().data if step['finished']])
+        self.assert_within_budget('user-onboarding-flow-client', self.get(
+            UserOnboardingFlowView.as_view(), f'/user-onboarding-flow/{user.id}/', service=ServiceList.CLIENT.value,
+            user=user, user_id=user.id), http_send)
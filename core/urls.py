@@ -3,7 +3,8 @@ from rest_framework.routers import SimpleRouter
 from core.views import APILogFilterSearchChoices, UserIdentificationView, SendTestEmailView, \
     APILogUserSearchChoices, UserMaskedMobileEmail, PersonVerifyView, BDManualKYCView, UserOnboardingFlowView, \
     SyncKYCView, PlaidAuthorizationRequestViewSet, BusinessSearchChoices, TariffSearchChoices, UserFullAccessView, \
-    IncomingPlaidConnectionViewSet
+    IncomingPlaidConnectionViewSet, DatabaseRoutingStatsView, RequestProfileStatsView, \
+    BulkProfileApprovalView
 from core.viewsets import PriyoMoneyUserViewSet, UserMobileNumberViewSet, UserAddressViewSet, TerminateUserView, \
     SocureIdvViewSet, UserAdditionalInfoViewSet, UserBasicInfoViewSet, UserOnboardingStepViewSet, \
     UserSMSLogViewSet, UserStatusUpdateViewSet, UserLocationViewSet, UserIdentityNumberViewSet, \
@@ -52,5 +53,8 @@ urlpatterns = [
     path('user-onboarding-flow/<int:user_id>/', UserOnboardingFlowView.as_view()),
     path('send-test-email/', SendTestEmailView.as_view()),
     path('user-full-access/', UserFullAccessView.as_view()),
+    path('user-bulk-approval/', BulkProfileApprovalView.as_view()),
     path('note-count/', NoteCountView.as_view()),
+    path('db-routing-stats/', DatabaseRoutingStatsView.as_view()),
+    path('request-profile-stats/', RequestProfileStatsView.as_view()),
 ]
@@ -0,0 +1,81 @@
+import logging
+from datetime import datetime, timezone as dt_timezone
+
+from django.utils import timezone
+from django_redis import get_redis_connection
+
+from core.models import PriyoMoneyUser
+
+logger = logging.getLogger(__name__)
+
+
+class UserActivityBuffer:
+    """
+    Write-behind buffer for PriyoMoneyUser.last_active_at. Activity is recorded in a Redis sorted set
+    (user id -> unix time) and flushed to the database by the flush_user_activity task, so a database value is at
+    most LAST_ACTIVE_AT_FLUSH_INTERVAL seconds behind. Use merge_into to read up to date values.
+    """
+    key = 'priyo-pay:user-last-active'
+    flushing_key = 'priyo-pay:user-last-active:flushing'
+
+    @property
+    def redis(self):
+        return get_redis_connection('default')
+
+    def record(self, user_id, active_at=None):
+        active_at = active_at or timezone.now()
+        self.redis.zadd(self.key, {user_id: active_at.timestamp()})
+
+    def get_buffered(self, user_ids):
+        """Returns user id -> buffered last activity, including activity being flushed at the moment"""
+        if not user_ids:
+            return {}
+        pipeline = self.redis.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipeline.zscore(self.key, user_id)
+            pipeline.zscore(self.flushing_key, user_id)
+        scores = pipeline.execute()
+
+        buffered = {}
+        for index, user_id in enumerate(user_ids):
+            timestamps = [score for score in scores[index * 2:index * 2 + 2] if score is not None]
+            if timestamps:
+                buffered[user_id] = datetime.fromtimestamp(max(timestamps), tz=dt_timezone.utc)
+        return buffered
+
+    def merge_into(self, users):
+        """Sets last_active_at of the given users to the latest of their database and buffered value"""
+        buffered = self.get_buffered([user.id for user in users])
+        for user in users:
+            buffered_at = buffered.get(user.id)
+            if buffered_at and (user.last_active_at is None or buffered_at > user.last_active_at):
+                user.last_active_at = buffered_at
+
+    def flush(self, batch_size=1000):
+        """
+        Moves the buffer aside and writes it with bulk_update. A buffer left aside by a failed flush is written
+        first, activity recorded meanwhile goes to a fresh buffer.
+        """
+        redis = self.redis
+        if not redis.exists(self.flushing_key):
+            if not redis.exists(self.key):
+                return 0
+            redis.rename(self.key, self.flushing_key)
+
+        flushed = 0
+        start = 0
+        while True:
+            entries = redis.zrange(self.flushing_key, start, start + batch_size - 1, withscores=True)
+            if not entries:
+                break
+            users = [PriyoMoneyUser(id=int(user_id), last_active_at=datetime.fromtimestamp(score, tz=dt_timezone.utc))
+                     for user_id, score in entries]
+            PriyoMoneyUser.objects.bulk_update(users, ['last_active_at'])
+            flushed += len(users)
+            start += batch_size
+
+        redis.delete(self.flushing_key)
+        return flushed
+
+
+user_activity_buffer = UserActivityBuffer()
@@ -7,6 +7,7 @@ from rest_framework import status
 
 from accounts.enums import EntityType
 from api_clients.synctera_client import SyncteraClient
+from priyomoney_client.synctera_transport import synctera_transport
 from common.views import CommonTaskManager
 from core.models import PriyoMoneyUser
 from disclosure.enums import DisclosureProfile
@@ -28,7 +29,7 @@ class PersonDisclosureManager(CommonTaskManager):
         disclosure_date = datetime.now(pytz.timezone(settings.TIME_ZONE)).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
         idempotent_key = f'IDM{disclosure.id}_{uuid.uuid4()}'
 
-        synctera_client = SyncteraClient()
+        synctera_client = SyncteraClient(transport=synctera_transport)
         acknowledge_response, status_code = synctera_client.disclosure_acknowledge(
             business_id=None,
             person_id=person.synctera_user_id,
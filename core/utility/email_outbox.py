@@ -0,0 +1,162 @@
+import logging
+import random
+import threading
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from common.email import EmailSender
+from core.enums import EmailOutboxStatus
+from core.models import EmailOutbox
+
+logger = logging.getLogger(__name__)
+
+
+# Request Scoped Variables
+class OutboxBatch(threading.local):
+    emails = None  # emails queued inside email_outbox_batch, inserted when it exits
+
+
+outbox_batch = OutboxBatch()
+
+
+def schedule_drain():
+    def drain():
+        from core.tasks import drain_email_outbox
+        try:
+            drain_email_outbox.delay()
+        except Exception as ex:
+            # The periodic drain sends them a little later
+            logger.warning(f'Could not schedule the email outbox drain: {ex}')
+
+    transaction.on_commit(drain, using=settings.MASTER_DB_KEY)
+
+
+def save_emails(emails):
+    if not emails:
+        return
+    EmailOutbox.objects.using(settings.MASTER_DB_KEY).bulk_create(emails)
+    schedule_drain()
+
+
+@contextmanager
+def email_outbox_batch():
+    """Emails queued inside the block are inserted in one query when it exits without an error"""
+    if outbox_batch.emails is not None:
+        yield
+        return
+    outbox_batch.emails = []
+    try:
+        yield
+        emails = outbox_batch.emails
+    finally:
+        outbox_batch.emails = None
+    save_emails(emails)
+
+
+class OutboxEmailSender:
+    """
+    EmailSender's interface for emails about a state change: the email is written to EmailOutbox (in the caller's
+    transaction, if any) and drain_email_outbox sends it after commit, so the request does no email work.
+    """
+
+    def __init__(self, user=None, admin=None, kwargs=None):
+        self.user = user
+        self.admin = admin
+        self.kwargs = kwargs
+
+    def queue(self, method, *args, **kwargs):
+        email = EmailOutbox(method=method, args=list(args), kwargs=kwargs, user=self.user, admin=self.admin,
+                            sender_kwargs=self.kwargs)
+        if outbox_batch.emails is not None:
+            outbox_batch.emails.append(email)
+        else:
+            save_emails([email])
+        return email
+
+    def send_kyc_status_change_email(self, previous_approval_status, approval_status):
+        return self.queue('send_kyc_status_change_email', previous_approval_status, approval_status)
+
+    def send_user_email(self, context, **kwargs):
+        return self.queue('send_user_email', context=context, **kwargs)
+
+    def send_admin_email(self, context, **kwargs):
+        return self.queue('send_admin_email', context=context, **kwargs)
+
+
+def get_retry_delay(attempts):
+    """Exponential backoff from EMAIL_OUTBOX_RETRY_DELAY seconds, capped and jittered"""
+    delay = min(settings.EMAIL_OUTBOX_RETRY_DELAY * 2 ** (attempts - 1), settings.EMAIL_OUTBOX_MAX_RETRY_DELAY)
+    return timedelta(seconds=random.uniform(delay / 2, delay))
+
+
+def send_outbox_email(email):
+    sender_kwargs = {'user': email.user, 'admin': email.admin, 'kwargs': email.sender_kwargs}
+    sender = EmailSender(**{key: value for key, value in sender_kwargs.items() if value is not None})
+    getattr(sender, email.method)(*email.args, **email.kwargs)
+
+
+def claim_batch(batch_size):
+    """
+    Marks a batch of due emails SENDING in a short transaction. Rows are locked with SKIP LOCKED, so several workers
+    claim side by side without taking the same email. A claim expires after EMAIL_OUTBOX_CLAIM_TIMEOUT, the emails of
+    a drain that died while sending are picked up again after that.
+    """
+    now = timezone.now()
+    outbox = EmailOutbox.objects.using(settings.MASTER_DB_KEY)
+    with transaction.atomic(using=settings.MASTER_DB_KEY):
+        email_ids = list(outbox.select_for_update(skip_locked=True)
+                         .filter(status__in=[EmailOutboxStatus.PENDING.value, EmailOutboxStatus.SENDING.value],
+                                 next_attempt_at__lte=now)
+                         .order_by('next_attempt_at').values_list('id', flat=True)[:batch_size])
+        outbox.filter(id__in=email_ids).update(
+            status=EmailOutboxStatus.SENDING.value, attempts=F('attempts') + 1,
+            next_attempt_at=now + timedelta(seconds=settings.EMAIL_OUTBOX_CLAIM_TIMEOUT))
+    return list(outbox.select_related('user', 'admin').filter(id__in=email_ids).order_by('next_attempt_at'))
+
+
+def record_result(email, error=None):
+    """Records the outcome of one claimed email, unless its claim expired and another drain took it over"""
+    if error is None:
+        changes = {'status': EmailOutboxStatus.SENT.value, 'sent_at': timezone.now()}
+    elif email.attempts >= settings.EMAIL_OUTBOX_MAX_ATTEMPTS:
+        changes = {'status': EmailOutboxStatus.FAILED.value, 'last_error': str(error)}
+        logger.error(f'Giving up on {email.method} email {email.id} after {email.attempts} attempts: {error}')
+    else:
+        changes = {'status': EmailOutboxStatus.PENDING.value, 'last_error': str(error),
+                   'next_attempt_at': timezone.now() + get_retry_delay(email.attempts)}
+        logger.warning(f'Could not send {email.method} email {email.id}, retrying: {error}')
+    EmailOutbox.objects.using(settings.MASTER_DB_KEY).filter(
+        id=email.id, status=EmailOutboxStatus.SENDING.value, attempts=email.attempts).update(**changes)
+
+
+def drain_batch(batch_size):
+    """
+    Sends one batch of due emails. No transaction is held while sending, each result is written on its own.
+    Returns how many emails were processed.
+    """
+    emails = claim_batch(batch_size)
+    for email in emails:
+        try:
+            send_outbox_email(email)
+        except Exception as ex:
+            record_result(email, error=ex)
+        else:
+            record_result(email)
+    return len(emails)
+
+
+def drain_outbox(batch_size=None, max_batches=None):
+    batch_size = batch_size or settings.EMAIL_OUTBOX_BATCH_SIZE
+    max_batches = max_batches or settings.EMAIL_OUTBOX_MAX_BATCHES
+    processed = 0
+    for _ in range(max_batches):
+        count = drain_batch(batch_size)
+        processed += count
+        if count < batch_size:
+            break
+    return processed
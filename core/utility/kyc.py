@@ -2,7 +2,8 @@ from rest_framework import status
 
 from accounts.enums import EntityType
 from api_clients.synctera_client import SyncteraClient
-from common.email import EmailSender
+from priyomoney_client.synctera_transport import synctera_transport
+from core.utility.email_outbox import OutboxEmailSender
 from common.views import CommonTaskManager
 from core.enums import ProfileApprovalStatus
 from core.models import PriyoMoneyUser
@@ -17,7 +18,7 @@ class KycCreationManager(CommonTaskManager):
     def perform_third_party_api_call(cls, validated_data, idempotent_key, **kwargs):
         person_id = validated_data.get('user_id')
         person = PriyoMoneyUser.objects.get(id=person_id)
-        synctera_client = SyncteraClient()
+        synctera_client = SyncteraClient(transport=synctera_transport)
 
         return synctera_client.create_kyc_without_document(person, idempotent_key)
 
@@ -25,7 +26,7 @@ class KycCreationManager(CommonTaskManager):
     def get_verification_status(synctera_response, synctera_user_id):
         verification_status = synctera_response.get('verification_status')
         if not verification_status:
-            synctera_client = SyncteraClient()
+            synctera_client = SyncteraClient(transport=synctera_transport)
             synctera_response, status_code = synctera_client.get_person(synctera_user_id)
             if status.is_success(status_code):
                 verification_status = synctera_response.get('verification_status')
@@ -47,6 +48,6 @@ class KycCreationManager(CommonTaskManager):
                 user.profile_approval_status = approval_status
                 user.save(update_fields=['profile_approval_status'])
 
-        EmailSender(user=person).send_kyc_status_change_email(previous_approval_status, approval_status)
+            OutboxEmailSender(user=person).send_kyc_status_change_email(previous_approval_status, approval_status)
 
         return PriyoMoneyUserSerializer(instance=person).data
@@ -1,5 +1,8 @@
+from django.db import transaction
+from django.utils import timezone
+
 from core.enums import OnboardingSteps, ProfileApprovalStatus
-from core.models import PriyoMoneyUser, UserOnboardingStep
+from core.models import PriyoMoneyUser, UserOnboardingStep, UserOnboardingProgress
 from file_uploader.enums import DocumentType
 
 
@@ -28,11 +31,11 @@ class OnboardingStepManager:
         elif step == OnboardingSteps.PROFILE_PICTURE.value:
             return self.user.has_document(DocumentType.PROFILE_IMAGE.value)
         elif step == OnboardingSteps.DOCUMENTS.value:
-            return self.user.profile.documents.exists() and self.user.has_necessary_documents()
+            return self.user.has_any_document() and self.user.has_necessary_documents()
         elif step == OnboardingSteps.ADDITIONAL_INFO.value:
             return self.user.has_additional_info() and self.user.bd_user_additional_info.is_complete()
         elif step == OnboardingSteps.SUBSCRIPTION.value:
-            return self.user.get_active_subscriptions().exists()
+            return self.user.has_active_subscription()
         elif step == OnboardingSteps.PERSONA_VERIFICATION.value:
             return self.user.is_persona_verified()
         elif step == OnboardingSteps.ADMIN_APPROVAL.value:
@@ -56,7 +59,11 @@ class OnboardingStepManager:
     def add_step(self, step: OnboardingSteps, check_completion=True):
         if check_completion and not self.verify_step_completed(step):
             return None, False
-        return UserOnboardingStep.objects.get_or_create(user=self.user, step=step)
+        with transaction.atomic():
+            onboarding_step, created = UserOnboardingStep.objects.get_or_create(user=self.user, step=step)
+            if created:
+                UserOnboardingProgress.record_step_for_user(onboarding_step)
+        return onboarding_step, created
 
     def check_and_add_all_steps(self):
         for step in OnboardingSteps.values():
@@ -79,9 +86,72 @@ class OnboardingStepManager:
         ]
 
     def get_last_finished_step(self):
-        finished_steps = self.user.onboarding_steps.all().values_list('step', flat=True)
+        # iterating over .all() keeps the prefetched onboarding_steps cache usable for list serialization
+        finished_steps = {onboarding_step.step for onboarding_step in self.user.onboarding_steps.all()}
         expected_steps = OnboardingSteps.get_expected_onboarding_flow(self.user)
         for step in expected_steps[::-1]:
             if step in finished_steps:
                 return step
         return None
+
+
+class BulkOnboardingStepReconciler:
+    """
+    Adds the missing onboarding steps of many users at once. Users are loaded in chunks together with every relation
+    verify_step_completed looks at, so reconciling a chunk takes a fixed number of queries regardless of its size.
+    """
+
+    def __init__(self, chunk_size=500):
+        self.chunk_size = chunk_size
+
+    @staticmethod
+    def get_users_queryset():
+        return PriyoMoneyUser.objects.select_related(
+            'profile', 'user_mobile_number', 'bd_user_additional_info', 'referral_code_usage__referral_code',
+        ).prefetch_related(
+            'user_addresses', 'userlocation_set', 'profile__documents', 'subscriptions', 'persona_verifications',
+            'onboarding_steps',
+        )
+
+    @staticmethod
+    def get_missing_steps(user, now):
+        manager = OnboardingStepManager(user)
+        done_steps = list(user.onboarding_steps.all())
+        done_step_names = {onboarding_step.step for onboarding_step in done_steps}
+        last_step_time = max((onboarding_step.created_at for onboarding_step in done_steps), default=None)
+
+        missing_steps = []
+        for step in OnboardingSteps.values():
+            if step in done_step_names or not manager.verify_step_completed(step):
+                continue
+            # Same time_taken as adding the steps one by one through UserOnboardingStep.save
+            missing_steps.append(UserOnboardingStep(user=user, step=step,
+                                                    time_taken=now - last_step_time if last_step_time else None))
+            last_step_time = now
+        return missing_steps
+
+    def reconcile_chunk(self, after_id):
+        """
+        Reconciles the next chunk of users with id greater than after_id.
+        Returns the last user id of the chunk (None when there are no users left), the number of users and the number
+        of created steps.
+        """
+        users = list(self.get_users_queryset().filter(id__gt=after_id).order_by('id')[:self.chunk_size])
+        if not users:
+            return None, 0, 0
+
+        now = timezone.now()
+        missing_steps = [step for user in users for step in self.get_missing_steps(user, now)]
+        if not missing_steps:
+            return users[-1].id, len(users), 0
+
+        user_ids = {step.user_id for step in missing_steps}
+        with transaction.atomic():
+            steps = UserOnboardingStep.objects.filter(user_id__in=user_ids)
+            steps_before = steps.count()
+            # ignore_conflicts keeps the chunk going if a step got added concurrently through add_step, the skipped
+            # rows are not counted as created
+            UserOnboardingStep.objects.bulk_create(missing_steps, ignore_conflicts=True)
+            created_count = steps.count() - steps_before
+            UserOnboardingProgress.rebuild_for_users(user_ids)
+        return users[-1].id, len(users), created_count
@@ -4,6 +4,7 @@ from django.core.cache import cache
 
 from accounts.enums import EntityType
 from api_clients.synctera_client import SyncteraClient
+from priyomoney_client.synctera_transport import synctera_transport
 from core.enums import ProfileApprovalStatus
 from core.models import PriyoMoneyUser, UserIdentification
 from error_handling.error_list import CUSTOM_ERROR_LIST
@@ -30,7 +31,7 @@ class PersonCreationManager:
                 .first()
             )
 
-        synctera_client = SyncteraClient()
+        synctera_client = SyncteraClient(transport=synctera_transport)
         return synctera_client.create_person(user=person,
                                              address=person.legal_address,
                                              mobile=person.user_mobile_number,
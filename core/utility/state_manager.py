@@ -1,8 +1,9 @@
 import logging
+from contextlib import nullcontext
 
+from django.db.models import Prefetch
 from django.utils import timezone
 from rest_framework.exceptions import ValidationError
-from common.email import EmailSender
 from common.views import CommonProfileManager
 from core.enums import ProfileApprovalStatus, AllowedCountries, ProfileType, OnboardingSteps, AdminReviewStatus
 from core.helpers import upload_persona_documents_to_synctera
@@ -10,6 +11,7 @@ from core.models import PriyoMoneyUser, UserMetaData
 from dues.tasks import DueCreationTask
 from pay_admin.models import PayAdmin
 from core.utility.disclosure import PersonDisclosureManager
+from core.utility.email_outbox import OutboxEmailSender, email_outbox_batch
 from core.utility.kyc import KycCreationManager
 from core.utility.onboarding_step_handler import OnboardingStepManager
 from core.utility.person import PersonCreationManager
@@ -23,19 +25,83 @@ from django.conf import settings
 logger = logging.getLogger(__name__)
 
 
+def send_status_change_email(user, previous_status, new_status):
+    OutboxEmailSender(user=user).send_kyc_status_change_email(previous_status, new_status)
+
+
+def send_admin_approved_email(user, previous_status, new_status):
+    OutboxEmailSender(user=user).send_user_email(context='kyc_status_admin_approved_email')
+
+
+def extend_onboarding_subscription(user, previous_status, new_status):
+    subscription: Subscription = user.get_active_onboarding_subscription()
+    DueCreationTask.extend_paid_upto_date_using_kyc_acceptance_or_approval_date(subscription, admin_approved=True)
+
+
+class Transition:
+    """
+    An entry of PersonManager.transitions. A state can be requested from the source states only, then prepare and
+    the guards (PersonManager methods, guards raise ValidationError) run and the handler moves the person. Once the
+    status changed, emails and side effects (functions of user, previous status, new status) run: emails are queued
+    in the email outbox in the transaction of the change, side effects run in a celery task after commit.
+    """
+
+    def __init__(self, sources, handler, prepare=None, guards=(), emails=(), side_effects=()):
+        self.sources = tuple(sources)
+        self.handler = handler
+        self.prepare = prepare
+        self.guards = tuple(guards)
+        self.emails = tuple(emails)
+        self.side_effects = tuple(side_effects)
+
+    def check_source(self, person):
+        if person.profile_approval_status not in self.sources:
+            raise ValidationError(detail={'profile_approval_status': [
+                f'Person status is not {" or ".join(self.sources)}'
+            ]})
+
+
 class PersonManager(CommonProfileManager):
+    transitions = {
+        ProfileApprovalStatus.AWAITING_PROFILE_COMPLETION.value: Transition(
+            sources=[ProfileApprovalStatus.AWAITING_SIGNUP_COMPLETION.value],
+            handler='handle_awaiting_profile_completion',
+        ),
+        ProfileApprovalStatus.AWAITING_ADMIN_APPROVAL.value: Transition(
+            sources=[ProfileApprovalStatus.AWAITING_PROFILE_COMPLETION.value],
+            handler='handle_awaiting_admin_approval',
+            prepare='sync_shipping_address',
+            guards=['check_onboarding_data'],
+            emails=[send_status_change_email],
+        ),
+        ProfileApprovalStatus.PROFILE_COMPLETED.value: Transition(
+            sources=[ProfileApprovalStatus.AWAITING_ADMIN_APPROVAL.value],
+            handler='handle_profile_completed',
+            emails=[send_status_change_email, send_admin_approved_email],
+            side_effects=[extend_onboarding_subscription],
+        ),
+        ProfileApprovalStatus.PROFILE_INFO_SAVED.value: Transition(
+            sources=[ProfileApprovalStatus.PROFILE_COMPLETED.value],
+            handler='handle_profile_info_saved',
+            guards=['check_onboarding_data', 'check_onboarding_subscription', 'check_persona_requirements'],
+        ),
+        ProfileApprovalStatus.MANUAL_KYC_ACCEPTED.value: Transition(
+            sources=[ProfileApprovalStatus.MANUAL_KYC_IN_REVIEW.value, ProfileApprovalStatus.MANUAL_KYC_REJECTED.value],
+            handler='handle_manual_kyc_accepted',
+            guards=['check_bd_user'],
+        ),
+        ProfileApprovalStatus.MANUAL_KYC_REJECTED.value: Transition(
+            sources=[ProfileApprovalStatus.MANUAL_KYC_IN_REVIEW.value, ProfileApprovalStatus.MANUAL_KYC_REJECTED.value],
+            handler='handle_manual_kyc_rejected',
+            guards=['check_bd_user'],
+        ),
+    }
+    # Admin rejection blocks the review, the person keeps their status
+    admin_rejection = Transition(sources=[ProfileApprovalStatus.AWAITING_ADMIN_APPROVAL.value], handler=None)
 
     def __init__(self, person: PriyoMoneyUser, admin: PayAdmin = None):
         self.person = person
         self.admin = admin
-        self._handler_dict = {
-            ProfileApprovalStatus.AWAITING_PROFILE_COMPLETION.value: self.handle_awaiting_profile_completion,
-            ProfileApprovalStatus.PROFILE_INFO_SAVED.value: self.handle_profile_info_saved,
-            ProfileApprovalStatus.AWAITING_ADMIN_APPROVAL.value: self.handle_awaiting_admin_approval,
-            ProfileApprovalStatus.PROFILE_COMPLETED.value: self.handle_profile_completed,
-            ProfileApprovalStatus.MANUAL_KYC_ACCEPTED.value: self.handle_manual_kyc_accepted,
-            ProfileApprovalStatus.MANUAL_KYC_REJECTED.value: self.handle_manual_kyc_rejected,
-        }
 
     def should_run_kyc_with_persona(self):
         return self.person.get_country() == AllowedCountries.BD.value
@@ -68,33 +134,29 @@ class PersonManager(CommonProfileManager):
         self.call_celery(entity_type=PersonDisclosureManager.entity_type,
                          view_class_name=PersonDisclosureManager.view_class_name)
 
-    def handle_awaiting_profile_completion(self):
-        if self.person.profile_approval_status != ProfileApprovalStatus.AWAITING_SIGNUP_COMPLETION.value:
+    def check_onboarding_data(self):
+        if not self.person.has_complete_onboarding_data():
+            missing_fields = self.person.get_missing_onboarding_data()
             raise ValidationError(detail={'profile_approval_status': [
-                f'Person status is not {ProfileApprovalStatus.AWAITING_SIGNUP_COMPLETION.value}'
+                f'Onboarding criteria not fulfilled: Missing {missing_fields}'
             ]})
 
+    def check_onboarding_subscription(self):
+        if not is_user_subscribed_for_onboarding(self.person):
+            raise ValidationError(detail={'subscription': 'Not done'})
+
+    def handle_awaiting_profile_completion(self):
         try:
             self.person.profile_approval_status = ProfileApprovalStatus.AWAITING_PROFILE_COMPLETION.value
             self.person.save(update_fields=['profile_approval_status'])
         except Exception as ex:
             raise ValidationError(detail={'profile_approval_status': [str(ex)]})
 
-    def handle_awaiting_admin_approval(self):
+    def sync_shipping_address(self):
         self.person.sync_shipping_address(force_overwrite=True)
-        if self.person.profile_approval_status != ProfileApprovalStatus.AWAITING_PROFILE_COMPLETION.value:
-            raise ValidationError(detail={'profile_approval_status': [
-                f'Person status is not {ProfileApprovalStatus.AWAITING_PROFILE_COMPLETION.value}'
-            ]})
-
-        if not self.person.has_complete_onboarding_data():
-            missing_fields = self.person.get_missing_onboarding_data()
-            raise ValidationError(detail={'profile_approval_status': [
-                f'Onboarding criteria not fulfilled: Missing {missing_fields}'
-            ]})
 
+    def handle_awaiting_admin_approval(self):
         try:
-            previous_approval_status = self.person.profile_approval_status
             if self.person.requires_admin_approval():
                 approval_status = ProfileApprovalStatus.AWAITING_ADMIN_APPROVAL.value
                 admin_review_status = AdminReviewStatus.IN_REVIEW.value
@@ -105,30 +167,14 @@ class PersonManager(CommonProfileManager):
             self.person.admin_review_status = admin_review_status
             self.person.profile_approval_status = approval_status
             self.person.save(update_fields=['profile_approval_status', 'admin_review_status'])
-            EmailSender(user=self.person).send_kyc_status_change_email(previous_approval_status, approval_status)
         except Exception as ex:
             raise ValidationError(detail={'profile_approval_status': [str(ex)]})
 
     def handle_profile_completed(self):
-        if self.person.profile_approval_status != ProfileApprovalStatus.AWAITING_ADMIN_APPROVAL.value:
-            raise ValidationError(detail={'profile_approval_status': [
-                f'Person status is not {ProfileApprovalStatus.AWAITING_ADMIN_APPROVAL.value}'
-            ]})
-
         try:
             if self.profile_approve_by_admin():
-                previous_approval_status = self.person.profile_approval_status
-                approval_status = ProfileApprovalStatus.PROFILE_COMPLETED.value
-                self.person.profile_approval_status = approval_status
+                self.person.profile_approval_status = ProfileApprovalStatus.PROFILE_COMPLETED.value
                 self.person.save(update_fields=['profile_approval_status'])
-                EmailSender(user=self.person).send_kyc_status_change_email(previous_approval_status, approval_status)
-
-                if previous_approval_status == ProfileApprovalStatus.AWAITING_ADMIN_APPROVAL.value:
-                    EmailSender(user=self.person).send_user_email(context='kyc_status_admin_approved_email')
-
-                subscription: Subscription = self.person.get_active_onboarding_subscription()
-                DueCreationTask.extend_paid_upto_date_using_kyc_acceptance_or_approval_date(subscription, admin_approved=True)
-
         except Exception as ex:
             raise ValidationError(detail={'profile_approval_status': [str(ex)]})
 
@@ -155,30 +201,15 @@ class PersonManager(CommonProfileManager):
         return is_profile_completed
 
     def check_persona_requirements(self):
+        # TODO :: Temporarily skipped Persona for business on-boarding flow.
+        # We had a plan to remove profile_type from PriyoMoneyUser
+        if self.person.profile_type == ProfileType.BUSINESS.value:
+            return
         persona_verification = self.person.persona_verifications.filter(is_active=True).first()
         if not persona_verification or not persona_verification.is_complete():
             raise CUSTOM_ERROR_LIST.PERSONA_VERIFICATION_NOT_COMPLETE
 
     def handle_profile_info_saved(self):
-        if self.person.profile_approval_status != ProfileApprovalStatus.PROFILE_COMPLETED.value:
-            raise ValidationError(detail={'profile_approval_status': [
-                f'Person status is not {ProfileApprovalStatus.PROFILE_COMPLETED.value}'
-            ]})
-
-        if not self.person.has_complete_onboarding_data():
-            missing_fields = self.person.get_missing_onboarding_data()
-            raise ValidationError(detail={'profile_approval_status': [
-                f'Onboarding criteria not fulfilled: Missing {missing_fields}'
-            ]})
-
-        if not is_user_subscribed_for_onboarding(self.person):
-            raise ValidationError(detail={'subscription': 'Not done'})
-
-        # TODO :: Temporarily skipped Persona for business on-boarding flow.
-        # We had a plan to remove profile_type from PriyoMoneyUser
-        if self.person.profile_type != ProfileType.BUSINESS.value:
-            self.check_persona_requirements()
-
         if self.person.is_user_only_subscribed_for_bdt_account():
             self.person.profile_approval_status = ProfileApprovalStatus.KYC_ACCEPTED_FOR_BDT_ONLY.value
             self.person.save(update_fields=['profile_approval_status'])
@@ -186,25 +217,15 @@ class PersonManager(CommonProfileManager):
         else:
             self.create_person_synctera()
 
-    def check_bd_user_kyc_update_requirements(self):
+    def check_bd_user(self):
         if self.person.get_country() != AllowedCountries.BD.value:
             raise ValidationError(detail={'country': f'Country must be bd'})
 
-        allowed_current_statuses = [
-            ProfileApprovalStatus.MANUAL_KYC_IN_REVIEW.value,
-            ProfileApprovalStatus.MANUAL_KYC_REJECTED.value
-        ]
-
-        if self.person.profile_approval_status not in allowed_current_statuses:
-            raise ValidationError({"user": "User status must be in review or rejected"})
-
     def handle_manual_kyc_accepted(self):
-        self.check_bd_user_kyc_update_requirements()
         self.person.profile_approval_status = ProfileApprovalStatus.MANUAL_KYC_ACCEPTED.value
         self.person.save(update_fields=['profile_approval_status'])
 
     def handle_manual_kyc_rejected(self):
-        self.check_bd_user_kyc_update_requirements()
         self.person.profile_approval_status = ProfileApprovalStatus.MANUAL_KYC_REJECTED.value
         self.person.save(update_fields=['profile_approval_status'])
 
@@ -212,4 +233,111 @@ class PersonManager(CommonProfileManager):
         if self.person.profile_approval_status == new_state:
             return
 
-        self._handler_dict[new_state]()
+        transition = self.transitions[new_state]
+        transition.check_source(self.person)
+        if transition.prepare:
+            getattr(self, transition.prepare)()
+        for guard in transition.guards:
+            getattr(self, guard)()
+
+        previous_status = self.person.profile_approval_status
+        with transaction.atomic() if transition.emails else nullcontext(), email_outbox_batch():
+            getattr(self, transition.handler)()
+            if self.person.profile_approval_status != previous_status:
+                for send_email in transition.emails:
+                    send_email(self.person, previous_status, self.person.profile_approval_status)
+        if self.person.profile_approval_status != previous_status:
+            self.enqueue_side_effects(new_state, previous_status, self.person.profile_approval_status, [self.person.id])
+
+    @classmethod
+    def enqueue_side_effects(cls, requested_state, previous_status, new_status, user_ids):
+        if not cls.transitions[requested_state].side_effects or not user_ids:
+            return
+        from core.tasks import run_person_transition_side_effects
+        batch_size = settings.PERSON_TRANSITION_SIDE_EFFECT_BATCH_SIZE
+        for start in range(0, len(user_ids), batch_size):
+            batch = list(user_ids[start:start + batch_size])
+            transaction.on_commit(lambda batch=batch: run_person_transition_side_effects.delay(
+                requested_state, previous_status, new_status, batch))
+
+    @classmethod
+    def run_side_effects(cls, requested_state, previous_status, new_status, user_ids):
+        """Runs the transition's side effects for each user, a failing one is logged and doesn't stop the others"""
+        side_effects = cls.transitions[requested_state].side_effects
+        users = PriyoMoneyUser.objects.filter(id__in=user_ids).prefetch_related(
+            Prefetch('subscriptions', queryset=Subscription.objects.select_related('package').order_by('id')))
+        for user in users:
+            for side_effect in side_effects:
+                try:
+                    side_effect(user, previous_status, new_status)
+                except Exception:
+                    logger.error(f'{side_effect.__name__} failed for user {user.id} after moving to {new_status}',
+                                 exc_info=True)
+
+    @classmethod
+    def bulk_approve(cls, user_ids, admin: PayAdmin):
+        """
+        Admin approval of many AWAITING_ADMIN_APPROVAL people at once, the same rules as handle_profile_completed:
+        with PROFILE_APPROVAL_ADMIN_STEP 2 the first approval is recorded and a second admin completes the profile.
+        Guards are checked in a few set based queries, the emails are queued in one insert and the side effects run
+        in batched celery tasks.
+        """
+        transition = cls.transitions[ProfileApprovalStatus.PROFILE_COMPLETED.value]
+        user_ids = list(dict.fromkeys(user_ids))
+        result = {'completed': [], 'awaiting_second_approval': [], 'skipped': {}}
+        now = timezone.now()
+
+        with transaction.atomic(), email_outbox_batch():
+            people = {person.id: person for person in PriyoMoneyUser.objects.select_for_update().filter(
+                id__in=user_ids, profile_approval_status__in=transition.sources)}
+            meta_data = {meta.user_id: meta for meta in UserMetaData.objects.filter(user_id__in=people)}
+
+            changed_meta_data, new_meta_data = [], []
+            for user_id in user_ids:
+                if user_id not in people:
+                    result['skipped'][user_id] = f'Person status is not {" or ".join(transition.sources)}'
+                    continue
+                meta = meta_data.get(user_id)
+                if meta is None:
+                    new_meta_data.append(UserMetaData(user_id=user_id, profile_approved_by=admin,
+                                                      profile_approved_at=now))
+                    is_profile_completed = settings.PROFILE_APPROVAL_ADMIN_STEP == 1
+                elif meta.profile_approved_by_id == admin.id:
+                    result['skipped'][user_id] = "Same Admin User can't verify the User Profile"
+                    continue
+                elif meta.profile_approved_by_id:
+                    meta.profile_verified_by, meta.profile_verified_at = admin, now
+                    changed_meta_data.append(meta)
+                    is_profile_completed = True
+                else:
+                    meta.profile_approved_by, meta.profile_approved_at = admin, now
+                    changed_meta_data.append(meta)
+                    is_profile_completed = settings.PROFILE_APPROVAL_ADMIN_STEP == 1
+                result['completed' if is_profile_completed else 'awaiting_second_approval'].append(user_id)
+
+            UserMetaData.objects.bulk_create(new_meta_data)
+            UserMetaData.objects.bulk_update(changed_meta_data, fields=[
+                'profile_approved_by', 'profile_approved_at', 'profile_verified_by', 'profile_verified_at'])
+            PriyoMoneyUser.objects.filter(id__in=result['completed']).update(
+                profile_approval_status=ProfileApprovalStatus.PROFILE_COMPLETED.value)
+            previous_status, new_status = transition.sources[0], ProfileApprovalStatus.PROFILE_COMPLETED.value
+            for user_id in result['completed']:
+                for send_email in transition.emails:
+                    send_email(people[user_id], previous_status, new_status)
+            cls.enqueue_side_effects(ProfileApprovalStatus.PROFILE_COMPLETED.value, previous_status, new_status,
+                                     result['completed'])
+        return result
+
+    @classmethod
+    def bulk_reject(cls, user_ids):
+        """Blocks the admin review of many AWAITING_ADMIN_APPROVAL people in one update"""
+        sources = cls.admin_rejection.sources
+        with transaction.atomic():
+            rejected = set(PriyoMoneyUser.objects.select_for_update().filter(
+                id__in=user_ids, profile_approval_status__in=sources).values_list('id', flat=True))
+            PriyoMoneyUser.objects.filter(id__in=rejected).update(admin_review_status=AdminReviewStatus.BLOCKED.value)
+        return {
+            'rejected': [user_id for user_id in dict.fromkeys(user_ids) if user_id in rejected],
+            'skipped': {user_id: f'Person status is not {" or ".join(sources)}'
+                        for user_id in user_ids if user_id not in rejected},
+        }
@@ -0,0 +1,287 @@
+import heapq
+import json
+import logging
+from abc import ABC, abstractmethod
+from functools import reduce
+from operator import and_, or_
+
+from django.db.models import Q
+from django_redis import get_redis_connection
+
+from business.models import Business
+from core.models import PriyoMoneyUser
+from subscription.models import Tariff
+
+logger = logging.getLogger(__name__)
+
+
+class LabelIndex(ABC):
+    """
+    Precomputed dropdown choices of a model kept in Redis, searched by word prefix. Until the index is built (by the
+    rebuild_typeahead_index task or the rebuild_typeahead_indexes command) searches run a bounded database query.
+
+    Keys of an index:
+    - <prefix>:choices   hash, object id -> {"choice": <response dict>, "terms": [<searchable words>]}
+    - <prefix>:terms     sorted set of "<term>\\x00<id>" (all scores 0), scanned with ZRANGEBYLEX for prefix matches
+    - <prefix>:labels    sorted set of "<lowercased label>\\x00<id>", used to page through choices without a query
+    - <prefix>:ready     set once the index has been fully built from the database
+    - <prefix>:pending   ids saved or deleted while the index was not ready, replayed once a rebuild has finished
+    """
+    name = None
+    model = None
+    fields = ()  # values() fields needed to build a choice, a save touching none of them leaves the index as is
+    search_fields = ()  # fields the database fallback matches every word of the query against
+    ordering = ()  # order of the database fallback, close to the label order of the index
+
+    key_prefix = 'priyo-pay:typeahead'
+    separator = '\x00'
+    candidate_chunk_size = 1000  # term members read per ZRANGEBYLEX
+    max_candidates = 20000  # a word prefix matching more objects than this gets a truncated result
+    build_chunk_size = 2000
+    default_page_size = 20
+    max_page_size = 50
+
+    @abstractmethod
+    def get_label(self, row):
+        pass
+
+    def get_choice(self, row):
+        return {"label": self.get_label(row), "value": str(row['id'])}
+
+    def get_terms(self, row):
+        return {word for word in self.get_label(row).lower().replace(' - ', ' ').split()}
+
+    @property
+    def redis(self):
+        return get_redis_connection('default')
+
+    def key(self, suffix):
+        return f'{self.key_prefix}:{self.name}:{suffix}'
+
+    def get_queryset(self):
+        return self.model.objects.all()
+
+    def is_relevant_save(self, update_fields):
+        return update_fields is None or bool(set(update_fields) & {*self.fields, 'is_deleted'})
+
+    def _member(self, value, object_id):
+        return f'{value}{self.separator}{object_id}'
+
+    def _write(self, pipeline, row, old_entry=None):
+        if old_entry:
+            self._remove_entry(pipeline, row['id'], old_entry)
+        choice, terms = self.get_choice(row), sorted(self.get_terms(row))
+        pipeline.hset(self.key('choices'), row['id'], json.dumps({"choice": choice, "terms": terms}))
+        pipeline.zadd(self.key('terms'), {self._member(term, row['id']): 0 for term in terms})
+        pipeline.zadd(self.key('labels'), {self._member(choice['label'].lower(), row['id']): 0})
+
+    def _remove_entry(self, pipeline, object_id, entry):
+        terms = [self._member(term, object_id) for term in entry['terms']]
+        if terms:
+            pipeline.zrem(self.key('terms'), *terms)
+        pipeline.zrem(self.key('labels'), self._member(entry['choice']['label'].lower(), object_id))
+
+    def _get_entry(self, object_id):
+        entry = self.redis.hget(self.key('choices'), object_id)
+        return json.loads(entry) if entry else None
+
+    def is_ready(self):
+        return bool(self.redis.exists(self.key('ready')))
+
+    def rebuild(self):
+        redis = self.redis
+        with redis.lock(self.key('rebuild-lock'), timeout=600, blocking_timeout=600):
+            if self.is_ready():
+                return
+            redis.delete(self.key('choices'), self.key('terms'), self.key('labels'))
+            count = 0
+            rows = self.get_queryset().order_by('id').values('id', *self.fields).iterator(chunk_size=self.build_chunk_size)
+            pipeline = redis.pipeline(transaction=False)
+            for count, row in enumerate(rows, start=1):
+                self._write(pipeline, row)
+                if count % self.build_chunk_size == 0:
+                    pipeline.execute()
+            pipeline.set(self.key('ready'), 1)
+            pipeline.execute()
+            replayed = self.replay_pending()
+            redis.delete(self.key('rebuild-scheduled'))
+            logger.info(f'Built {self.name} typeahead index with {count} entries, replayed {replayed} updates')
+
+    def schedule_rebuild(self):
+        """Queues one rebuild_typeahead_index task, requests meanwhile keep using the database fallback"""
+        from core.tasks import rebuild_typeahead_index
+        try:
+            if self.redis.set(self.key('rebuild-scheduled'), 1, nx=True, ex=600):
+                rebuild_typeahead_index.delay(self.name)
+        except Exception as ex:
+            logger.warning(f'Could not schedule a rebuild of the {self.name} typeahead index: {ex}')
+
+    def invalidate(self):
+        self.redis.delete(self.key('ready'))
+
+    def defer(self, object_id):
+        """
+        Records a change the index can't take yet. A rebuild reads rows while they keep changing, so changes made
+        during it are replayed once it is done.
+        """
+        pipeline = self.redis.pipeline()
+        pipeline.sadd(self.key('pending'), object_id)
+        pipeline.expire(self.key('pending'), 3600)
+        pipeline.execute()
+
+    def replay_pending(self):
+        replayed = 0
+        while object_ids := self.redis.spop(self.key('pending'), self.build_chunk_size):
+            for object_id in object_ids:
+                self.update(object_id.decode())
+            replayed += len(object_ids)
+        return replayed
+
+    def update(self, object_id):
+        if not self.is_ready():
+            self.defer(object_id)
+            # Ready in between means the rebuild may have replayed before our defer, apply it here then
+            if not self.is_ready():
+                return
+        row = self.get_queryset().filter(id=object_id).values('id', *self.fields).first()
+        if row is None:
+            return self.remove(object_id)
+        pipeline = self.redis.pipeline()
+        self._write(pipeline, row, old_entry=self._get_entry(object_id))
+        pipeline.execute()
+
+    def remove(self, object_id):
+        if not self.is_ready():
+            self.defer(object_id)
+            if not self.is_ready():
+                return
+        entry = self._get_entry(object_id)
+        if entry is None:
+            return
+        pipeline = self.redis.pipeline()
+        self._remove_entry(pipeline, object_id, entry)
+        pipeline.hdel(self.key('choices'), object_id)
+        pipeline.execute()
+
+    def _ids_from_members(self, members):
+        return [member.decode().rsplit(self.separator, 1)[1] for member in members]
+
+    def _load_entries(self, object_ids):
+        if not object_ids:
+            return []
+        entries = self.redis.hmget(self.key('choices'), object_ids)
+        return [json.loads(entry) for entry in entries if entry]
+
+    def iter_candidate_ids(self, token):
+        """Ids of the objects with a term starting with token, read a chunk at a time in term order"""
+        min_member, max_member = f'[{token}'.encode(), f'[{token}'.encode() + b'\xff'
+        while True:
+            members = self.redis.zrangebylex(self.key('terms'), min_member, max_member, start=0,
+                                             num=self.candidate_chunk_size)
+            yield from self._ids_from_members(members)
+            if len(members) < self.candidate_chunk_size:
+                return
+            min_member = b'(' + members[-1]
+
+    def search(self, query, offset=0, limit=None):
+        """
+        Returns one page of choices matching every word of the query by prefix, exact word matches first and then by
+        label, and whether it is truncated. Without a query, choices are paged in label order.
+
+        A page ranks every object matching the longest word of the query, unless more than max_candidates do. Then
+        only the first max_candidates in term order are ranked and the page is truncated, a longer query narrows it.
+        """
+        limit = min(limit or self.default_page_size, self.max_page_size)
+        tokens = (query or '').lower().split()
+        if not self.is_ready():
+            self.schedule_rebuild()
+            return self.search_database(tokens, offset, limit), False
+        if not tokens:
+            members = self.redis.zrangebylex(self.key('labels'), '-', '+', start=offset, num=limit)
+            return [entry['choice'] for entry in self._load_entries(self._ids_from_members(members))], False
+
+        # The longest word is the most selective one to look up candidates with
+        lookup_token = max(tokens, key=len)
+        candidate_ids, is_truncated = set(), False
+        ranked = []
+        for object_id in self.iter_candidate_ids(lookup_token):
+            if object_id in candidate_ids:
+                continue
+            if len(candidate_ids) == self.max_candidates:
+                is_truncated = True
+                break
+            candidate_ids.add(object_id)
+        for entry in self._load_entries(list(candidate_ids)):
+            terms = entry['terms']
+            if not all(any(term.startswith(token) for term in terms) for token in tokens):
+                continue
+            exact_matches = sum(token in terms for token in tokens)
+            ranked.append((-exact_matches, entry['choice']['label'].lower(), entry['choice']))
+        ranked = heapq.nsmallest(offset + limit, ranked, key=lambda item: item[:2])
+        return [choice for _, _, choice in ranked[offset:offset + limit]], is_truncated
+
+    def search_database(self, tokens, offset, limit):
+        """One page straight from the database, each word has to be in one of the search_fields"""
+        queryset = self.get_queryset()
+        if tokens:
+            queryset = queryset.filter(reduce(and_, (
+                reduce(or_, (Q(**{f'{field}__icontains': token}) for field in self.search_fields),
+                       Q(id=int(token)) if token.isdigit() else Q(pk__in=[]))
+                for token in tokens
+            )))
+        rows = queryset.order_by(*self.ordering, 'id').values('id', *self.fields)[offset:offset + limit]
+        return [self.get_choice(row) for row in rows]
+
+
+class UserLabelIndex(LabelIndex):
+    name = 'users'
+    model = PriyoMoneyUser
+    fields = ('first_name', 'middle_name', 'last_name', 'email_address', 'profile')
+    search_fields = ('first_name', 'middle_name', 'last_name', 'email_address')
+    ordering = ('first_name',)
+
+    def get_label(self, row):
+        user_name = ' '.join(name for name in [row['first_name'], row['middle_name'], row['last_name']] if name)
+        user_name = row['email_address'] if len(user_name.strip()) == 0 else user_name
+        return f'{user_name} - {row["id"]}'
+
+    def get_choice(self, row):
+        return super().get_choice(row) | {"profile_id": row['profile']}
+
+    def get_terms(self, row):
+        return super().get_terms(row) | ({row['email_address'].lower()} if row['email_address'] else set())
+
+
+class BusinessLabelIndex(LabelIndex):
+    name = 'businesses'
+    model = Business
+    fields = ('name', 'profile')
+    search_fields = ('name',)
+    ordering = ('name',)
+
+    def get_label(self, row):
+        return f'{row["name"]} - {row["id"]}'
+
+    def get_choice(self, row):
+        return super().get_choice(row) | {"profile_id": row['profile']}
+
+
+class TariffLabelIndex(LabelIndex):
+    name = 'tariffs'
+    model = Tariff
+    fields = ('tariff_name', 'tariff_type')
+    search_fields = ('tariff_name', 'tariff_type')
+    ordering = ('tariff_name',)
+
+    def get_label(self, row):
+        return f'{row["tariff_name"]} ({row["tariff_type"]})'
+
+    def get_terms(self, row):
+        return {word.strip('()') for word in super().get_terms(row)}
+
+
+user_label_index = UserLabelIndex()
+business_label_index = BusinessLabelIndex()
+tariff_label_index = TariffLabelIndex()
+
+label_indexes = [user_label_index, business_label_index, tariff_label_index]
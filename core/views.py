@@ -10,6 +10,7 @@ from rest_framework.response import Response
 from rest_framework.viewsets import ModelViewSet
 
 from api_clients.synctera_client import SyncteraClient
+from auth_client import PriyoClient
 from business.enums import BusinessVerificationStatus
 from business.models import Business
 from common.email import EmailSender
@@ -25,13 +26,35 @@ from utilities.enums import RequestMethod
 from core.models import PriyoMoneyUser, PlaidAuthorizationRequest, UserMetaData
 from core.permissions import IsAdmin, IsOwner, is_client, IsClient, ReadOnlyAdmin, is_admin
 from core.serializers import UserSsnSerializer, PersonVerifySerializer, BDManualKYCSerializer, SyncKYCSerializer, \
-    PriyoMoneyUserSerializer, PlaidAuthorizationRequestSerializer, UserFullAccessSerializer
+    PriyoMoneyUserSerializer, PlaidAuthorizationRequestSerializer, UserFullAccessSerializer, \
+    BulkProfileApprovalSerializer
 from common.serializers import SendTestEmailSerializer
 from core.utility.state_manager import PersonManager
+from core.utility.email_outbox import OutboxEmailSender
+from file_uploader.bucket import url_signing_metrics
+from priyomoney_client.cache_fill import cache_fill_counters
+from priyomoney_client.request_profile import route_profile_window, PROFILE_FIELDS
+from priyomoney_client.synctera_transport import synctera_transport, synctera_rate_limiter
+from priyomoney_client.routes import routing_counters, connection_counters, replica_pool, get_connection_stats
+from core.utility.typeahead import user_label_index, business_label_index, tariff_label_index
 
 logger = logging.getLogger(__name__)
 
 
+def get_typeahead_response(label_index, request):
+    # example: /business-choices/fetch/?q=priyo&offset=0&limit=20
+    try:
+        offset = max(int(request.query_params.get('offset', 0)), 0)
+        limit = max(int(request.query_params.get('limit', label_index.default_page_size)), 1)
+    except ValueError:
+        raise ValidationError({'detail': 'offset and limit must be integers'})
+    choices, is_truncated = label_index.search(request.query_params.get('q', ''), offset=offset, limit=limit)
+    response = Response(choices, status.HTTP_200_OK)
+    # The query matched too many choices to rank them all, the client should ask for a longer one
+    response['X-Typeahead-Truncated'] = 'true' if is_truncated else 'false'
+    return response
+
+
 class APILogFilterSearchChoices(GenericAPIView):
     http_method_names = ['get']
     permission_classes = [IsAdmin]
@@ -66,20 +89,7 @@ class APILogUserSearchChoices(GenericAPIView):
         return self.queryset
 
     def get(self, request, *args, **kwargs):
-        users_list = []
-        fields = ['id', 'first_name', 'middle_name', 'last_name', 'email_address', 'profile']
-
-        for user in PriyoMoneyUser.objects.all().order_by('first_name').values(*fields):
-            user_name = ' '.join(name for name in [user['first_name'], user['middle_name'], user['last_name']] if name)
-            user_name = user['email_address'] if len(user_name.strip()) == 0 else user_name
-            user_name = user_name + ' - ' + str(user['id'])
-            user_dict = {
-                "label": user_name,
-                "value": str(user['id']),
-                "profile_id": user['profile']
-            }
-            users_list.append(user_dict)
-        return Response(users_list, status.HTTP_200_OK)
+        return get_typeahead_response(user_label_index, request)
 
 
 class UserIdentificationView(GenericAPIView):
@@ -97,7 +107,7 @@ class UserIdentificationView(GenericAPIView):
         if not self.request.user.synctera_user_id:
             return Response({"ssn": ""}, status=status.HTTP_200_OK)
 
-        synctera_client = SyncteraClient()
+        synctera_client = SyncteraClient(transport=synctera_transport)
         person_response, status_code = synctera_client.get_person(self.request.user.synctera_user_id)
         if not status.is_success(status_code):
             return Response(person_response, status=status.HTTP_400_BAD_REQUEST)
@@ -110,7 +120,7 @@ class UserIdentificationView(GenericAPIView):
 
         person = request.user
         ssn = serializer.validated_data.get('ssn')
-        synctera_client = SyncteraClient()
+        synctera_client = SyncteraClient(transport=synctera_transport)
         person_response, status_code = synctera_client.update_person_ssn(person.synctera_user_id, ssn)
         if not status.is_success(status_code):
             return Response(person_response, status=status.HTTP_400_BAD_REQUEST)
@@ -194,7 +204,6 @@ class SyncKYCView(GenericAPIView):
         approval_status = get_user_verification_status(person.synctera_user_id)
 
         if approval_status:
-            is_send_email = False
             try:
                 with transaction.atomic(using=settings.MASTER_DB_KEY):
                     user = PriyoMoneyUser.objects.select_for_update().get(id=person.id)
@@ -203,18 +212,15 @@ class SyncKYCView(GenericAPIView):
                     if previous_approval_status != approval_status:
                         user.profile_approval_status = approval_status
                         user.save(update_fields=['profile_approval_status'])
-                        is_send_email = True
+                        OutboxEmailSender(user=user).send_kyc_status_change_email(previous_approval_status,
+                                                                                  approval_status)
 
                     if approval_status == ProfileApprovalStatus.KYC_ACCEPTED.value:
                         OnboardingStepManager(user).add_step(OnboardingSteps.KYC_ACCEPTANCE.value)
 
             except Exception as ex:
-                is_send_email = False
                 logger.error(str(ex), exc_info=True)
 
-            if is_send_email:
-                EmailSender(user=user).send_kyc_status_change_email(previous_approval_status, approval_status)
-
         return Response(PriyoMoneyUserSerializer(instance=user).data, status=status.HTTP_200_OK)
 
 
@@ -363,7 +369,7 @@ class PlaidAuthorizationRequestViewSet(ModelViewSet):
         grant_status = self.decide_grant_status(validated_data)
 
         try:
-            synctera_client = SyncteraClient(raise_exception=True)
+            synctera_client = SyncteraClient(raise_exception=True, transport=synctera_transport)
 
             if validated_data['profile'].profile_type == ProfileType.PERSON.value:
                 synctera_customer_id = validated_data['profile'].get_entity().synctera_user_id
@@ -410,16 +416,7 @@ class BusinessSearchChoices(GenericAPIView):
         return self.queryset
 
     def get(self, request, *args, **kwargs):
-        business_list = []
-
-        for business in Business.objects.all().order_by('name').values('id', 'name', 'profile'):
-            user_dict = {
-                "label": business['name'] + ' - ' + str(business['id']),
-                "value": str(business['id']),
-                "profile_id": business['profile']
-            }
-            business_list.append(user_dict)
-        return Response(business_list, status.HTTP_200_OK)
+        return get_typeahead_response(business_label_index, request)
 
 
 class TariffSearchChoices(GenericAPIView):
@@ -433,15 +430,66 @@ class TariffSearchChoices(GenericAPIView):
         return self.queryset
 
     def get(self, request, *args, **kwargs):
-        tariff_list = []
+        return get_typeahead_response(tariff_label_index, request)
+
+
+class DatabaseRoutingStatsView(GenericAPIView):
+    http_method_names = ['get']
+    permission_classes = [IsAdmin]
+
+    def get(self, request, *args, **kwargs):
+        routing_counters.flush(force=True)
+        connection_counters.flush(force=True)
+        cache_fill_counters.flush(force=True)
+        return Response({
+            'routing_counters': routing_counters.get_totals(),
+            'replicas': replica_pool.get_status(),  # as seen by the serving process
+            'connections': get_connection_stats(),
+            'cache_fill_counters': cache_fill_counters.get_totals(),
+            'url_signing': url_signing_metrics.snapshot(),  # as seen by the serving process
+        }, status.HTTP_200_OK)
+
+
+class RequestProfileStatsView(GenericAPIView):
+    http_method_names = ['get']
+    permission_classes = [IsAdmin]
+    order_by_choices = ('mean_ms', 'max_ms', 'mean_queries', 'count', *PROFILE_FIELDS)
+
+    def get(self, request, *args, **kwargs):
+        # example: /request-profile-stats/?minutes=15&limit=20&order_by=max_ms
+        try:
+            minutes = max(int(request.query_params.get('minutes', settings.REQUEST_PROFILE_WINDOW_MINUTES)), 1)
+            limit = max(int(request.query_params.get('limit', 20)), 1)
+        except ValueError:
+            raise ValidationError({'detail': 'minutes and limit must be integers'})
+        order_by = request.query_params.get('order_by', 'mean_ms')
+        if order_by not in self.order_by_choices:
+            raise ValidationError({'order_by': f'Must be one of {", ".join(self.order_by_choices)}'})
+
+        return Response({
+            'sample_rate': settings.REQUEST_PROFILE_SAMPLE_RATE,
+            'routes': route_profile_window.get_slowest_routes(minutes=minutes, limit=limit, order_by=order_by),
+            'one_auth': PriyoClient.transport.metrics.snapshot(),  # as seen by the serving process
+            'synctera': synctera_transport.metrics.snapshot(),  # as seen by the serving process
+            'synctera_rate_limit': synctera_rate_limiter.get_status(),
+        }, status.HTTP_200_OK)
+
+
+class BulkProfileApprovalView(GenericAPIView):
+    http_method_names = ['post']
+    permission_classes = [IsAdmin]
+    serializer_class = BulkProfileApprovalSerializer
 
-        for tariff in Tariff.objects.all().order_by('tariff_name').values('id', 'tariff_name', 'tariff_type'):
-            user_dict = {
-                "label": tariff['tariff_name'] + ' (' + tariff['tariff_type'] + ')',
-                "value": str(tariff['id'])
-            }
-            tariff_list.append(user_dict)
-        return Response(tariff_list, status.HTTP_200_OK)
+    def post(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        user_ids = serializer.validated_data.get('user_ids')
+        if serializer.validated_data.get('action') == BulkProfileApprovalSerializer.APPROVE:
+            result = PersonManager.bulk_approve(user_ids, admin=request.user)
+        else:
+            result = PersonManager.bulk_reject(user_ids)
+        return Response(result, status=status.HTTP_200_OK)
 
 
 class UserFullAccessView(GenericAPIView):
@@ -459,19 +507,10 @@ class UserFullAccessView(GenericAPIView):
             user.is_full_access_given = True
             user.save(update_fields=['is_full_access_given'])
             UserMetaData.objects.update_or_create(user=user, defaults={'full_access_updated_by': request.user})
-
-        self.send_mail_to_user(user)
+            OutboxEmailSender(user=user).send_user_email(context='full_access_given')
 
         return Response(status=status.HTTP_200_OK)
 
-    def send_mail_to_user(self, user):
-        try:
-            context = 'full_access_given'
-            email_sender = EmailSender(user=user)
-            email_sender.send_user_email(context=context)
-        except Exception as ex:
-            logger.error("Failed to send mail to notify for full access given \n" + str(ex))
-
 
 class IncomingPlaidConnectionViewSet(ModelViewSet):
     http_method_names = ['get']
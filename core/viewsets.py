@@ -9,13 +9,15 @@ from rest_framework.response import Response
 from rest_framework.status import HTTP_200_OK, is_success, HTTP_400_BAD_REQUEST, HTTP_201_CREATED
 from rest_framework.viewsets import ModelViewSet, ReadOnlyModelViewSet
 from rest_framework.exceptions import PermissionDenied
-from common.helpers import google_bucket_file_upload, SyncteraAddressDefaultMappings
+from common.helpers import SyncteraAddressDefaultMappings
 
 from accounts.enums import EntityType, SyncteraAccountStatus
 from accounts.handlers.account_balance_handler import AccountBalanceHandler
 from accounts.helpers import get_accounts_of_user
 from api_clients.synctera_client import SyncteraClient
+from priyomoney_client.synctera_transport import synctera_transport
 from common.email import EmailSender
+from file_uploader.bucket import stream_file_to_bucket
 from file_uploader.enums import RelatedResourceType
 from file_uploader.models import Documents
 from file_uploader.viewsets import FileUploaderViewSet
@@ -38,6 +40,7 @@ from core.serializers import PriyoMoneyUserSerializer, UserMobileNumberSerialize
 from core.filters import UserFilter, UserAdditionalInfoFilter, UserSMSLogFilter, \
     UserLocationFilter, UserAddressFilter, UserIdentityNumberFilterSet, UserOnboardingStepFilter, \
     UserSourceOfIncomeFilter, UserSourceOfHearingFilterSet, NoteFilterSet, UserContactReferenceFilter
+from core.utility.activity import user_activity_buffer
 from core.utility.state_manager import PersonManager
 from error_handling.custom_exception import CustomValidationError, CustomErrorWithCode
 from error_handling.utils import get_json_validation_error_response, get_json_response_with_error
@@ -66,7 +69,7 @@ class PriyoMoneyUserViewSet(ModelViewSet, CommonTaskManager):
         user_id = kwargs.get('id')
         user = PriyoMoneyUser.objects.get(id=user_id)
 
-        synctera_client = SyncteraClient()
+        synctera_client = SyncteraClient(transport=synctera_transport)
         return synctera_client.update_person(user.synctera_user_id, idempotent_key,
                                              **validated_data)
 
@@ -125,8 +128,26 @@ class PriyoMoneyUserViewSet(ModelViewSet, CommonTaskManager):
         if getattr(self, "swagger_fake_view", False):
             return PriyoMoneyUser.objects.none()
         if is_admin(self.request):
-            return PriyoMoneyUser.objects.all().order_by('-created_at')
-        return PriyoMoneyUser.objects.filter(Q(one_auth_uuid=self.request.user.one_auth_uuid)).order_by('-created_at')
+            queryset = PriyoMoneyUser.objects.all().order_by('-created_at')
+        else:
+            queryset = PriyoMoneyUser.objects.filter(Q(one_auth_uuid=self.request.user.one_auth_uuid)).order_by(
+                '-created_at')
+
+        if self.action in ['list', 'retrieve']:
+            queryset = self.get_serializer_class().setup_eager_loading(queryset)
+        return queryset
+
+    def paginate_queryset(self, queryset):
+        page = super().paginate_queryset(queryset)
+        if page is not None:
+            user_activity_buffer.merge_into(page)
+        return page
+
+    def get_object(self):
+        instance = super().get_object()
+        if self.action == 'retrieve':
+            user_activity_buffer.merge_into([instance])
+        return instance
 
 
 class UserBasicInfoViewSet(ReadOnlyModelViewSet):
@@ -229,7 +250,7 @@ class UserAddressViewSet(ModelViewSet, CommonTaskManager):
 
     @classmethod
     def perform_third_party_api_call(cls, validated_data, idempotent_key, **kwargs):
-        synctera_client = SyncteraClient()
+        synctera_client = SyncteraClient(transport=synctera_transport)
         synctera_user_id = kwargs.get('synctera_user_id', None)
         user = PriyoMoneyUser.objects.get(synctera_user_id=synctera_user_id)
 
@@ -417,7 +438,7 @@ class UserStatusUpdateViewSet(GenericAPIView, CommonTaskManager):
         user_id = kwargs.get('id')
         user = PriyoMoneyUser.objects.get(id=user_id)
 
-        synctera_client = SyncteraClient()
+        synctera_client = SyncteraClient(transport=synctera_transport)
         return synctera_client.update_person_status(user.synctera_user_id, idempotent_key,
                                                     validated_data.get('synctera_user_status'))
 
@@ -661,7 +682,7 @@ class NoteViewSet(ModelViewSet):
             folder_prefix = doc_type.lower()
             bucket_folder_name = folder_prefix + "/a" + str(request.user.id) + '_u' + str(user_id)
             file_name = FileUploaderViewSet.build_file_name(upload_file, bucket_folder_name)
-            uploaded_file, error_msg = google_bucket_file_upload(the_file=upload_file, file_name=file_name)
+            uploaded_file, _, error_msg = stream_file_to_bucket(the_file=upload_file, file_name=file_name)
 
             if uploaded_file:
                 document = Documents.objects.create(
@@ -0,0 +1,184 @@
+import base64
+import hashlib
+import logging
+import mimetypes
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files import File
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+
+from common.helpers import google_bucket_file_delete, google_bucket_file_url
+from file_uploader.models import Documents
+from priyomoney_client.cache_fill import cache_fill_counters
+from priyomoney_client.http_transport import LatencyHistogram
+
+logger = logging.getLogger(__name__)
+
+SIGNED_URL_KEY_PREFIX = 'signed-url:'
+MISSING_FILE_URL_TTL = 60
+
+# Time spent signing URLs (and checking the objects exist) in this process
+url_signing_metrics = LatencyHistogram()
+
+
+def get_content_hash(the_file):
+    """sha256 of the file, taken from the upload handler when the file came with the request"""
+    content_hash = getattr(the_file, 'sha256', None)
+    if content_hash is None:
+        sha256 = hashlib.sha256()
+        for chunk in (the_file if isinstance(the_file, File) else File(the_file)).chunks():
+            sha256.update(chunk)
+        content_hash = sha256.hexdigest()
+        the_file.sha256 = content_hash
+    return content_hash
+
+
+def find_stored_file_names(content_hash, bucket_folder_name):
+    """
+    Files of documents in the folder that have this content. Reuse is kept to one folder (one profile and document
+    name) so a document never points at an object under someone else's folder.
+    """
+    return list(Documents.objects.filter(content_hash=content_hash,
+                                         uploaded_file_name__startswith=f'{bucket_folder_name}/')
+                .values_list('uploaded_file_name', flat=True).distinct()[:5])
+
+
+def store_file(the_file, file_name, stored_file_names=()):
+    """
+    Reuses the first of stored_file_names that still exists in the bucket, otherwise streams the file to file_name.
+    Does not touch the database, so it can run on worker threads. Returns like stream_file_to_bucket.
+    """
+    for stored_file_name in stored_file_names:
+        if get_bucket_object(stored_file_name) is not None:
+            logger.info(f'Reusing {stored_file_name} instead of uploading {file_name}')
+            return stored_file_name, getattr(the_file, 'sha256', None), None
+    return stream_file_to_bucket(the_file, file_name)
+
+
+def store_file_in_bucket(the_file, file_name, bucket_folder_name, is_content_addressed=True):
+    """
+    Uploads the file unless the folder already has an object with the same content. A content addressed file_name
+    (see FileUploaderViewSet.build_file_name) is reused as well when it exists, even if no document refers to it.
+    """
+    stored_file_names = find_stored_file_names(get_content_hash(the_file), bucket_folder_name)
+    if is_content_addressed:
+        stored_file_names.append(file_name)
+    return store_file(the_file, file_name, stored_file_names)
+
+
+def delete_file_if_unreferenced(file_name, exclude_document_ids=()):
+    """Deletes the object unless a document (other than the excluded ones) still refers to it"""
+    if Documents.objects.filter(uploaded_file_name=file_name).exclude(pk__in=exclude_document_ids).exists():
+        logger.info(f'Keeping {file_name}, it is shared with other documents')
+        return False
+    google_bucket_file_delete(file_name)
+    return True
+
+
+def stream_file_to_bucket(the_file, file_name):
+    """
+    Uploads the file to the bucket in resumable chunks of GS_UPLOAD_CHUNK_SIZE, so at most one chunk of it is held in
+    memory (uploads above FILE_UPLOAD_MAX_MEMORY_SIZE are already spooled to disk by Django). The file is read once:
+    its checksums are computed from the chunks being uploaded and the object's md5 is checked against ours.
+
+    Returns (file_name, sha256 hex digest of the content, error message), file_name is None on failure.
+    """
+    if not isinstance(the_file, File):
+        the_file = File(the_file, name=getattr(the_file, 'name', file_name))
+    content_type = getattr(the_file, 'content_type', None) or mimetypes.guess_type(file_name)[0] or \
+        'application/octet-stream'
+
+    md5, sha256 = hashlib.md5(), hashlib.sha256()
+    blob = default_storage.bucket.blob(file_name, chunk_size=settings.GS_UPLOAD_CHUNK_SIZE)
+    try:
+        with blob.open('wb', content_type=content_type, ignore_flush=True) as writer:
+            for chunk in the_file.chunks(settings.GS_UPLOAD_CHUNK_SIZE):
+                md5.update(chunk)
+                sha256.update(chunk)
+                writer.write(chunk)
+        blob.reload()
+    except Exception as ex:
+        logger.error(f'Failed to upload {file_name} to the bucket', exc_info=True)
+        return None, None, str(ex)
+
+    # Composite objects have no md5, the resumable upload's own crc32c checks cover them
+    if blob.md5_hash and blob.md5_hash != base64.b64encode(md5.digest()).decode():
+        logger.error(f'Checksum mismatch after uploading {file_name}, deleting it')
+        blob.delete()
+        return None, None, 'File was corrupted while uploading, please try again'
+    return file_name, sha256.hexdigest(), None
+
+
+def generate_upload_url(file_name, content_type):
+    """
+    Returns a V4 signed URL that lets a client PUT the object straight into the bucket for GS_UPLOAD_URL_EXPIRATION
+    seconds. The client must send the same Content-Type header, it is part of the signature.
+    """
+    blob = default_storage.bucket.blob(file_name)
+    return blob.generate_signed_url(version='v4', method='PUT', content_type=content_type,
+                                    expiration=timedelta(seconds=settings.GS_UPLOAD_URL_EXPIRATION))
+
+
+def get_bucket_object(file_name):
+    """Returns the object's metadata (size, content_type, md5_hash, ...) or None if it was not uploaded"""
+    return default_storage.bucket.get_blob(file_name)
+
+
+def get_signed_url_key(file_name, check_exists):
+    return f'{SIGNED_URL_KEY_PREFIX}{"checked:" if check_exists else ""}{file_name}'
+
+
+def sign_url(file_name, check_exists=False):
+    started_at = time.perf_counter()
+    try:
+        if check_exists and not default_storage.exists(file_name):
+            return ''
+        return google_bucket_file_url(file_name)
+    finally:
+        url_signing_metrics.observe('exists_and_sign' if check_exists else 'sign',
+                                    (time.perf_counter() - started_at) * 1000)
+
+
+def get_signed_urls(file_names, check_exists=False):
+    """
+    Returns file name -> signed URL. URLs are cached and reused until GS_SIGNED_URL_REFRESH_MARGIN seconds before
+    they expire, the missing ones are signed together on a few threads. With check_exists a file missing from the
+    bucket gets '' (cached for a minute).
+    """
+    file_names = [file_name for file_name in dict.fromkeys(file_names) if file_name]
+    if not file_names:
+        return {}
+    keys = {file_name: get_signed_url_key(file_name, check_exists) for file_name in file_names}
+    cached = cache.get_many(keys.values())
+    signed_urls = {file_name: cached[key] for file_name, key in keys.items() if key in cached}
+    missing_file_names = [file_name for file_name in file_names if file_name not in signed_urls]
+
+    cache_fill_counters.increment('signed-url', 'hits', len(signed_urls))
+    cache_fill_counters.increment('signed-url', 'misses', len(missing_file_names))
+    cache_fill_counters.flush()
+    if not missing_file_names:
+        return signed_urls
+
+    if len(missing_file_names) == 1:
+        signed_urls[missing_file_names[0]] = sign_url(missing_file_names[0], check_exists)
+    else:
+        with ThreadPoolExecutor(max_workers=min(settings.GS_SIGNING_WORKERS, len(missing_file_names))) as executor:
+            signed_urls.update(zip(missing_file_names,
+                                   executor.map(lambda file_name: sign_url(file_name, check_exists), missing_file_names)))
+
+    timeout = max(int(settings.GS_EXPIRATION.total_seconds()) - settings.GS_SIGNED_URL_REFRESH_MARGIN, 0)
+    cache.set_many({keys[file_name]: signed_urls[file_name] for file_name in missing_file_names
+                    if signed_urls[file_name]}, timeout=timeout)
+    cache.set_many({keys[file_name]: '' for file_name in missing_file_names if not signed_urls[file_name]},
+                   timeout=MISSING_FILE_URL_TTL)
+    return signed_urls
+
+
+def get_signed_url(file_name, check_exists=False):
+    if not file_name:
+        return ''
+    return get_signed_urls([file_name], check_exists)[file_name]
@@ -1,15 +1,20 @@
 import io
+import os
 import requests
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
 from rest_framework import status
 from django.apps import apps
 from accounts.enums import EntityType
-from common.helpers import google_bucket_file_url
+from file_uploader.bucket import get_signed_url, get_signed_urls
 from common.views import CommonTaskManager
 from file_uploader.enums import DocumentType
 from file_uploader.models import Documents
 from file_uploader.viewsets import FileUploaderViewSet
 import logging
-from PIL import Image, ImageOps
+from PIL import Image, ImageOps, features
 
 logger = logging.getLogger(__name__)
 
@@ -71,43 +76,120 @@ class DocumentsManager(CommonTaskManager):
 
 
 class ImageCompressManager:
+    """
+    Thumbnails of profile images, generated once per upload by the generate_document_thumbnails task. Reads only
+    sign the precomputed objects and answer with PROFILE_IMAGE_PLACEHOLDER_URL while the thumbnails are pending.
+    """
     COMPRESS_WIDTH = 75
     COMPRESS_HEIGHT = 75
+    THUMBNAIL_SIZES = (75, 150, 300)  # the first one is also kept in uploaded_compressed_file_name
+    SCHEDULE_LOCK_SECONDS = 10 * 60
 
     @staticmethod
-    def get_compressed_image_url(document: Documents):
-        if not document or not document.uploaded_file_name or document.doc_type != DocumentType.PROFILE_IMAGE.value:
+    def has_thumbnails(document: Documents):
+        return document and document.uploaded_file_name and document.doc_type == DocumentType.PROFILE_IMAGE.value
+
+    @staticmethod
+    def get_thumbnail_file_name(document: Documents, size=COMPRESS_WIDTH):
+        thumbnail_file_name = (document.thumbnails or {}).get(str(size))
+        if size == ImageCompressManager.COMPRESS_WIDTH:
+            thumbnail_file_name = thumbnail_file_name or document.uploaded_compressed_file_name
+        return thumbnail_file_name
+
+    @staticmethod
+    def get_thumbnail_file_names(document: Documents):
+        if not ImageCompressManager.has_thumbnails(document):
+            return {}
+        return {str(size): ImageCompressManager.get_thumbnail_file_name(document, size)
+                for size in ImageCompressManager.THUMBNAIL_SIZES}
+
+    @staticmethod
+    def get_compressed_image_url(document: Documents, size=COMPRESS_WIDTH):
+        if not ImageCompressManager.has_thumbnails(document):
             return None
 
-        if document.uploaded_compressed_file_name:
-            return google_bucket_file_url(document.uploaded_compressed_file_name)
-        try:
-            ImageCompressManager.generate_compressed_image(document)
-            return google_bucket_file_url(document.uploaded_compressed_file_name)
-        except Exception as ex:
-            logger.error(f"Failed to compress image, document id {document.pk} \n" + str(ex), exc_info=True)
+        thumbnail_file_name = ImageCompressManager.get_thumbnail_file_name(document, size)
+        if thumbnail_file_name:
+            return get_signed_url(thumbnail_file_name)
+
+        ImageCompressManager.schedule_thumbnails(document)
+        return settings.PROFILE_IMAGE_PLACEHOLDER_URL
+
+    @staticmethod
+    def get_thumbnail_urls(document: Documents, signed_urls=None):
+        """signed_urls may hold the URLs already signed for a list of documents"""
+        thumbnail_file_names = ImageCompressManager.get_thumbnail_file_names(document)
+        if not thumbnail_file_names:
+            return {}
+        if not all(thumbnail_file_names.values()):
+            ImageCompressManager.schedule_thumbnails(document)
+
+        file_names = [file_name for file_name in thumbnail_file_names.values() if file_name]
+        signed_urls = signed_urls or {}
+        if not all(file_name in signed_urls for file_name in file_names):
+            signed_urls = get_signed_urls(file_names)
+        return {size: signed_urls[file_name] if file_name else settings.PROFILE_IMAGE_PLACEHOLDER_URL
+                for size, file_name in thumbnail_file_names.items()}
+
+    @staticmethod
+    def schedule_thumbnails(document: Documents, force=False):
+        """Queues thumbnail generation once the current transaction commits, at most once per lock period"""
+        lock_key = f'document-thumbnails:{document.pk}'
+        if force:
+            cache.delete(lock_key)
+        if not cache.add(lock_key, 1, timeout=ImageCompressManager.SCHEDULE_LOCK_SECONDS):
+            return
+        from file_uploader.tasks import generate_document_thumbnails
+        transaction.on_commit(lambda: generate_document_thumbnails.delay(document.pk))
+
+    @staticmethod
+    def reset_thumbnails(document: Documents):
+        """Called when the image of a document is replaced, reads get the placeholder until its thumbnails exist"""
+        document.uploaded_compressed_file_name = None
+        document.thumbnails = None
+        document.save(update_fields=['uploaded_compressed_file_name', 'thumbnails', 'updated_at'])
+        ImageCompressManager.schedule_thumbnails(document, force=True)
 
     @staticmethod
-    def generate_compressed_image(document: Documents):
-        response = requests.request('GET', google_bucket_file_url(document.uploaded_file_name))
+    def generate_thumbnails(document: Documents):
+        """Returns the thumbnail file names by size, None if the image was replaced meanwhile"""
+        source_file_name = document.uploaded_file_name
+        response = requests.request('GET', get_signed_url(source_file_name))
         if not status.is_success(response.status_code):
-            logger.error("Failed to retrieve image from gcp bucket to compress")
-            return None
+            raise Exception(f'Failed to retrieve image of document {document.pk} from the bucket: '
+                            f'{response.status_code}')
 
         image = Image.open(io.BytesIO(response.content))
         ImageOps.exif_transpose(image, in_place=True)
-        image.thumbnail((ImageCompressManager.COMPRESS_WIDTH, ImageCompressManager.COMPRESS_HEIGHT), Image.NEAREST)
-
+        image_format = 'WEBP' if features.check('webp') else image.format
+        if image_format == 'WEBP' and image.mode not in ('RGB', 'RGBA'):
+            # WEBP has no CMYK, palette or 16 bit modes. Transparency is kept
+            has_alpha = image.mode in ('LA', 'PA') or 'transparency' in image.info
+            image = image.convert('RGBA' if has_alpha else 'RGB')
         bucket_folder_name, file_name = ImageCompressManager._get_folder_name_and_file_name_for_compressed_file(document)
-        image_file_obj = io.BytesIO()
-        image_file_obj.name = file_name
-        image.save(image_file_obj, format=image.format)
-
-        uploaded_file_name, _ = FileUploaderViewSet.upload_file_to_bucket_basic(upload_file=image_file_obj,
-                                                                                bucket_folder_name=bucket_folder_name)
-
-        document.uploaded_compressed_file_name = uploaded_file_name
-        document.save()
+        name, extension = os.path.splitext(file_name)
+        extension = '.webp' if image_format == 'WEBP' else extension
+
+        thumbnails = {}
+        # Largest first, each thumbnail is made from the previous one instead of the full image
+        for size in sorted(ImageCompressManager.THUMBNAIL_SIZES, reverse=True):
+            image.thumbnail((size, size), Image.LANCZOS)
+            image_file_obj = io.BytesIO()
+            image_file_obj.name = f'{name}_{size}{extension}'
+            image.save(image_file_obj, format=image_format)
+            uploaded_file_name, _ = FileUploaderViewSet.upload_file_to_bucket_basic(upload_file=image_file_obj,
+                                                                                    bucket_folder_name=bucket_folder_name)
+            if not uploaded_file_name:
+                raise Exception(f'Failed to upload {size}px thumbnail of document {document.pk}')
+            thumbnails[str(size)] = uploaded_file_name
+
+        # The image may have been replaced while we were working on the old one
+        updated = Documents.objects.filter(pk=document.pk, uploaded_file_name=source_file_name).update(
+            thumbnails=thumbnails,
+            uploaded_compressed_file_name=thumbnails[str(ImageCompressManager.COMPRESS_WIDTH)],
+            updated_at=timezone.now(),
+        )
+        return thumbnails if updated else None
 
     @staticmethod
     def _get_folder_name_and_file_name_for_compressed_file(document: Documents):
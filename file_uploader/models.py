@@ -17,6 +17,8 @@ class Documents(TimeStampMixin):
     related_resource_type = models.CharField(max_length=16, choices=RelatedResourceType.choices())
     uploaded_file_name = models.CharField(max_length=256)
     uploaded_compressed_file_name = models.CharField(max_length=256, null=True, blank=True)
+    thumbnails = models.JSONField(null=True, blank=True)  # thumbnail size in px -> file name, set once generated
+    content_hash = models.CharField(max_length=64, null=True, blank=True, db_index=True)  # sha256 of the file
     verification_status = models.CharField(max_length=16, choices=DocumentVerificationStatus.choices(),
                                            default=DocumentVerificationStatus.UNVERIFIED.value)
 
@@ -1,3 +1,4 @@
+from django.core.exceptions import ValidationError as DjangoValidationError
 from rest_framework import serializers
 from rest_framework.serializers import ModelSerializer
 from django.conf import settings
@@ -9,19 +10,29 @@ from core.models import PriyoMoneyUser
 from file_uploader.enums import RelatedResourceType, BDPersonIdentityDocumentName, USPersonIdentityDocumentName
 from file_uploader.validators import FileValidator
 from file_uploader.models import Documents, SyncteraDocuments
-from django.core.files.storage import default_storage
-from common.helpers import google_bucket_file_url
+from django.db import models
+from file_uploader.bucket import get_signed_url, get_signed_urls
 from utilities.enums import RequestMethod
 from file_uploader.enums import DocumentType
 from core.enums import ServiceList
 from utilities.helpers import convert_to_safe_text
 
 
+DOCUMENT_FILE_VALIDATOR = FileValidator(max_size=5 * 1024 * 1024, allowed_extensions=('pdf', 'jpg', 'png', 'jpeg', 'gif'))
+
+
+class DocumentsListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        documents = list(data.all() if isinstance(data, models.Manager) else data)
+        self.child.prefetch_signed_urls(documents)
+        return super().to_representation(documents)
+
+
 class DocumentsSerializer(ModelSerializer, ProfileAssignmentSerializer):
-    upload_file = serializers.FileField(required=True, write_only=True, validators=[
-        FileValidator(max_size=5 * 1024 * 1024, allowed_extensions=('pdf', 'jpg', 'png', 'jpeg', 'gif'))])
+    upload_file = serializers.FileField(required=True, write_only=True, validators=[DOCUMENT_FILE_VALIDATOR])
     gcp_url = serializers.CharField(max_length=256, required=False, read_only=True)
     gcp_url_compressed = serializers.CharField(max_length=256, required=False, read_only=True)
+    thumbnail_urls = serializers.DictField(child=serializers.CharField(), required=False, read_only=True)
     uploader_id = serializers.IntegerField(write_only=True, required=False)
     document_name = serializers.CharField(max_length=64, write_only=True, required=False)
 
@@ -30,7 +41,19 @@ class DocumentsSerializer(ModelSerializer, ProfileAssignmentSerializer):
         fields = '__all__'
         read_only_fields = (
         'id', 'uploader', 'profile', 'uploaded_file_name', 'gcp_url', 'gcp_url_compressed', 'related_resource_type',
-        'created_at', 'updated_at', 'doc_name', 'verification_status')
+        'created_at', 'updated_at', 'doc_name', 'verification_status', 'thumbnails')
+        list_serializer_class = DocumentsListSerializer
+
+    signed_urls = None  # set by prefetch_signed_urls when serializing a list
+
+    def prefetch_signed_urls(self, documents):
+        """Signs the URLs of all the listed documents at once instead of one by one while serializing them"""
+        from file_uploader.manager import ImageCompressManager
+        self.signed_urls = {
+            'files': get_signed_urls([document.uploaded_file_name for document in documents], check_exists=True),
+            'thumbnails': get_signed_urls([file_name for document in documents for file_name
+                                           in ImageCompressManager.get_thumbnail_file_names(document).values()]),
+        }
 
     def to_internal_value(self, data):
         """This method overwrite only for uploading customer's additional identity documents"""
@@ -74,21 +97,50 @@ class DocumentsSerializer(ModelSerializer, ProfileAssignmentSerializer):
         representation = super().to_representation(instance)
         uploaded_file_name = representation['uploaded_file_name']
 
-        if default_storage.exists(uploaded_file_name):
-            representation['gcp_url'] = google_bucket_file_url(uploaded_file_name)
-        else:
-            representation['gcp_url'] = ""
+        signed_urls = self.signed_urls or {'files': {}, 'thumbnails': {}}
+        gcp_url = signed_urls['files'].get(uploaded_file_name)
+        if gcp_url is None:
+            gcp_url = get_signed_url(uploaded_file_name, check_exists=True)
+        representation['gcp_url'] = gcp_url
 
         from file_uploader.manager import ImageCompressManager
-        compressed_file_url = ImageCompressManager.get_compressed_image_url(instance)
+        thumbnail_urls = ImageCompressManager.get_thumbnail_urls(instance, signed_urls['thumbnails'])
+        compressed_file_url = thumbnail_urls.get(str(ImageCompressManager.COMPRESS_WIDTH))
         if compressed_file_url:
             representation['gcp_url_compressed'] = compressed_file_url
         else:
             representation['gcp_url_compressed'] = ""
+        representation['thumbnail_urls'] = thumbnail_urls
 
         return representation
 
 
+class DocumentUploadUrlSerializer(DocumentsSerializer):
+    """Requests a signed URL to upload a document straight to the bucket, the file itself is not sent"""
+    upload_file = None
+    file_name = serializers.CharField(max_length=256, write_only=True)
+    content_type = serializers.CharField(max_length=128, write_only=True)
+    size = serializers.IntegerField(min_value=1, write_only=True)
+    # sha256 hex digest computed by the client, recorded as the document's content_hash
+    content_hash = serializers.RegexField(r'^[0-9a-f]{64}$', write_only=True)
+
+    def validate(self, attrs):
+        attrs = super().validate(attrs)
+        try:
+            DOCUMENT_FILE_VALIDATOR.validate_name_and_size(attrs['file_name'], attrs['size'])
+        except DjangoValidationError as ex:
+            raise serializers.ValidationError({"file_name": ex.messages})
+        try:
+            DOCUMENT_FILE_VALIDATOR.validate_content_type(attrs['content_type'])
+        except DjangoValidationError as ex:
+            raise serializers.ValidationError({"content_type": ex.messages})
+        return attrs
+
+
+class DocumentUploadFinalizeSerializer(serializers.Serializer):
+    upload_id = serializers.CharField(max_length=64)
+
+
 class DocumentFileField(serializers.FileField):
     def __init__(self, **kwargs):
         validators = kwargs.pop('validators', [])
@@ -0,0 +1,25 @@
+import logging
+
+from celery import shared_task
+
+logger = logging.getLogger(__name__)
+
+
+@shared_task(bind=True, max_retries=3, default_retry_delay=30)
+def generate_document_thumbnails(self, document_id):
+    from file_uploader.manager import ImageCompressManager
+    from file_uploader.models import Documents
+
+    document = Documents.objects.filter(pk=document_id).first()
+    if not ImageCompressManager.has_thumbnails(document):
+        return
+    try:
+        thumbnails = ImageCompressManager.generate_thumbnails(document)
+    except Exception as ex:
+        logger.error(f'Failed to generate thumbnails of document {document_id}', exc_info=True)
+        raise self.retry(exc=ex)
+    if thumbnails is None:
+        # The replacing upload scheduled thumbnails of its own image
+        logger.info(f'Image of document {document_id} was replaced, thumbnails of the old one were not recorded')
+        return
+    logger.info(f'Generated thumbnails of document {document_id}: {thumbnails}')
@@ -48,3 +48,111 @@ class FileUploadTest(USClientAPITestCase):
         response = self.api_client.get(f'/business-documents/?business={business1.id}')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(response.json().get('count'), 1)
+
+    @skip_if_sqlite
+    @mock.patch('django.core.files.storage.default_storage.exists', mock.MagicMock(return_value=True))
+    @mock.patch('file_uploader.bucket.google_bucket_file_url', mock.MagicMock(return_value='https://bucket/doc'))
+    @mock.patch('file_uploader.viewsets.generate_upload_url', mock.MagicMock(return_value='https://bucket/signed'))
+    def test_direct_upload_is_recorded_on_finalize(self):
+        response = self.api_client.post('/document-uploads/upload-url/', data={
+            'profile_id': self.user.profile.id,
+            'doc_type': DocumentType.IDENTITY_DOCUMENTATION.value,
+            'file_name': 'passport.pdf',
+            'content_type': 'application/pdf',
+            'size': 1024,
+            'content_hash': 'a' * 64,
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['upload_url'], 'https://bucket/signed')
+        upload_id = response.json()['upload_id']
+
+        with mock.patch('file_uploader.viewsets.get_bucket_object', mock.MagicMock(return_value=None)):
+            response = self.api_client.post('/document-uploads/finalize/', data={'upload_id': upload_id}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Documents.objects.filter(profile=self.user.profile).exists())
+
+        uploaded_object = mock.MagicMock(content_type='application/pdf', size=1024)
+        with mock.patch('file_uploader.viewsets.get_bucket_object', mock.MagicMock(return_value=uploaded_object)):
+            response = self.api_client.post('/document-uploads/finalize/', data={'upload_id': upload_id}, format='json')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            # A repeated (or concurrent) finalize of the same upload doesn't record it again
+            response = self.api_client.post('/document-uploads/finalize/', data={'upload_id': upload_id}, format='json')
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        document = Documents.objects.get(profile=self.user.profile)
+        self.assertTrue(document.uploaded_file_name.startswith(f'{self.user.profile.profile_type}/p{self.user.profile.id}/'))
+        self.assertEqual(document.content_hash, 'a' * 64)
+        self.assertEqual(document.uploader, self.user)
+
+    @mock.patch('file_uploader.viewsets.generate_upload_url')
+    def test_upload_url_rejects_content_type_of_other_files(self, generate_upload_url):
+        response = self.api_client.post('/document-uploads/upload-url/', data={
+            'profile_id': self.user.profile.id,
+            'doc_type': DocumentType.IDENTITY_DOCUMENTATION.value,
+            'file_name': 'passport.pdf',
+            'content_type': 'text/html',
+            'size': 1024,
+            'content_hash': 'a' * 64,
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('content_type', response.json())
+        generate_upload_url.assert_not_called()
+
+    @mock.patch('file_uploader.bucket.google_bucket_file_delete')
+    def test_shared_file_is_kept_until_unreferenced(self, google_bucket_file_delete):
+        from file_uploader.bucket import delete_file_if_unreferenced
+        business = create_sample_business(user=self.user, fake_ein="12-3556789")
+        document = create_business_document(user=self.user, business=business, name="A")
+        shared_document = create_business_document(user=self.user, business=business, name="B")
+
+        self.assertFalse(delete_file_if_unreferenced('xxx', exclude_document_ids=[document.pk]))
+        google_bucket_file_delete.assert_not_called()
+
+        shared_document.delete()
+        self.assertTrue(delete_file_if_unreferenced('xxx', exclude_document_ids=[document.pk]))
+        google_bucket_file_delete.assert_called_once_with('xxx')
+
+    @mock.patch('file_uploader.manager.get_signed_url', mock.MagicMock(return_value='https://bucket/doc'))
+    @mock.patch('file_uploader.manager.FileUploaderViewSet.upload_file_to_bucket_basic')
+    @mock.patch('file_uploader.manager.requests.request')
+    def test_thumbnails_of_cmyk_image(self, request, upload_file_to_bucket_basic):
+        import io
+        from PIL import Image
+        from file_uploader.manager import ImageCompressManager
+        image_file_obj = io.BytesIO()
+        Image.new('CMYK', (400, 400)).save(image_file_obj, format='JPEG')
+        request.return_value = mock.MagicMock(status_code=200, content=image_file_obj.getvalue())
+        upload_file_to_bucket_basic.side_effect = lambda upload_file, bucket_folder_name: (upload_file.name, None)
+        document = Documents.objects.create(uploader=self.user, profile=self.user.profile,
+                                            doc_type=DocumentType.PROFILE_IMAGE.value, doc_name='profile_image',
+                                            related_resource_type=RelatedResourceType.CUSTOMER.value,
+                                            uploaded_file_name='customer/p1/profile_image/me.jpg')
+
+        thumbnails = ImageCompressManager.generate_thumbnails(document)
+        self.assertEqual(set(thumbnails), {'75', '150', '300'})
+
+        request.return_value = mock.MagicMock(status_code=404)
+        with self.assertRaises(Exception):
+            ImageCompressManager.generate_thumbnails(document)
+
+    @mock.patch('file_uploader.bucket.google_bucket_file_delete')
+    def test_documents_synctera_did_not_accept_are_discarded(self, google_bucket_file_delete):
+        from file_uploader.viewsets import KYCDocumentsUploaderViewSet
+        reused_document = create_business_document(user=self.user, business=create_sample_business(
+            user=self.user, fake_ein="12-3656789"))
+        previous_files = {reused_document.pk: ('xxx', None)}
+        reused_document.uploaded_file_name = 'new-passport'
+        reused_document.save()
+        created_document = create_business_document(user=self.user, business=create_sample_business(
+            user=self.user, fake_ein="12-3556789"), name='B')
+        submitted_document = create_business_document(user=self.user, business=create_sample_business(
+            user=self.user, fake_ein="12-3456798"), name='C')
+        file_statuses = [{'status': 'synctera_failed'}, {'status': 'synctera_failed'}, {'status': 'submitted'}]
+
+        kept_documents = KYCDocumentsUploaderViewSet.discard_unsubmitted_documents(
+            [reused_document, created_document, submitted_document], file_statuses, previous_files)
+
+        self.assertEqual(kept_documents, [submitted_document])
+        reused_document.refresh_from_db()
+        self.assertEqual(reused_document.uploaded_file_name, 'xxx')
+        self.assertFalse(Documents.objects.filter(pk=created_document.pk).exists())
+        google_bucket_file_delete.assert_called_once_with('new-passport')
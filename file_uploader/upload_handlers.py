@@ -0,0 +1,34 @@
+import hashlib
+
+from django.core.files.uploadhandler import MemoryFileUploadHandler, TemporaryFileUploadHandler
+
+
+class ChecksumUploadHandlerMixin:
+    """
+    Hashes an uploaded file while the request body is parsed, the upload ends up with a sha256 attribute so it never
+    has to be read again to find its content hash. Each handler hashes the chunks it keeps.
+    """
+
+    def new_file(self, *args, **kwargs):
+        self.sha256 = hashlib.sha256()
+        super().new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        data = super().receive_data_chunk(raw_data, start)
+        if data is None:
+            self.sha256.update(raw_data)
+        return data
+
+    def file_complete(self, file_size):
+        uploaded_file = super().file_complete(file_size)
+        if uploaded_file is not None:
+            uploaded_file.sha256 = self.sha256.hexdigest()
+        return uploaded_file
+
+
+class ChecksumMemoryFileUploadHandler(ChecksumUploadHandlerMixin, MemoryFileUploadHandler):
+    pass
+
+
+class ChecksumTemporaryFileUploadHandler(ChecksumUploadHandlerMixin, TemporaryFileUploadHandler):
+    pass
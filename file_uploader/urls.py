@@ -1,7 +1,7 @@
 from django.urls import path, include
 from rest_framework.routers import SimpleRouter
 from file_uploader.viewsets import FileUploaderViewSet, BDUserDocumentsUploaderViewSet, \
-    ExternalCustomerDocumentUploaderViewSet
+    ExternalCustomerDocumentUploaderViewSet, DocumentDirectUploadViewSet
 from file_uploader.viewsets import BusinessDocumentsUploaderViewSet, KYCDocumentsUploaderViewSet, \
     UserSourceOfIncomeDocumentUploaderViewSet, StudentDocumentsUploaderViewSet
 
@@ -13,6 +13,7 @@ router.register(r'kyc-identity-documents', KYCDocumentsUploaderViewSet)
 router.register(r'user-source-of-income-document', UserSourceOfIncomeDocumentUploaderViewSet)
 router.register(r'bd/user-identity-documents', BDUserDocumentsUploaderViewSet)
 router.register(r'file-upload', FileUploaderViewSet)
+router.register(r'document-uploads', DocumentDirectUploadViewSet, basename='document-uploads')
 router.register(r'business-owner-documents', ExternalCustomerDocumentUploaderViewSet)
 router.register(r'student-documents', StudentDocumentsUploaderViewSet)
 
@@ -36,9 +36,38 @@ class FileValidator(object):
         """
         Check the extension, content type and file size.
         """
+        self.validate_name_and_size(value.name, len(value))
+
+    def get_allowed_mimetypes(self):
+        """
+        The allowed mimetypes, or those of the allowed extensions when no mimetypes were given.
+        """
+        if self.allowed_mimetypes:
+            return set(self.allowed_mimetypes)
+        if self.allowed_extensions:
+            return {mimetypes.guess_type(f'file.{ext}')[0] for ext in self.allowed_extensions} - {None}
+        return set()
+
+    def validate_content_type(self, content_type):
+        """
+        Check a content type declared by the client, e.g. the one a signed upload URL is bound to.
+        """
+        allowed_mimetypes = self.get_allowed_mimetypes()
+        if allowed_mimetypes and content_type not in allowed_mimetypes:
+            message = self.mime_message % {
+                'mimetype': content_type,
+                'allowed_mimetypes': ', '.join(sorted(allowed_mimetypes))
+            }
+
+            raise ValidationError(message)
+
+    def validate_name_and_size(self, name, filesize):
+        """
+        Same checks for a file that is not in hand, e.g. one uploaded straight to the bucket.
+        """
 
         # Check the extension
-        ext = splitext(value.name)[1][1:].lower()
+        ext = splitext(name)[1][1:].lower()
         if self.allowed_extensions and ext not in self.allowed_extensions:
             message = self.extension_message % {
                 'extension': ext,
@@ -48,7 +77,7 @@ class FileValidator(object):
             raise ValidationError(message)
 
         # Check the content type
-        mimetype = mimetypes.guess_type(value.name)[0]
+        mimetype = mimetypes.guess_type(name)[0]
         if self.allowed_mimetypes and mimetype not in self.allowed_mimetypes:
             message = self.mime_message % {
                 'mimetype': mimetype,
@@ -58,7 +87,6 @@ class FileValidator(object):
             raise ValidationError(message)
 
         # Check the file size
-        filesize = len(value)
         if self.max_size and filesize > self.max_size:
             message = self.max_size_message % {
                 'size': filesizeformat(filesize),
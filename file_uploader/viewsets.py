@@ -1,31 +1,44 @@
+import logging
 import os
 import re
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 
+from django.core.cache import cache
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db import connections, transaction
 from django.db.models import Q
 from django.conf import settings
-from rest_framework.viewsets import ModelViewSet
+from rest_framework.decorators import action
+from rest_framework.viewsets import ModelViewSet, GenericViewSet
 from rest_framework.response import Response
 from rest_framework import status
 
 from api_clients.synctera_client import SyncteraClient
+from priyomoney_client.synctera_transport import synctera_transport
 from business.enums import BusinessAddressType
-from common.helpers import google_bucket_file_upload, google_bucket_file_delete
+from common.helpers import google_bucket_file_delete
 from core.enums import AllowedCountries, ProfileType
+from file_uploader.bucket import generate_upload_url, get_bucket_object, get_content_hash, store_file, \
+    store_file_in_bucket, find_stored_file_names, delete_file_if_unreferenced
 from file_uploader.enums import BDBusinessDocumentName, DocumentVerificationStatus, \
     RelatedResourceType, USPersonIdentityDocumentName, BDPersonIdentityDocumentName, StudentDocumentName
 from business.models import Business
 from business.views.manager import BusinessManager
 from core.permissions import IsAdmin, IsOwner, IsClient
-from core.models import Profile
+from core.models import Profile, PriyoMoneyUser
 from error_handling.error_list import CUSTOM_ERROR_LIST
 from file_uploader.filters import UserDocumentsFilter
 from file_uploader.models import Documents, SyncteraDocuments, DocumentsUploadedByAdmin, ExternalCustomerDocument
 from file_uploader.serializers import USBusinessDocUploadSerializer, DocumentsSerializer, BDBusinessDocUploadSerializer, \
     USPersonIdentityDocUploadSerializer, BDPersonIdentityDocUploadSerializer, PersonSourceOfIncomeDocUploadSerializer, \
-    ExternalCustomerDocumentSerializer, StudentDocumentUploadSerializer
+    ExternalCustomerDocumentSerializer, StudentDocumentUploadSerializer, DocumentUploadUrlSerializer, \
+    DocumentUploadFinalizeSerializer, DOCUMENT_FILE_VALIDATOR
 from file_uploader.enums import DocumentType, BusinessDocumentName
 from core.permissions import is_admin
+from priyomoney_client.rate_limit import call_priority, priority
+
+logger = logging.getLogger(__name__)
 
 
 class FileUploaderViewSet(ModelViewSet):
@@ -71,7 +84,8 @@ class FileUploaderViewSet(ModelViewSet):
                 error_msg = error_msg if error_msg else "Failed to upload file!"
                 raise CUSTOM_ERROR_LIST.FAILED_TO_CREATE_ERROR_4009(error_msg)
 
-            document = self.perform_db_update(user, profile, doc_type, doc_name, file_name, admin)
+            document = self.perform_db_update(user, profile, doc_type, doc_name, file_name, admin,
+                                              content_hash=get_content_hash(upload_file))
             return Response(data=self.serializer_class(document).data, status=status.HTTP_200_OK)
         except Exception as ex:
             return Response({'Error': str(ex)}, status=status.HTTP_400_BAD_REQUEST)
@@ -96,11 +110,17 @@ class FileUploaderViewSet(ModelViewSet):
 
     @classmethod
     def build_file_name(cls, upload_file, bucket_folder_name, version_required=True):
-        name, extension = os.path.splitext(upload_file.name)
+        """Versioned names are content addressed: the same content in the same folder always gets the same name"""
+        content_hash = get_content_hash(upload_file) if version_required else None
+        return cls.build_file_name_from_name(upload_file.name, bucket_folder_name, version_required, content_hash)
+
+    @classmethod
+    def build_file_name_from_name(cls, upload_file_name, bucket_folder_name, version_required=True, content_hash=None):
+        name, extension = os.path.splitext(upload_file_name)
         bucket_file_name = re.sub('[^a-zA-Z0-9]', '_', name)
         if len(bucket_file_name) > settings.GS_BUCKET_FILE_NAME_MAX_CHAR:
             bucket_file_name = bucket_file_name[:settings.GS_BUCKET_FILE_NAME_MAX_CHAR]
-        file_version = f"_v{str(uuid.uuid4())[:8]}" if version_required else ""
+        file_version = f"_v{content_hash[:16] if content_hash else str(uuid.uuid4())[:8]}" if version_required else ""
         file_name = bucket_folder_name + "/" + bucket_file_name + file_version + extension
         return file_name
 
@@ -108,38 +128,52 @@ class FileUploaderViewSet(ModelViewSet):
     def upload_file_to_bucket_basic(cls, upload_file, bucket_folder_name):
         try:
             file_name = cls.build_file_name(upload_file, bucket_folder_name)
-            uploaded_file_url, error_msg = google_bucket_file_upload(the_file=upload_file, file_name=file_name)
+            uploaded_file_url, _, error_msg = store_file_in_bucket(upload_file, file_name, bucket_folder_name)
             return uploaded_file_url, error_msg
         except Exception as ex:
             raise CUSTOM_ERROR_LIST.DB_GENERAL_ERROR_4004(str(ex))
 
+    @classmethod
+    def get_bucket_folder_name(cls, profile, doc_name, external_customer=None):
+        profile_type = profile.profile_type
+        if not external_customer:
+            return profile_type + "/p" + str(profile.id) + "/" + doc_name
+        return f"{profile_type}/p{str(profile.id)}/external_customer/e{str(external_customer.id)}/{doc_name}"
+
+    @classmethod
+    def get_replaceable_document(cls, profile, doc_type, doc_name):
+        return Documents.objects.filter(profile=profile, doc_type=doc_type, doc_name=doc_name).order_by(
+            '-updated_at').first()
+
+    @classmethod
+    def delete_replaced_file(cls, profile, doc_type, file_name, document):
+        """Removes the previous file of a business identity document that was not submitted to synctera"""
+        if (doc_type == DocumentType.IDENTITY_DOCUMENTATION.value and
+                profile.profile_type == ProfileType.BUSINESS.value and document and
+                not document.has_synctera_document() and document.uploaded_file_name != file_name):
+            delete_file_if_unreferenced(document.uploaded_file_name, exclude_document_ids=[document.pk])
+
     @classmethod
     def upload_file_to_bucket(cls, profile, upload_file, doc_name, doc_type, version_required=True, external_customer=None):
         try:
-            profile_type = profile.profile_type
-            if not external_customer:
-                bucket_folder_name = profile_type + "/p" + str(profile.id) + "/" + doc_name
-            else:
-                bucket_folder_name = f"{profile_type}/p{str(profile.id)}/external_customer/e{str(external_customer.id)}/{doc_name}"
-
+            bucket_folder_name = cls.get_bucket_folder_name(profile, doc_name, external_customer)
             file_name = cls.build_file_name(upload_file, bucket_folder_name, version_required)
 
-            document = Documents.objects.filter(profile=profile, doc_type=doc_type, doc_name=doc_name).order_by(
-                '-updated_at').first()
+            document = cls.get_replaceable_document(profile, doc_type, doc_name)
 
-            uploaded_file, error_msg = google_bucket_file_upload(the_file=upload_file, file_name=file_name)
+            uploaded_file, _, error_msg = store_file_in_bucket(upload_file, file_name, bucket_folder_name,
+                                                               is_content_addressed=version_required)
 
-            if (uploaded_file and doc_type == DocumentType.IDENTITY_DOCUMENTATION.value and
-                    profile_type == ProfileType.BUSINESS.value and document and
-                    not document.has_synctera_document() and document.uploaded_file_name != file_name):
-                google_bucket_file_delete(document.uploaded_file_name)
+            if uploaded_file:
+                cls.delete_replaced_file(profile, doc_type, uploaded_file, document)
 
             return uploaded_file, error_msg
         except Exception as ex:
             raise CUSTOM_ERROR_LIST.DB_GENERAL_ERROR_4004(str(ex))
 
     @classmethod
-    def perform_db_update(cls, user, profile, doc_type, doc_name, file_name, admin=None, external_customer=None):
+    def perform_db_update(cls, user, profile, doc_type, doc_name, file_name, admin=None, external_customer=None,
+                          reuse_document=True, content_hash=None):
         resource_type = RelatedResourceType.CUSTOMER.value
         if (profile.profile_type in [RelatedResourceType.BUSINESS.value, RelatedResourceType.LINKED_BUSINESS.value]
                 and not external_customer):
@@ -151,14 +185,16 @@ class FileUploaderViewSet(ModelViewSet):
             'doc_type': doc_type,
             'doc_name': doc_name,
             'uploaded_file_name': file_name,
+            'content_hash': content_hash,
             'related_resource_type': resource_type
         }
 
         if doc_type in [DocumentType.IDENTITY_DOCUMENTATION.value, DocumentType.BD_BUSINESS_IDENTITY_DOCS.value]:
             document = Documents.objects.filter(profile=profile, doc_type=doc_type, doc_name=doc_name,
                                                 synctera_document__isnull=True).order_by('-updated_at').first()
-            if document and document.verification_status == DocumentVerificationStatus.UNVERIFIED.value:
+            if reuse_document and document and document.verification_status == DocumentVerificationStatus.UNVERIFIED.value:
                 document.uploaded_file_name = file_name
+                document.content_hash = content_hash
                 document.save()
             else:
                 document = Documents.objects.create(**doc_data)
@@ -181,15 +217,199 @@ class FileUploaderViewSet(ModelViewSet):
             document, created = Documents.objects.update_or_create(profile=profile, doc_type=doc_type,
                                                                    doc_name=doc_name, defaults=doc_data)
 
-            if not created and doc_type == DocumentType.PROFILE_IMAGE.value:
-                document.uploaded_compressed_file_name = None
-                document.save()
+            if doc_type == DocumentType.PROFILE_IMAGE.value:
+                from file_uploader.manager import ImageCompressManager
+                ImageCompressManager.reset_thumbnails(document)
 
             if admin and created:
                 DocumentsUploadedByAdmin.objects.create(admin=admin, document=document)
 
         return document
 
+    @classmethod
+    def delete_orphaned_files(cls, file_names):
+        """Deletes objects uploaded for documents that were not recorded, objects shared with documents are kept"""
+        for file_name in file_names:
+            try:
+                delete_file_if_unreferenced(file_name)
+            except Exception:
+                logger.error(f'Failed to delete orphaned bucket object {file_name}', exc_info=True)
+
+    @classmethod
+    def upload_documents(cls, user, profile, doc_type, uploads, separate_documents=False):
+        """
+        Uploads [(doc_name, upload_file)] to the bucket concurrently on at most DOCUMENT_UPLOAD_WORKERS threads and, once
+        all of them are uploaded, records them in one transaction. If any upload or the transaction fails nothing is
+        recorded and the uploaded objects are deleted. Content already stored in a document's folder is not uploaded
+        again (see store_file_in_bucket). With separate_documents a doc_name repeated in the batch gets a
+        document per file instead of replacing the previous one.
+
+        Returns (documents, status of each file, error message).
+        """
+        file_statuses = [{'doc_name': doc_name, 'file': upload_file.name, 'status': 'pending', 'error': None}
+                         for doc_name, upload_file in uploads]
+        if not uploads:
+            return [], file_statuses, "Failed to upload files!"
+
+        bucket_folder_names = [cls.get_bucket_folder_name(profile, doc_name) for doc_name, _ in uploads]
+        file_names = [cls.build_file_name(upload_file, bucket_folder_name)
+                      for (_, upload_file), bucket_folder_name in zip(uploads, bucket_folder_names)]
+        # Database lookups stay on this thread, the workers only talk to the bucket
+        stored_file_names = [find_stored_file_names(get_content_hash(upload_file), bucket_folder_name) + [file_name]
+                             for (_, upload_file), bucket_folder_name, file_name
+                             in zip(uploads, bucket_folder_names, file_names)]
+        replaceable_documents = [cls.get_replaceable_document(profile, doc_type, doc_name) for doc_name, _ in uploads]
+
+        def store_file_in_worker(upload_file, file_name, file_stored_names):
+            try:
+                return store_file(upload_file, file_name, file_stored_names)
+            finally:
+                # Requests close their connections, pool threads don't. A persistent one would outlive the thread
+                connections.close_all()
+
+        with ThreadPoolExecutor(max_workers=min(settings.DOCUMENT_UPLOAD_WORKERS, len(uploads))) as executor:
+            results = list(executor.map(store_file_in_worker, [upload_file for _, upload_file in uploads], file_names,
+                                        stored_file_names))
+
+        uploaded_file_names = [uploaded_file for uploaded_file, _, _ in results if uploaded_file]
+        for file_status, (uploaded_file, _, error_msg) in zip(file_statuses, results):
+            file_status.update(status='uploaded' if uploaded_file else 'failed', error=error_msg)
+        if len(uploaded_file_names) < len(uploads):
+            cls.delete_orphaned_files(uploaded_file_names)
+            for file_status in file_statuses:
+                if file_status['status'] == 'uploaded':
+                    file_status['status'] = 'discarded'
+            return [], file_statuses, "Failed to upload files!"
+
+        try:
+            with transaction.atomic():
+                documents, recorded_doc_names = [], set()
+                for (doc_name, upload_file), file_name in zip(uploads, uploaded_file_names):
+                    reuse_document = not (separate_documents and doc_name in recorded_doc_names)
+                    documents.append(cls.perform_db_update(user, profile, doc_type, doc_name, file_name,
+                                                           reuse_document=reuse_document,
+                                                           content_hash=get_content_hash(upload_file)))
+                    recorded_doc_names.add(doc_name)
+        except Exception as ex:
+            cls.delete_orphaned_files(uploaded_file_names)
+            for file_status in file_statuses:
+                file_status.update(status='failed', error=str(ex))
+            return [], file_statuses, str(ex)
+
+        for file_status in file_statuses:
+            file_status['status'] = 'stored'
+        for file_name, document in zip(uploaded_file_names, replaceable_documents):
+            cls.delete_replaced_file(profile, doc_type, file_name, document)
+        return documents, file_statuses, ""
+
+
+class DocumentDirectUploadViewSet(GenericViewSet):
+    """
+    Two phase document upload that keeps file bytes off the web workers: upload-url returns a short lived signed URL
+    the client PUTs the file to, finalize checks the uploaded object and records the document like
+    FileUploaderViewSet.create does.
+    """
+    http_method_names = ['post']
+    permission_classes = [IsOwner | IsAdmin]
+    queryset = Documents.objects.all()
+    pending_upload_key_prefix = 'document-upload:'
+
+    def get_serializer_class(self):
+        if self.action == 'finalize':
+            return DocumentUploadFinalizeSerializer
+        return DocumentUploadUrlSerializer
+
+    @classmethod
+    def get_pending_upload_key(cls, upload_id):
+        return cls.pending_upload_key_prefix + upload_id
+
+    @staticmethod
+    def get_requester(request):
+        return f'{request.user.__class__.__name__}:{request.user.pk}'
+
+    @action(detail=False, methods=['post'], url_path='upload-url')
+    def upload_url(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        validated_data = serializer.validated_data
+
+        profile = Profile.objects.get(id=validated_data.get("profile_id"))
+        user, doc_name = FileUploaderViewSet.get_user_and_doc_name(request, validated_data)
+        if not isinstance(user, PriyoMoneyUser):
+            return Response({'Error': 'uploader is required for an admin upload'}, status=status.HTTP_400_BAD_REQUEST)
+        file_name = FileUploaderViewSet.build_file_name_from_name(
+            validated_data["file_name"], FileUploaderViewSet.get_bucket_folder_name(profile, doc_name),
+            content_hash=validated_data["content_hash"])
+        upload_url = generate_upload_url(file_name, validated_data["content_type"])
+
+        upload_id = uuid.uuid4().hex
+        cache.set(self.get_pending_upload_key(upload_id), {
+            'file_name': file_name,
+            'original_file_name': validated_data["file_name"],
+            'content_type': validated_data["content_type"],
+            'profile_id': profile.id,
+            'user_id': user.id,
+            'content_hash': validated_data["content_hash"],
+            'doc_type': validated_data.get("doc_type"),
+            'doc_name': doc_name,
+            'is_admin_upload': bool(validated_data.get("admin")),
+            'requester': self.get_requester(request),
+        }, timeout=settings.GS_UPLOAD_URL_EXPIRATION * 2)
+
+        return Response(data={
+            'upload_id': upload_id,
+            'upload_url': upload_url,
+            'method': 'PUT',
+            'headers': {'Content-Type': validated_data["content_type"]},
+            'expires_in': settings.GS_UPLOAD_URL_EXPIRATION,
+        }, status=status.HTTP_200_OK)
+
+    @action(detail=False, methods=['post'])
+    def finalize(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        pending_upload_key = self.get_pending_upload_key(serializer.validated_data["upload_id"])
+
+        pending_upload = cache.get(pending_upload_key)
+        if not pending_upload or pending_upload['requester'] != self.get_requester(request):
+            return Response({'Error': 'Upload not found or expired'}, status=status.HTTP_404_NOT_FOUND)
+
+        file_name = pending_upload['file_name']
+        bucket_object = get_bucket_object(file_name)
+        if bucket_object is None:
+            return Response({'Error': 'File has not been uploaded yet'}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Only the request that deletes the key records the upload, a concurrent finalize of the same upload stops here
+        if not cache.delete(pending_upload_key):
+            return Response({'Error': 'Upload not found or expired'}, status=status.HTTP_404_NOT_FOUND)
+
+        try:
+            if bucket_object.content_type != pending_upload['content_type']:
+                raise DjangoValidationError(f"Uploaded content type {bucket_object.content_type} does not match "
+                                            f"{pending_upload['content_type']}")
+            DOCUMENT_FILE_VALIDATOR.validate_name_and_size(pending_upload['original_file_name'], bucket_object.size)
+        except DjangoValidationError as ex:
+            google_bucket_file_delete(file_name)
+            return Response({'Error': ex.messages}, status=status.HTTP_400_BAD_REQUEST)
+
+        profile = Profile.objects.get(id=pending_upload['profile_id'])
+        user = PriyoMoneyUser.objects.get(id=pending_upload['user_id'])
+        doc_type, doc_name = pending_upload['doc_type'], pending_upload['doc_name']
+        admin = request.user if pending_upload['is_admin_upload'] else None
+
+        try:
+            with transaction.atomic():
+                replaced_document = FileUploaderViewSet.get_replaceable_document(profile, doc_type, doc_name)
+                document = FileUploaderViewSet.perform_db_update(user, profile, doc_type, doc_name, file_name, admin,
+                                                                 content_hash=pending_upload['content_hash'])
+                transaction.on_commit(lambda: FileUploaderViewSet.delete_replaced_file(profile, doc_type, file_name,
+                                                                                       replaced_document))
+        except Exception:
+            # The object is still in the bucket, the client may finalize again
+            cache.set(pending_upload_key, pending_upload, timeout=settings.GS_UPLOAD_URL_EXPIRATION)
+            raise
+        return Response(data=DocumentsSerializer(document).data, status=status.HTTP_200_OK)
+
 
 class BusinessDocumentsUploaderViewSet(FileUploaderViewSet):
     http_method_names = ['get', 'post', 'patch']
@@ -275,7 +495,8 @@ class BusinessDocumentsUploaderViewSet(FileUploaderViewSet):
                                                                      doc_type=document_type)
 
                     if file_name:
-                        user_document = cls.perform_db_update(user, profile, document_type, doc_name, file_name)
+                        user_document = cls.perform_db_update(user, profile, document_type, doc_name, file_name,
+                                                              content_hash=get_content_hash(uploaded_document))
                         response_data.append(user_document)
             if len(response_data) == 0:
                 error_message = "Failed to upload files!"
@@ -343,9 +564,10 @@ class KYCDocumentsUploaderViewSet(FileUploaderViewSet):
         serializer = serializer_class(data=request.data, context={'request': request})
         serializer.is_valid(raise_exception=True)
 
-        response_data, error_msg = self.upload_person_identity_docs(serializer.validated_data, request.user)
+        response_data, file_statuses, error_msg = self.upload_person_identity_docs(serializer.validated_data,
+                                                                                   request.user)
         if error_msg:
-            return Response({'Error': error_msg}, status=status.HTTP_400_BAD_REQUEST)
+            return Response({'Error': error_msg, 'files': file_statuses}, status=status.HTTP_400_BAD_REQUEST)
 
         return Response(data=DocumentsSerializer(response_data, many=True).data, status=status.HTTP_200_OK)
 
@@ -354,7 +576,7 @@ class KYCDocumentsUploaderViewSet(FileUploaderViewSet):
         profile = user.profile
         document_type = DocumentType.IDENTITY_DOCUMENTATION.value
         document_names = USPersonIdentityDocumentName.values()
-        response_data = []
+        response_data, file_statuses = [], []
         error_message = ""
         total_allowed_docs = int(settings.MAXIMUM_ALLOWED_IDENTITY_DOCS)
         total_submitted_docs = cls.get_submitted_identity_docs_number(validated_data, document_names)
@@ -366,31 +588,27 @@ class KYCDocumentsUploaderViewSet(FileUploaderViewSet):
             error_message = f"You can upload a maximum of {total_allowed_docs} identity documents. " \
                             f"You have already uploaded {already_uploaded_docs} documents. " \
                             f"Now You can upload only {total_allowed_docs - already_uploaded_docs} documents."
-            return response_data, error_message
+            return response_data, [], error_message
 
+        uploads = [(doc_name, uploaded_document) for doc_name in document_names
+                   for uploaded_document in validated_data.get(doc_name) or []]
         try:
-            for doc_name in document_names:
-                uploaded_doc_list = validated_data.get(doc_name)
-                if uploaded_doc_list:
-                    for uploaded_document in uploaded_doc_list:
-                        file_name, error_msg = cls.upload_file_to_bucket(profile=profile,
-                                                                         upload_file=uploaded_document,
-                                                                         doc_name=doc_name,
-                                                                         doc_type=document_type)
-
-                        if file_name:
-                            user_document = cls.perform_db_update(user, profile, document_type, doc_name, file_name)
-                            response_data.append(user_document)
-
-                            if user.synctera_user_id:
-                                cls.upload_document_to_synctera(user_document, uploaded_document, document_type, user)
-
-            if len(response_data) == 0:
-                error_message = "Failed to upload files!"
+            # Unsubmitted documents an upload may replace the file of, restored if that upload is not accepted
+            previous_files = {pk: (file_name, content_hash) for pk, file_name, content_hash in Documents.objects.filter(
+                profile=profile, doc_type=document_type, synctera_document__isnull=True).values_list(
+                'pk', 'uploaded_file_name', 'content_hash')}
+            # Each file submitted to synctera keeps its own document, like when they were recorded one by one
+            response_data, file_statuses, error_message = cls.upload_documents(
+                user, profile, document_type, uploads, separate_documents=bool(user.synctera_user_id))
+            if response_data and user.synctera_user_id:
+                error_message = cls.upload_documents_to_synctera(response_data, [file for _, file in uploads],
+                                                                 document_type, user, file_statuses)
+                if error_message:
+                    response_data = cls.discard_unsubmitted_documents(response_data, file_statuses, previous_files)
         except Exception as ex:
             error_message = str(ex)
 
-        return response_data, error_message
+        return response_data, file_statuses, error_message
 
     @classmethod
     def get_submitted_identity_docs_number(cls, validated_data, documents):
@@ -403,26 +621,78 @@ class KYCDocumentsUploaderViewSet(FileUploaderViewSet):
         return identity_docs_number
 
     @classmethod
-    def upload_document_to_synctera(cls, user_document, uploaded_doc_file, document_type, user):
-        try:
-            idempotent_key = f'{document_type}_KYC_ID_DOC{user_document.id}'
-            synctera_client = SyncteraClient()
-            doc_response, status_code = synctera_client.create_document(resource_id=user.synctera_user_id,
-                                                                        resource_type=RelatedResourceType.CUSTOMER.value,
-                                                                        doc_name=user_document.doc_name,
-                                                                        doc_file=uploaded_doc_file,
-                                                                        doc_type=user_document.doc_type,
-                                                                        idempotent_key=idempotent_key)
-
-            if not status.is_success(status_code):
-                raise CUSTOM_ERROR_LIST.SYNCTERA_REMOTE_API_ERROR_4002(doc_response.get('detail'))
-
-            return SyncteraDocuments.objects.create(document=user_document,
-                                                    synctera_document_id=doc_response.get('id'),
-                                                    synctera_document_version=doc_response.get('available_versions')[0],
-                                                    synctera_upload_response=doc_response)
-        except Exception as ex:
-            raise CUSTOM_ERROR_LIST.DB_GENERAL_ERROR_4004(str(ex))
+    def create_synctera_document(cls, user_document, uploaded_doc_file, document_type, user):
+        idempotent_key = f'{document_type}_KYC_ID_DOC{user_document.id}'
+        uploaded_doc_file.seek(0)
+        synctera_client = SyncteraClient(transport=synctera_transport)
+        doc_response, status_code = synctera_client.create_document(resource_id=user.synctera_user_id,
+                                                                    resource_type=RelatedResourceType.CUSTOMER.value,
+                                                                    doc_name=user_document.doc_name,
+                                                                    doc_file=uploaded_doc_file,
+                                                                    doc_type=user_document.doc_type,
+                                                                    idempotent_key=idempotent_key)
+
+        if not status.is_success(status_code):
+            raise CUSTOM_ERROR_LIST.SYNCTERA_REMOTE_API_ERROR_4002(doc_response.get('detail'))
+        return doc_response
+
+    @classmethod
+    def save_synctera_document(cls, user_document, doc_response):
+        return SyncteraDocuments.objects.create(document=user_document,
+                                                synctera_document_id=doc_response.get('id'),
+                                                synctera_document_version=doc_response.get('available_versions')[0],
+                                                synctera_upload_response=doc_response)
+
+    @classmethod
+    def upload_documents_to_synctera(cls, user_documents, uploaded_doc_files, document_type, user, file_statuses):
+        """
+        Submits the documents to synctera concurrently, the synctera documents are recorded from this thread. Updates
+        the status of each file and returns the combined error message of the failed ones.
+        """
+        caller_priority = call_priority.value  # BACKGROUND in a celery task, pool threads would not inherit it
+
+        def create_synctera_document(user_document, uploaded_doc_file):
+            try:
+                with priority(caller_priority):
+                    return cls.create_synctera_document(user_document, uploaded_doc_file, document_type, user)
+            finally:
+                connections.close_all()  # Only closes the connections this worker thread may have opened
+
+        with ThreadPoolExecutor(max_workers=min(settings.DOCUMENT_UPLOAD_WORKERS, len(user_documents))) as executor:
+            futures = [executor.submit(create_synctera_document, user_document, uploaded_doc_file)
+                       for user_document, uploaded_doc_file in zip(user_documents, uploaded_doc_files)]
+
+        errors = []
+        for future, user_document, file_status in zip(futures, user_documents, file_statuses):
+            try:
+                cls.save_synctera_document(user_document, future.result())
+                file_status['status'] = 'submitted'
+            except Exception as ex:
+                file_status.update(status='synctera_failed', error=str(ex))
+                errors.append(f"{file_status['file']}: {ex}")
+        return '; '.join(errors)
+
+    @classmethod
+    def discard_unsubmitted_documents(cls, user_documents, file_statuses, previous_files):
+        """
+        Undoes the recording of the files synctera did not accept, so the user can upload them again: a document the
+        upload created is deleted, one it reused gets its previous file back. Their objects are deleted from the bucket
+        unless another document refers to them. Returns the documents that were kept.
+        """
+        kept_documents, discarded_file_names = [], []
+        with transaction.atomic():
+            for user_document, file_status in zip(user_documents, file_statuses):
+                if file_status['status'] != 'synctera_failed':
+                    kept_documents.append(user_document)
+                    continue
+                discarded_file_names.append(user_document.uploaded_file_name)
+                if user_document.pk in previous_files:
+                    user_document.uploaded_file_name, user_document.content_hash = previous_files[user_document.pk]
+                    user_document.save()
+                else:
+                    user_document.delete()
+        cls.delete_orphaned_files(discarded_file_names)
+        return kept_documents
 
 
 class BDUserDocumentsUploaderViewSet(KYCDocumentsUploaderViewSet):
@@ -435,25 +705,18 @@ class BDUserDocumentsUploaderViewSet(KYCDocumentsUploaderViewSet):
         profile = user.profile
         document_type = DocumentType.IDENTITY_DOCUMENTATION.value
         document_names = BDPersonIdentityDocumentName.values()
-        response_data = []
+        response_data, file_statuses = [], []
         error_message = ""
 
+        uploads = [(doc_name, validated_data[doc_name]) for doc_name in document_names if validated_data.get(doc_name)]
+        if not uploads:
+            return response_data, file_statuses, error_message
         try:
-            for doc_name in document_names:
-                uploaded_document = validated_data.get(doc_name)
-                if uploaded_document:
-                    file_name, error_msg = cls.upload_file_to_bucket(profile=profile,
-                                                                     upload_file=uploaded_document,
-                                                                     doc_name=doc_name,
-                                                                     doc_type=document_type)
-
-                    if file_name:
-                        user_document = cls.perform_db_update(user, profile, document_type, doc_name, file_name)
-                        response_data.append(user_document)
+            response_data, file_statuses, error_message = cls.upload_documents(user, profile, document_type, uploads)
         except Exception as ex:
             error_message = str(ex)
 
-        return response_data, error_message
+        return response_data, file_statuses, error_message
 
 
 class UserSourceOfIncomeDocumentUploaderViewSet(BDUserDocumentsUploaderViewSet):
@@ -507,6 +770,7 @@ class ExternalCustomerDocumentUploaderViewSet(FileUploaderViewSet):
                 doc_name=doc_name,
                 file_name=file_name,
                 external_customer=external_customer,
+                content_hash=get_content_hash(validated_data['upload_file']),
             )
         except Exception as ex:
             return Response({'Error': str(ex)}, status=status.HTTP_400_BAD_REQUEST)
@@ -531,18 +795,6 @@ class StudentDocumentsUploaderViewSet(FileUploaderViewSet):
         
         queryset = self.filter_queryset(self.get_queryset())
         
-        # Use the serializer to get proper gcp_url values
-        serializer = DocumentsSerializer(queryset, many=True, context={'request': request})
-        serialized_data = serializer.data
-        
-        # Group documents by doc_name
-        grouped_documents = {}
-        for document_data in serialized_data:
-            doc_name = document_data.get('doc_name')
-            gcp_url = document_data.get('gcp_url', '')
-            if doc_name:
-                grouped_documents[doc_name] = gcp_url
-        
         # Use the parent's pagination if available
         page = self.paginate_queryset(queryset)
         if page is not None:
@@ -559,6 +811,18 @@ class StudentDocumentsUploaderViewSet(FileUploaderViewSet):
             
             return self.paginator.get_paginated_response([grouped_documents])
         
+        # Use the serializer to get proper gcp_url values
+        serializer = DocumentsSerializer(queryset, many=True, context={'request': request})
+        serialized_data = serializer.data
+        
+        # Group documents by doc_name
+        grouped_documents = {}
+        for document_data in serialized_data:
+            doc_name = document_data.get('doc_name')
+            gcp_url = document_data.get('gcp_url', '')
+            if doc_name:
+                grouped_documents[doc_name] = gcp_url
+        
         # If no pagination, return custom format
         response_data = {
             'count': queryset.count(),
@@ -593,9 +857,10 @@ class StudentDocumentsUploaderViewSet(FileUploaderViewSet):
         serializer = serializer_class(data=request.data, context={'request': request})
         serializer.is_valid(raise_exception=True)
 
-        response_data, error_msg = self.upload_student_onboarding_docs(serializer.validated_data, hardcoded_user)
+        response_data, file_statuses, error_msg = self.upload_student_onboarding_docs(serializer.validated_data,
+                                                                                      hardcoded_user)
         if error_msg:
-            return Response({'Error': error_msg}, status=status.HTTP_400_BAD_REQUEST)
+            return Response({'Error': error_msg, 'files': file_statuses}, status=status.HTTP_400_BAD_REQUEST)
 
         return Response(data=DocumentsSerializer(response_data, many=True).data, status=status.HTTP_200_OK)
 
@@ -609,9 +874,10 @@ class StudentDocumentsUploaderViewSet(FileUploaderViewSet):
         serializer = serializer_class(data=request.data, context={'request': request, 'id': kwargs.get('pk')})
         serializer.is_valid(raise_exception=True)
 
-        response_data, error_msg = self.upload_student_onboarding_docs(serializer.validated_data, hardcoded_user)
+        response_data, file_statuses, error_msg = self.upload_student_onboarding_docs(serializer.validated_data,
+                                                                                      hardcoded_user)
         if error_msg:
-            return Response({'Error': error_msg}, status=status.HTTP_400_BAD_REQUEST)
+            return Response({'Error': error_msg, 'files': file_statuses}, status=status.HTTP_400_BAD_REQUEST)
 
         return Response(data=DocumentsSerializer(response_data, many=True).data, status=status.HTTP_200_OK)
 
@@ -621,24 +887,14 @@ class StudentDocumentsUploaderViewSet(FileUploaderViewSet):
     def upload_student_onboarding_docs(cls, validated_data, user):
         document_type = DocumentType.STUDENT_DOCUMENTS.value
         documents = StudentDocumentName.values()
-        response_data = []
+        response_data, file_statuses = [], []
         error_message = ""
 
+        uploads = [(doc_name, validated_data[doc_name]) for doc_name in documents if validated_data.get(doc_name)]
         try:
-            for doc_name in documents:
-                uploaded_document = validated_data.get(doc_name)
-                if uploaded_document:
-                    file_name, error_msg = cls.upload_file_to_bucket(profile=user.profile,
-                                                                     upload_file=uploaded_document,
-                                                                     doc_name=doc_name,
-                                                                     doc_type=document_type)
-
-                    if file_name:
-                        user_document = cls.perform_db_update(user, user.profile, document_type, doc_name, file_name)
-                        response_data.append(user_document)
-            if len(response_data) == 0:
-                error_message = "Failed to upload files!"
+            response_data, file_statuses, error_message = cls.upload_documents(user, user.profile, document_type,
+                                                                               uploads)
         except Exception as ex:
             error_message = str(ex)
 
-        return response_data, error_message
+        return response_data, file_statuses, error_message
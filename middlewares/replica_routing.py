@@ -0,0 +1,36 @@
+from django.db import OperationalError, connections
+
+from priyomoney_client.request_config import request_config
+from priyomoney_client.routes import SAFE_METHODS, pin_user_to_master, routing_counters, replica_pool, \
+    count_connections_used, install_write_tracking
+
+
+class ReplicaRoutingMiddleware:
+    """
+    Scopes CustomRouter's per request state. Sets the request method for the only_get slave mode, and after a
+    request that wrote something pins its user to master so the next few requests don't read stale rows from slave.
+    A replica whose connection broke during the request is ejected from the replica pool.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request_config.reset()
+        request_config.request_method = request.method
+        install_write_tracking()
+        try:
+            return self.get_response(request)
+        finally:
+            if request_config.has_written and request.method not in SAFE_METHODS and request_config.user_id:
+                pin_user_to_master(request_config.user_id)
+            routing_counters.flush()
+            count_connections_used()
+            request_config.reset()
+
+    def process_exception(self, request, exception):
+        replica = request_config.replica_alias
+        if isinstance(exception, OperationalError) and replica:
+            connection = connections[replica]
+            if connection.connection is None or not connection.is_usable():
+                replica_pool.eject(replica)
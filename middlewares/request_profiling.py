@@ -0,0 +1,75 @@
+import logging
+import random
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+
+from core.permissions import is_admin
+from priyomoney_client.request_profile import request_profile, record_query, route_profile_window
+
+logger = logging.getLogger(__name__)
+
+
+class RequestProfilingMiddleware:
+    """
+    Profiles a REQUEST_PROFILE_SAMPLE_RATE share of requests: query count, repeated (N+1) queries, database, cache
+    and outbound HTTP time. The profile is logged as structured fields and summed per route for
+    RequestProfileStatsView. Admin requests (or any with DEBUG) also get it back in a Server-Timing header.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    @staticmethod
+    def is_sampled(request):
+        return random.random() < settings.REQUEST_PROFILE_SAMPLE_RATE
+
+    @staticmethod
+    def get_route(request):
+        resolver_match = getattr(request, 'resolver_match', None)
+        if resolver_match is None:
+            return f'{request.method} <unresolved>'
+        return f'{request.method} /{resolver_match.route or resolver_match.view_name}'
+
+    def __call__(self, request):
+        if not self.is_sampled(request):
+            return self.get_response(request)
+
+        request_profile.start()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(record_query))
+                response = self.get_response(request)
+
+            summary = request_profile.get_summary()
+            route = self.get_route(request)
+            if settings.DEBUG or is_admin(request):
+                response['Server-Timing'] = self.get_server_timing(summary)
+            self.log(route, response.status_code, summary)
+            route_profile_window.record(route, summary)
+            return response
+        finally:
+            request_profile.reset()
+
+    @staticmethod
+    def get_server_timing(summary):
+        metrics = [
+            f'db;dur={summary["db_ms"]};desc="{summary["queries"]} queries, {summary["duplicate_queries"]} repeated"',
+            f'cache;dur={summary["cache_ms"]};desc="{summary["cache_calls"]} calls"',
+        ]
+        metrics += [f'{service};dur={ms}' for service, ms in summary['http_ms_by_service'].items()]
+        metrics.append(f'total;dur={summary["total_ms"]}')
+        return ', '.join(metrics)
+
+    @staticmethod
+    def log(route, status_code, summary):
+        message = (f'{route} {status_code} took {summary["total_ms"]}ms: {summary["queries"]} queries '
+                   f'({summary["duplicate_queries"]} repeated) in {summary["db_ms"]}ms, cache {summary["cache_ms"]}ms, '
+                   f'http {summary["http_ms"]}ms')
+        extra = {'request_profile': {'route': route, 'status_code': status_code, **summary}}
+        if summary['duplicate_queries'] >= settings.REQUEST_PROFILE_DUPLICATE_QUERY_THRESHOLD:
+            logger.warning(f'Possible N+1 queries, {message}', extra=extra)
+        else:
+            logger.info(message, extra=extra)
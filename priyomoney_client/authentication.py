@@ -5,7 +5,7 @@ import jwt
 import json
 from django.conf import settings
 from django.contrib.auth.models import AnonymousUser
-from django.core.cache import cache
+from django.db import transaction
 from django.utils import timezone
 from requests import RequestException, HTTPError
 from rest_framework import authentication, status
@@ -13,13 +13,17 @@ from rest_framework import exceptions
 from rest_framework.exceptions import AuthenticationFailed
 
 from auth_client import PriyoClient
-from common.email import EmailSender
 from core.enums import ServiceList, ProfileApprovalStatus, SubServiceList
 from core.models import PriyoMoneyUser, TrustedDevice, UserMetaData
+from core.utility.activity import user_activity_buffer
+from core.utility.email_outbox import OutboxEmailSender, email_outbox_batch
 from custom_api_exceptions import UnAuthorized, NonInternalUser, UnrecognizedDevice, SessionExpired
 from error_handling.custom_exception import CustomErrorWithCode
 from error_handling.error_list import CUSTOM_ERROR_LIST
 from common.helpers import get_geo_location
+from priyomoney_client.cache_fill import SingleFlightCache
+from priyomoney_client.jwt_verification import verify_token_locally, revoke_token
+from priyomoney_client.request_config import request_config
 from firebase_admin import app_check
 
 device_safe_urls = [
@@ -92,10 +96,12 @@ def get_basic_profile_from_profile(profile):
 
 
 class JWTAuth(authentication.BaseAuthentication):
+    profile_cache = SingleFlightCache('profile', settings.PROFILE_CACHE_PREFIX, timeout=settings.PROFILE_CACHE_TTL,
+                                      refresh_ahead=settings.PROFILE_CACHE_REFRESH_AHEAD)
 
     @staticmethod
     def get_profile_cache_key(token):
-        return settings.PROFILE_CACHE_PREFIX + token
+        return JWTAuth.profile_cache.make_key(token)
 
     @staticmethod
     def get_user_details_from_one_auth(token):
@@ -107,16 +113,11 @@ class JWTAuth(authentication.BaseAuthentication):
         return get_basic_profile_from_profile(profile)
 
     def get_user_details_from_cache(self, token):
-        is_cache_exists = True
-        cache_token = self.get_profile_cache_key(token)
-        cached_details = cache.get(cache_token)
-        if cached_details:
-            return cached_details, is_cache_exists
-
-        is_cache_exists = False
-        details = self.get_user_details_from_one_auth(token)
-        cache.set(cache_token, details, timeout=settings.PROFILE_CACHE_TTL)
-        return details, is_cache_exists
+        """
+        Parallel requests with the same token wait for the one that is fetching the profile instead of all calling one
+        auth, a profile about to expire is refreshed in the background (PROFILE_CACHE_REFRESH_AHEAD).
+        """
+        return self.profile_cache.get(token, lambda: self.get_user_details_from_one_auth(token))
 
     def logout_user(self, token):
         try:
@@ -129,8 +130,36 @@ class JWTAuth(authentication.BaseAuthentication):
         except RequestException as e:
             log.error('Error while logging out user from one auth', exc_info=True)
 
-        cache_token = self.get_profile_cache_key(token)
-        cache.delete(cache_token)
+        # Also keeps a profile fill or refresh that is still running from caching the logged out token again
+        self.profile_cache.delete(token)
+
+        if self.is_local_verification_enabled():
+            try:
+                revoke_token(token)
+            except Exception:
+                log.error('Error while revoking token', exc_info=True)
+
+    @staticmethod
+    def is_local_verification_enabled():
+        return settings.JWT_VERIFICATION_MODE == 'local'
+
+    def get_user_from_verified_token(self, token, decoded_token):
+        """
+        Returns the user of a locally verified token, the profile is fetched from one auth only the first time a user
+        is seen. The returned flag tells whether last_active_at is recent enough to skip updating it, like a profile
+        cache hit does in remote mode.
+        """
+        one_auth_uuid = decoded_token.get(settings.AUTH_JWT_USER_ID_CLAIM)
+        priyo_money_user = PriyoMoneyUser.objects.filter(one_auth_uuid=one_auth_uuid).first() if one_auth_uuid else None
+        if priyo_money_user is None:
+            priyo_money_user, is_created = get_or_create_user(self.get_user_details_from_one_auth(token))
+            return priyo_money_user, is_created, False
+
+        user_activity_buffer.merge_into([priyo_money_user])
+        last_active_at = priyo_money_user.last_active_at
+        is_recently_active = last_active_at is not None and \
+            (timezone.now() - last_active_at).total_seconds() < settings.LAST_ACTIVE_AT_UPDATE_INTERVAL
+        return priyo_money_user, False, is_recently_active
 
     @staticmethod
     def retrieve_jwt_token_from_request(request):
@@ -211,8 +240,13 @@ class JWTAuth(authentication.BaseAuthentication):
         token, decoded_token = self.retrieve_jwt_token_from_request(request)
 
         try:
-            user, is_cached_data = self.get_user_details_from_cache(token=token)
-            priyo_money_user, is_created = get_or_create_user(user)
+            if self.is_local_verification_enabled():
+                decoded_token = verify_token_locally(token)
+                priyo_money_user, is_created, is_cached_data = self.get_user_from_verified_token(token, decoded_token)
+            else:
+                user, is_cached_data = self.get_user_details_from_cache(token=token)
+                priyo_money_user, is_created = get_or_create_user(user)
+            request_config.user_id = priyo_money_user.id
 
             if priyo_money_user.is_terminated:
                 raise AuthenticationFailed
@@ -224,12 +258,13 @@ class JWTAuth(authentication.BaseAuthentication):
                     'region_country': signup_meta_data.get('region') + " " + signup_meta_data.get('country'),
                     'http_user_agent': str(request.META.get('HTTP_USER_AGENT'))
                 }
-                UserMetaData.objects.get_or_create(user=priyo_money_user,
-                                                   signup_meta_data=json.dumps(signup_meta_data),
-                                                   http_user_agent=str(request.META.get('HTTP_USER_AGENT')))
-                email_sender = EmailSender(user=priyo_money_user, kwargs=email_data)
-                email_sender.send_user_email(context='welcome_email')
-                email_sender.send_admin_email(context='new_user_signup_admin_email', is_official=True)
+                with transaction.atomic(), email_outbox_batch():
+                    UserMetaData.objects.get_or_create(user=priyo_money_user,
+                                                       signup_meta_data=json.dumps(signup_meta_data),
+                                                       http_user_agent=str(request.META.get('HTTP_USER_AGENT')))
+                    email_sender = OutboxEmailSender(user=priyo_money_user, kwargs=email_data)
+                    email_sender.send_user_email(context='welcome_email')
+                    email_sender.send_admin_email(context='new_user_signup_admin_email', is_official=True)
         except AuthenticationFailed:
             raise CUSTOM_ERROR_LIST.SESSION_EXPIRED_4025
         except CustomErrorWithCode as ex:
@@ -245,7 +280,7 @@ class JWTAuth(authentication.BaseAuthentication):
 
         if not is_cached_data:
             priyo_money_user.last_active_at = timezone.now()
-            priyo_money_user.save(update_fields=['last_active_at'])
+            user_activity_buffer.record(priyo_money_user.id, priyo_money_user.last_active_at)
 
         self.validate_device_fingerprint(request, priyo_money_user)
         # self.validate_internal_verified_user(request, priyo_money_user)
@@ -0,0 +1,32 @@
+import time
+
+from django_redis.cache import RedisCache
+
+from priyomoney_client.request_profile import request_profile
+
+# Calls that reach Redis themselves, composite ones like get_or_set are timed through the calls they make
+PROFILED_METHODS = ('get', 'set', 'add', 'touch', 'delete', 'has_key', 'get_many', 'set_many', 'delete_many',
+                    'delete_pattern', 'incr', 'decr', 'ttl', 'expire')
+
+
+def profiled(method):
+    def wrapper(self, *args, **kwargs):
+        if not request_profile.is_sampled:
+            return method(self, *args, **kwargs)
+        started_at = time.perf_counter()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            request_profile.add_cache_call((time.perf_counter() - started_at) * 1000)
+
+    wrapper.__name__ = method.__name__
+    wrapper.__wrapped__ = method
+    return wrapper
+
+
+class ProfiledRedisCache(RedisCache):
+    """django_redis cache backend that adds the time of each call to the sampled request's profile"""
+
+
+for method_name in PROFILED_METHODS:
+    setattr(ProfiledRedisCache, method_name, profiled(getattr(RedisCache, method_name)))
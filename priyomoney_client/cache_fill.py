@@ -0,0 +1,170 @@
+import logging
+import threading
+import time
+from concurrent.futures import Future
+
+from django.core.cache import cache
+
+from priyomoney_client.counters import RedisCounters
+
+log = logging.getLogger(__name__)
+
+CACHE_FILL_COUNTERS_KEY = 'priyo-pay:cache-fill-counters'
+
+# <cache name>:hits|misses|coalesced|refreshes, shared by every SingleFlightCache
+cache_fill_counters = RedisCounters(CACHE_FILL_COUNTERS_KEY)
+
+
+class SingleFlightCache:
+    """
+    Cache in front of an expensive lookup where only one caller fills a missing key. Threads of a process wait on
+    the in-flight future of the key, other processes see a short lived lock in the cache and poll for the value the
+    lock holder stores. Values are wrapped so a cached None (e.g. "not found") is a hit.
+
+    With refresh_ahead, a hit on a value expiring within that many seconds is served as is while one caller refreshes
+    it in a background thread.
+    """
+    poll_interval = 0.05
+    deleted_timeout = 60  # longer than a fill or refresh that was already running when the key got deleted
+
+    def __init__(self, name, key_prefix, timeout, lock_timeout=10, wait_timeout=10, refresh_ahead=0):
+        self.name = name
+        self.key_prefix = key_prefix
+        self.timeout = timeout
+        self.lock_timeout = lock_timeout
+        self.wait_timeout = wait_timeout
+        self.refresh_ahead = refresh_ahead
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def make_key(self, key):
+        return f'{self.key_prefix}{key}'
+
+    def make_lock_key(self, key):
+        return f'{self.make_key(key)}:filling'
+
+    def make_result_key(self, key):
+        return f'{self.make_key(key)}:filled'
+
+    def make_deleted_key(self, key):
+        return f'{self.make_key(key)}:deleted'
+
+    def count(self, reason):
+        cache_fill_counters.increment(self.name, reason)
+        cache_fill_counters.flush()
+
+    @staticmethod
+    def read(cache_key):
+        cached = cache.get(cache_key)
+        # Anything else was stored before the key was managed here
+        return cached if isinstance(cached, dict) and 'value' in cached else None
+
+    def get_many(self, keys):
+        """Returns key -> value for the keys found in the cache"""
+        cached = cache.get_many([self.make_key(key) for key in keys])
+        return {key: cached[self.make_key(key)]['value'] for key in keys if self.make_key(key) in cached}
+
+    def set(self, key, value):
+        if self.timeout == 0:
+            return  # Not cached, waiters get the value through the result key
+        expires_at = time.time() + self.timeout if self.timeout else None
+        cache.set(self.make_key(key), {'value': value, 'expires_at': expires_at}, timeout=self.timeout)
+
+    def store_filled(self, key, value):
+        """
+        Caches a value fill returned, unless the key was deleted meanwhile (e.g. the token logged out): a fill that
+        started before the delete must not bring the value back.
+        """
+        deleted_key = self.make_deleted_key(key)
+        if cache.get(deleted_key) is not None:
+            return
+        self.set(key, value)
+        if cache.get(deleted_key) is not None:
+            cache.delete(self.make_key(key))  # Deleted between the check and the set
+
+    def delete(self, key):
+        cache.set(self.make_deleted_key(key), 1, timeout=self.deleted_timeout)
+        cache.delete_many([self.make_key(key), self.make_result_key(key)])
+
+    def get_or_fill(self, key, fill):
+        return self.get(key, fill)[0]
+
+    def get(self, key, fill):
+        """Returns the value and whether it was served without calling fill in this process"""
+        cached = self.read(self.make_key(key))
+        if cached is not None:
+            self.count('hits')
+            if self.is_due_for_refresh(cached):
+                self.refresh_in_background(key, fill)
+            return cached['value'], True
+
+        with self._lock:
+            future = self._futures.get(key)
+            is_owner = future is None
+            if is_owner:
+                future = Future()
+                self._futures[key] = future
+        if not is_owner:
+            self.count('coalesced')
+            return future.result(timeout=self.wait_timeout), True
+
+        try:
+            value, is_filled = self.fill_across_processes(key, fill)
+            future.set_result(value)
+        except Exception as ex:
+            future.set_exception(ex)
+            raise
+        finally:
+            with self._lock:
+                self._futures.pop(key, None)
+        self.count('misses' if is_filled else 'coalesced')
+        return value, not is_filled
+
+    def fill_across_processes(self, key, fill):
+        cache_key, lock_key, result_key = self.make_key(key), self.make_lock_key(key), self.make_result_key(key)
+        has_lock = cache.add(lock_key, 1, timeout=self.lock_timeout)
+        if has_lock:
+            cache.delete(result_key)  # Left by an earlier fill, waiters of this one must not take it
+        else:
+            deadline = time.monotonic() + self.wait_timeout
+            while time.monotonic() < deadline:
+                time.sleep(self.poll_interval)
+                # The result key is there whatever the cache timeout, even 0 where the value itself isn't cached
+                cached = self.read(result_key) or self.read(cache_key)
+                if cached is not None:
+                    return cached['value'], False
+                if cache.get(lock_key) is None:
+                    break  # The holder gave up without storing a value
+            log.info(f'Filling {cache_key} without the lock after waiting for it')
+
+        try:
+            value = fill()
+            self.store_filled(key, value)
+            if has_lock:
+                # Only waiting processes read it, it lives as long as they may wait
+                cache.set(result_key, {'value': value, 'expires_at': None}, timeout=self.wait_timeout)
+            return value, True
+        finally:
+            if has_lock:
+                cache.delete(lock_key)
+
+    def is_due_for_refresh(self, cached):
+        expires_at = cached.get('expires_at')
+        return bool(self.refresh_ahead) and expires_at is not None and expires_at - time.time() < self.refresh_ahead
+
+    def refresh_in_background(self, key, fill):
+        lock_key = self.make_lock_key(key)
+        if not cache.add(lock_key, 1, timeout=self.lock_timeout):
+            return  # Someone else is already refreshing it
+
+        def refresh():
+            try:
+                self.store_filled(key, fill())
+                self.count('refreshes')
+            except Exception as ex:
+                # The cached value stays until it expires, the next miss fills it again
+                log.info(f'Could not refresh {self.make_key(key)}: {ex}')
+            finally:
+                cache.delete(lock_key)
+
+        threading.Thread(target=refresh, daemon=True, name=f'{self.name}-cache-refresh').start()
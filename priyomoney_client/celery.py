@@ -1,6 +1,7 @@
 from __future__ import absolute_import, unicode_literals
 import os
 from celery import Celery
+from celery.signals import task_prerun, task_postrun
 import django
 
 # set the default Django settings module for the 'celery' program.
@@ -21,4 +22,26 @@ app.config_from_object('django.conf:settings', namespace='CELERY')
 
 # Load task modules from all registered Django app configs.
 app.conf.broker_transport_options = {'visibility_timeout': 3}
-app.autodiscover_tasks(force=True)
\ No newline at end of file
+app.autodiscover_tasks(force=True)
+
+
+@task_prerun.connect
+def reset_request_config(**kwargs):
+    # Worker threads are reused across tasks, don't let one task's routing state (e.g. master pinning) leak into the next
+    from priyomoney_client.request_config import request_config
+    request_config.reset()
+
+
+@task_prerun.connect
+def use_background_priority(task=None, **kwargs):
+    # Tasks are backfills and follow ups nobody waits on, they leave rate limited services' reserve to requests.
+    # The previous value is kept on the task's request, eager tasks run inside their caller and hand it back.
+    from priyomoney_client.rate_limit import call_priority, BACKGROUND
+    task.request.previous_call_priority = call_priority.value
+    call_priority.value = BACKGROUND
+
+
+@task_postrun.connect
+def restore_priority(task=None, **kwargs):
+    from priyomoney_client.rate_limit import call_priority, INTERACTIVE
+    call_priority.value = getattr(task.request, 'previous_call_priority', None) or INTERACTIVE
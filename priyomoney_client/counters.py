@@ -0,0 +1,46 @@
+import logging
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django_redis import get_redis_connection
+
+logger = logging.getLogger(__name__)
+
+
+class RedisCounters:
+    """
+    Per process counters, periodically added to a Redis hash shared by all processes. Fields are '<name>:<reason>',
+    incrementing costs a lock and a dict update, Redis is only written once every COUNTERS_FLUSH_INTERVAL seconds.
+    """
+
+    def __init__(self, redis_key):
+        self.redis_key = redis_key
+        self._lock = threading.Lock()
+        self._counts = Counter()
+        self._flushed_at = time.monotonic()
+
+    def increment(self, name, reason, count=1):
+        with self._lock:
+            self._counts[f'{name}:{reason}'] += count
+
+    def flush(self, force=False):
+        if not force and time.monotonic() - self._flushed_at < settings.COUNTERS_FLUSH_INTERVAL:
+            return
+        with self._lock:
+            counts, self._counts = self._counts, Counter()
+            self._flushed_at = time.monotonic()
+        if not counts:
+            return
+        try:
+            pipeline = get_redis_connection('default').pipeline(transaction=False)
+            for field, count in counts.items():
+                pipeline.hincrby(self.redis_key, field, count)
+            pipeline.execute()
+        except Exception as ex:
+            logger.warning(f'Could not flush {self.redis_key} counters: {ex}')
+
+    def get_totals(self):
+        counters = get_redis_connection('default').hgetall(self.redis_key)
+        return {field.decode(): int(count) for field, count in counters.items()}
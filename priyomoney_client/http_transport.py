@@ -0,0 +1,196 @@
+import logging
+import random
+import re
+import threading
+import time
+from bisect import bisect_left
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from priyomoney_client.request_profile import request_profile
+
+log = logging.getLogger(__name__)
+
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+RETRYABLE_STATUS_CODES = (502, 503, 504)
+TOO_MANY_REQUESTS = 429
+ID_SEGMENT = re.compile(r'/(?:\d+|[0-9a-fA-F-]{32,36})(?=/|$)')
+
+
+def get_endpoint_name(url):
+    """The url's path with ids replaced, so calls on different objects share their metrics"""
+    path = urlsplit(url).path
+    return ID_SEGMENT.sub('/{id}', path)
+
+
+class CircuitOpenError(requests.ConnectionError):
+    """Raised without calling the remote service while its circuit breaker is open"""
+
+
+class CircuitBreaker:
+    """
+    Opens after failure_threshold consecutive failures and rejects calls for reset_timeout seconds. After that a
+    single trial call is let through (half open), its success closes the circuit and its failure opens it again.
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_progress = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self._opened_at is None:
+            return 'closed'
+        if time.monotonic() - self._opened_at < self.reset_timeout:
+            return 'open'
+        return 'half_open'
+
+    def before_call(self):
+        with self._lock:
+            state = self.state
+            if state == 'open' or (state == 'half_open' and self._trial_in_progress):
+                raise CircuitOpenError(f'Circuit for {self.name} is open')
+            if state == 'half_open':
+                self._trial_in_progress = True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_progress = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial_in_progress or self._failures >= self.failure_threshold:
+                if self._opened_at is None or self._trial_in_progress:
+                    log.warning(f'Opening circuit for {self.name} after {self._failures} failures')
+                self._opened_at = time.monotonic()
+            self._trial_in_progress = False
+
+
+class LatencyHistogram:
+    """Call count, errors and a cumulative latency histogram (milliseconds) per endpoint"""
+    buckets = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, float('inf'))
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = {}
+
+    def observe(self, endpoint, latency_ms, is_error=False):
+        with self._lock:
+            stats = self._endpoints.setdefault(endpoint, {
+                'count': 0, 'errors': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'buckets': [0] * len(self.buckets),
+            })
+            stats['count'] += 1
+            stats['errors'] += int(is_error)
+            stats['total_ms'] += latency_ms
+            stats['max_ms'] = max(stats['max_ms'], latency_ms)
+            stats['buckets'][bisect_left(self.buckets, latency_ms)] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                endpoint: {
+                    'count': stats['count'],
+                    'errors': stats['errors'],
+                    'mean_ms': round(stats['total_ms'] / stats['count'], 2),
+                    'max_ms': round(stats['max_ms'], 2),
+                    'buckets': {f'le_{bucket}': count for bucket, count in zip(self.buckets, stats['buckets'])},
+                }
+                for endpoint, stats in self._endpoints.items()
+            }
+
+
+class PooledHttpTransport:
+    """
+    Thread safe HTTP transport over one keep-alive requests.Session per service. Idempotent calls are retried on
+    connection errors, timeouts and 502/503/504 with full-jitter exponential backoff, every call goes through the
+    service's circuit breaker and is timed per endpoint.
+
+    With a rate_limiter (see rate_limit.RedisTokenBucket) every attempt first takes a token. A 429 pauses the limiter
+    for its Retry-After and is retried whatever the method, the service did not process the call.
+    """
+    max_retry_after = 30
+
+    def __init__(self, name, pool_size=20, timeout=(3.05, 30), max_retries=2, backoff_base=0.2,
+                 failure_threshold=5, reset_timeout=30, rate_limiter=None):
+        self.name = name
+        self.rate_limiter = rate_limiter
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.circuit_breaker = CircuitBreaker(name, failure_threshold=failure_threshold, reset_timeout=reset_timeout)
+        self.metrics = LatencyHistogram()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get_backoff(self, attempt):
+        return random.uniform(0, self.backoff_base * 2 ** attempt)
+
+    def get_retry_after(self, response, attempt):
+        try:
+            return min(float(response.headers['Retry-After']), self.max_retry_after)
+        except (KeyError, ValueError):
+            return self.get_backoff(attempt) + 1
+
+    def observe(self, endpoint, started_at, is_error):
+        latency_ms = (time.perf_counter() - started_at) * 1000
+        self.metrics.observe(endpoint, latency_ms, is_error=is_error)
+        if request_profile.is_sampled:
+            request_profile.add_http_call(self.name, latency_ms)
+
+    def request(self, method, url, endpoint=None, timeout=None, retry=None, **kwargs):
+        """
+        endpoint names the call in metrics (defaults to the url's path without ids), retry defaults to whether the
+        method is idempotent. Error statuses are returned, not raised, except that retryable ones count as circuit
+        breaker failures.
+        """
+        method = method.upper()
+        endpoint = endpoint or get_endpoint_name(url)
+        retry = method in IDEMPOTENT_METHODS if retry is None else retry
+
+        for attempt in range(1 + self.max_retries):
+            is_last_attempt = attempt == self.max_retries
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            self.circuit_breaker.before_call()
+            started_at = time.perf_counter()
+            try:
+                response = self.session.request(method, url, timeout=timeout or self.timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as ex:
+                self.observe(endpoint, started_at, is_error=True)
+                self.circuit_breaker.record_failure()
+                if not retry or is_last_attempt:
+                    raise
+                log.info(f'{self.name} {method} {endpoint} failed ({ex}), retrying')
+                delay = self.get_backoff(attempt)
+            else:
+                is_retryable_status = response.status_code in RETRYABLE_STATUS_CODES
+                self.observe(endpoint, started_at,
+                             is_error=response.status_code >= 500 or response.status_code == TOO_MANY_REQUESTS)
+                if is_retryable_status:
+                    self.circuit_breaker.record_failure()
+                else:
+                    self.circuit_breaker.record_success()
+
+                if response.status_code == TOO_MANY_REQUESTS and self.rate_limiter is not None:
+                    delay = self.get_retry_after(response, attempt)
+                    self.rate_limiter.pause(delay)
+                    if is_last_attempt:
+                        return response
+                elif not is_retryable_status or not retry or is_last_attempt:
+                    return response
+                else:
+                    delay = self.get_backoff(attempt)
+                log.info(f'{self.name} {method} {endpoint} returned {response.status_code}, retrying')
+            time.sleep(delay)
@@ -0,0 +1,156 @@
+import hashlib
+import logging
+import threading
+import time
+
+import jwt
+from django.conf import settings
+from django.core.cache import cache
+from django_redis import get_redis_connection
+from rest_framework.exceptions import AuthenticationFailed
+
+from auth_client import PriyoClient
+
+log = logging.getLogger(__name__)
+
+
+class AuthSigningKeys:
+    """
+    Public keys of the auth service (a JWKS document), kept in process and shared through the cache. The
+    refresh_auth_signing_keys task re-fetches them periodically, processes reload from the cache once their copy is
+    older than AUTH_SIGNING_KEYS_REFRESH_INTERVAL. An unknown key id forces a fetch, at most once a minute.
+    """
+    cache_key = 'auth-signing-keys'
+    forced_fetch_interval = 60
+
+    def __init__(self):
+        self._keys = {}
+        self._loaded_at = None
+        self._forced_fetch_at = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def fetch():
+        response = PriyoClient(api_key=settings.AUTH_API_KEY, raise_on_error_status=True).get_signing_keys()
+        jwks = {'keys': response['keys']}
+        cache.set(AuthSigningKeys.cache_key, jwks, timeout=None)
+        return jwks
+
+    def load(self, force_fetch=False):
+        with self._lock:
+            jwks = None if force_fetch else cache.get(self.cache_key)
+            if jwks is None:
+                jwks = self.fetch()
+            self._keys = {key.key_id: key for key in jwt.PyJWKSet.from_dict(jwks).keys}
+            self._loaded_at = time.monotonic()
+
+    def is_stale(self):
+        return self._loaded_at is None or \
+            time.monotonic() - self._loaded_at > settings.AUTH_SIGNING_KEYS_REFRESH_INTERVAL
+
+    def get_key(self, key_id):
+        if self.is_stale():
+            self.load()
+        if key_id is None and len(self._keys) == 1:
+            return next(iter(self._keys.values()))
+
+        key = self._keys.get(key_id)
+        if key is None and time.monotonic() - self._forced_fetch_at > self.forced_fetch_interval:
+            self._forced_fetch_at = time.monotonic()
+            self.load(force_fetch=True)
+            key = self._keys.get(key_id)
+        if key is None:
+            raise AuthenticationFailed('Unknown token signing key')
+        return key
+
+
+class TokenRevocationList:
+    """
+    Revoked tokens, kept in process and pushed to every process through Redis: a revocation is stored as a key that
+    expires with the token (read by processes when they start listening) and published on a channel that a listener
+    thread in each process follows.
+    """
+    key_prefix = 'priyo-pay:auth-revoked:'
+    channel = 'priyo-pay:auth-revocations'
+
+    def __init__(self):
+        self._revoked = {}  # token id -> unix time the token expires at
+        self._listener = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_token_id(token, decoded_token):
+        return decoded_token.get('jti') or hashlib.sha256(token.encode()).hexdigest()
+
+    def revoke(self, token_id, expires_at):
+        expires_at = int(expires_at)
+        redis = get_redis_connection('default')
+        redis.set(self.key_prefix + token_id, expires_at, ex=max(expires_at - int(time.time()), 1))
+        redis.publish(self.channel, f'{token_id}:{expires_at}')
+        self._revoked[token_id] = expires_at
+
+    def is_revoked(self, token_id):
+        self.ensure_listening()
+        expires_at = self._revoked.get(token_id)
+        return expires_at is not None and expires_at > time.time()
+
+    def ensure_listening(self):
+        if self._listener is not None and self._listener.is_alive():
+            return
+        with self._lock:
+            if self._listener is not None and self._listener.is_alive():
+                return
+            redis = get_redis_connection('default')
+            # Subscribe before reading the stored revocations so nothing revoked in between is missed
+            pubsub = redis.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(self.channel)
+            for key in redis.scan_iter(match=self.key_prefix + '*', count=1000):
+                expires_at = redis.get(key)
+                if expires_at is not None:
+                    self._revoked[key.decode()[len(self.key_prefix):]] = int(expires_at)
+            self._listener = threading.Thread(target=self.listen, args=(pubsub,), daemon=True,
+                                              name='token-revocation-listener')
+            self._listener.start()
+
+    def listen(self, pubsub):
+        try:
+            for message in pubsub.listen():
+                token_id, _, expires_at = message['data'].decode().rpartition(':')
+                self._revoked[token_id] = int(expires_at)
+                self.purge_expired()
+        except Exception as ex:
+            # The next is_revoked call starts a new listener
+            log.warning(f'Token revocation listener stopped: {ex}')
+        finally:
+            pubsub.close()
+
+    def purge_expired(self):
+        now = time.time()
+        for token_id, expires_at in list(self._revoked.items()):
+            if expires_at <= now:
+                self._revoked.pop(token_id, None)
+
+
+auth_signing_keys = AuthSigningKeys()
+token_revocation_list = TokenRevocationList()
+
+
+def verify_token_locally(token):
+    """Verifies the token's signature against the auth service's keys and rejects revoked tokens"""
+    try:
+        key = auth_signing_keys.get_key(jwt.get_unverified_header(token).get('kid'))
+        decoded_token = jwt.decode(token, key=key.key, algorithms=settings.AUTH_JWT_ALGORITHMS,
+                                   options={'verify_aud': False})
+    except jwt.exceptions.InvalidTokenError:
+        raise AuthenticationFailed('Invalid token')
+
+    if token_revocation_list.is_revoked(TokenRevocationList.get_token_id(token, decoded_token)):
+        raise AuthenticationFailed('Token revoked')
+    return decoded_token
+
+
+def revoke_token(token):
+    decoded_token = jwt.decode(token, options={'verify_signature': False})
+    expires_at = decoded_token.get('expired_at') or decoded_token.get('exp') or \
+        time.time() + settings.SESSION_EXPIRED_AFTER_LOGIN_SECONDS
+    token_revocation_list.revoke(TokenRevocationList.get_token_id(token, decoded_token), expires_at)
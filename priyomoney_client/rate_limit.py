@@ -0,0 +1,139 @@
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+import requests
+from django_redis import get_redis_connection
+
+from priyomoney_client.http_transport import LatencyHistogram
+
+log = logging.getLogger(__name__)
+
+INTERACTIVE = 'interactive'
+BACKGROUND = 'background'
+
+
+class RateLimitTimeout(requests.ConnectionError):
+    """Raised without calling the remote service when no token could be taken in time"""
+
+
+# Request Scoped Variables
+class CallPriority(threading.local):
+    value = INTERACTIVE
+
+
+call_priority = CallPriority()
+
+
+@contextmanager
+def priority(value):
+    """Calls made inside the block (on this thread) take tokens with this priority, e.g. BACKGROUND for backfills"""
+    previous, call_priority.value = call_priority.value, value
+    try:
+        yield
+    finally:
+        call_priority.value = previous
+
+
+class RedisTokenBucket:
+    """
+    Token bucket shared by every process through Redis: rate tokens per second up to burst. Interactive calls may
+    empty the bucket, background calls only take a token while more than background_reserve of the burst is left, so
+    interactive calls get ahead of a backfill that keeps the bucket low. A 429 from the service pauses the bucket
+    for every process until its Retry-After has passed.
+    """
+    key_prefix = 'priyo-pay:rate-limit:'
+    # Returns the seconds to wait before asking again, 0 when a token was taken
+    take_script = """
+        local now_parts = redis.call('TIME')
+        local now = tonumber(now_parts[1]) + tonumber(now_parts[2]) / 1000000
+        local rate, burst, reserve = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+
+        local paused_until = tonumber(redis.call('GET', KEYS[2]) or 0)
+        if paused_until > now then
+            return tostring(paused_until - now)
+        end
+
+        local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+        local tokens = tonumber(state[1]) or burst
+        local updated_at = tonumber(state[2]) or now
+        tokens = math.min(burst, tokens + math.max(0, now - updated_at) * rate)
+
+        local wait = 0
+        if tokens - 1 >= reserve then
+            tokens = tokens - 1
+        else
+            wait = (reserve + 1 - tokens) / rate
+        end
+        redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated_at', tostring(now))
+        redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 60)
+        return tostring(wait)
+    """
+
+    def __init__(self, name, rate, burst, background_reserve=0.3, timeouts=None):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.reserves = {INTERACTIVE: 0, BACKGROUND: burst * background_reserve}
+        self.timeouts = timeouts or {INTERACTIVE: 10, BACKGROUND: 300}  # seconds to wait for a token
+        self.wait_metrics = LatencyHistogram()  # per priority
+        self._script = None
+
+    @property
+    def tokens_key(self):
+        return f'{self.key_prefix}{self.name}'
+
+    @property
+    def paused_key(self):
+        return f'{self.key_prefix}{self.name}:paused-until'
+
+    def take(self, reserve):
+        if self._script is None:
+            self._script = get_redis_connection('default').register_script(self.take_script)
+        return float(self._script(keys=[self.tokens_key, self.paused_key], args=[self.rate, self.burst, reserve]))
+
+    def acquire(self, value=None):
+        """Waits for a token, up to the priority's timeout"""
+        value = value or call_priority.value
+        started_at = time.monotonic()
+        deadline = started_at + self.timeouts[value]
+        try:
+            while True:
+                try:
+                    wait = self.take(self.reserves[value])
+                except Exception as ex:
+                    # Without Redis the service's own limit is the only one left
+                    log.warning(f'Could not take a {self.name} rate limit token: {ex}')
+                    return
+                if wait <= 0:
+                    return
+                if time.monotonic() + wait > deadline:
+                    raise RateLimitTimeout(f'No {self.name} rate limit token within {self.timeouts[value]}s')
+                # Jitter keeps waiting workers from asking again all at once
+                time.sleep(min(wait, 1) * random.uniform(1, 1.2))
+        finally:
+            self.wait_metrics.observe(value, (time.monotonic() - started_at) * 1000)
+
+    def pause(self, seconds):
+        try:
+            redis = get_redis_connection('default')
+            paused_until = float(redis.time()[0]) + seconds
+            current = float(redis.get(self.paused_key) or 0)
+            if paused_until > current:
+                redis.set(self.paused_key, paused_until, ex=max(int(seconds) + 1, 1))
+        except Exception as ex:
+            log.warning(f'Could not pause the {self.name} rate limit: {ex}')
+
+    def get_status(self):
+        redis = get_redis_connection('default')
+        tokens = redis.hget(self.tokens_key, 'tokens')
+        paused_until = redis.get(self.paused_key)
+        return {
+            'rate': self.rate,
+            'burst': self.burst,
+            'tokens': round(float(tokens), 2) if tokens is not None else self.burst,
+            'paused_for': max(round(float(paused_until) - float(redis.time()[0]), 2), 0) if paused_until else 0,
+            'waits': self.wait_metrics.snapshot(),  # as seen by the serving process
+        }
@@ -4,7 +4,14 @@ import threading
 # Request Scoped Variables
 class RequestConfig(threading.local):
     is_slave_allowed = None
+    request_method = None
+    user_id = None
+    has_written = False  # set by routes.track_write on the first executed write, reads after it stay on master
+    is_user_pinned = None  # memoized per request, see routes.is_user_pinned_to_master
+    replica_alias = None  # slave chosen for this request, '' when none was available
 
+    def reset(self):
+        self.__dict__.clear()
 
-request_config = RequestConfig()
 
+request_config = RequestConfig()
@@ -0,0 +1,150 @@
+import logging
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django_redis import get_redis_connection
+
+logger = logging.getLogger(__name__)
+
+REQUEST_PROFILE_KEY_PREFIX = 'priyo-pay:request-profile:'
+PROFILE_FIELDS = ('total_ms', 'db_ms', 'cache_ms', 'http_ms', 'queries', 'duplicate_queries')
+
+
+# Request Scoped Variables, only filled while is_sampled. Work done on other threads (thread pools) is not counted.
+# SQL is timed by record_query, cache calls by cache_backends.ProfiledRedisCache and outbound HTTP by
+# PooledHttpTransport, calls that go around them (direct Redis connections, GCS) are not counted.
+class RequestProfile(threading.local):
+    is_sampled = False
+
+    def start(self):
+        self.__dict__.clear()
+        self.is_sampled = True
+        self.started_at = time.perf_counter()
+        self.db_ms = 0.0
+        self.cache_ms = 0.0
+        self.cache_calls = 0
+        self.http_ms = Counter()  # service -> milliseconds
+        self.http_calls = Counter()
+        self.queries = Counter()  # sql without its params -> times it ran
+
+    def reset(self):
+        self.__dict__.clear()
+
+    def add_query(self, sql, duration_ms):
+        self.queries[sql] += 1
+        self.db_ms += duration_ms
+
+    def add_cache_call(self, duration_ms):
+        self.cache_calls += 1
+        self.cache_ms += duration_ms
+
+    def add_http_call(self, service, duration_ms):
+        self.http_calls[service] += 1
+        self.http_ms[service] += duration_ms
+
+    @property
+    def query_count(self):
+        return sum(self.queries.values())
+
+    @property
+    def duplicate_query_count(self):
+        """Queries that repeat an earlier statement of the request with other params, the N+1 pattern"""
+        return sum(count - 1 for count in self.queries.values() if count > 1)
+
+    def get_summary(self):
+        total_ms = (time.perf_counter() - self.started_at) * 1000
+        repeated = [(count, sql) for sql, count in self.queries.most_common(3) if count > 1]
+        return {
+            'total_ms': round(total_ms, 2),
+            'db_ms': round(self.db_ms, 2),
+            'queries': self.query_count,
+            'duplicate_queries': self.duplicate_query_count,
+            'most_repeated_queries': [{'count': count, 'sql': sql[:300]} for count, sql in repeated],
+            'cache_ms': round(self.cache_ms, 2),
+            'cache_calls': self.cache_calls,
+            'http_ms': round(sum(self.http_ms.values()), 2),
+            'http_calls': dict(self.http_calls),
+            'http_ms_by_service': {service: round(ms, 2) for service, ms in self.http_ms.items()},
+        }
+
+
+request_profile = RequestProfile()
+
+
+def record_query(execute, sql, params, many, context):
+    """connection.execute_wrapper hook, times the statement for the sampled request"""
+    started_at = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        request_profile.add_query(sql, (time.perf_counter() - started_at) * 1000)
+
+
+class RouteProfileWindow:
+    """
+    Sampled request profiles summed per route into one Redis hash per minute, kept for the rolling window. The
+    slowest single request of a route in a minute is kept in a sorted set next to it.
+    """
+
+    def __init__(self, key_prefix=REQUEST_PROFILE_KEY_PREFIX):
+        self.key_prefix = key_prefix
+
+    def key(self, minute, suffix='totals'):
+        return f'{self.key_prefix}{minute}:{suffix}'
+
+    @staticmethod
+    def current_minute():
+        return int(time.time() // 60)
+
+    def record(self, route, summary):
+        minute = self.current_minute()
+        expire_seconds = (settings.REQUEST_PROFILE_WINDOW_MINUTES + 1) * 60
+        try:
+            pipeline = get_redis_connection('default').pipeline(transaction=False)
+            pipeline.hincrby(self.key(minute), f'{route}|count', 1)
+            for field in PROFILE_FIELDS:
+                pipeline.hincrbyfloat(self.key(minute), f'{route}|{field}', summary[field])
+            pipeline.zadd(self.key(minute, 'max'), {route: summary['total_ms']}, gt=True)
+            pipeline.expire(self.key(minute), expire_seconds)
+            pipeline.expire(self.key(minute, 'max'), expire_seconds)
+            pipeline.execute()
+        except Exception as ex:
+            logger.warning(f'Could not record request profile of {route}: {ex}')
+
+    def get_slowest_routes(self, minutes=None, limit=20, order_by='mean_ms'):
+        """Routes over the last minutes, slowest first by order_by (mean_ms, max_ms or any summed field)"""
+        minutes = min(minutes or settings.REQUEST_PROFILE_WINDOW_MINUTES, settings.REQUEST_PROFILE_WINDOW_MINUTES)
+        last_minute = self.current_minute()
+        window = range(last_minute - minutes + 1, last_minute + 1)
+
+        pipeline = get_redis_connection('default').pipeline(transaction=False)
+        for minute in window:
+            pipeline.hgetall(self.key(minute))
+            pipeline.zrange(self.key(minute, 'max'), 0, -1, withscores=True)
+        results = pipeline.execute()
+
+        routes = {}
+        for totals, maximums in zip(results[::2], results[1::2]):
+            for field, value in totals.items():
+                route, _, name = field.decode().rpartition('|')
+                stats = routes.setdefault(route, {'route': route, 'count': 0, 'max_ms': 0.0,
+                                                  **{name: 0.0 for name in PROFILE_FIELDS}})
+                stats[name] += float(value)
+            for route, max_ms in maximums:
+                stats = routes.get(route.decode())
+                if stats is not None:
+                    stats['max_ms'] = max(stats['max_ms'], max_ms)
+
+        for stats in routes.values():
+            count = int(stats['count']) or 1
+            stats['count'] = int(stats['count'])
+            stats['mean_ms'] = round(stats['total_ms'] / count, 2)
+            stats['mean_queries'] = round(stats['queries'] / count, 2)
+            for field in PROFILE_FIELDS:
+                stats[field] = round(stats[field], 2)
+        return sorted(routes.values(), key=lambda stats: stats.get(order_by, 0), reverse=True)[:limit]
+
+
+route_profile_window = RouteProfileWindow()
@@ -1,10 +1,27 @@
+import logging
+import os
+import random
 import sys
+import threading
+import time
 from enum import Enum
 
 from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
 
+from priyomoney_client.counters import RedisCounters
 from priyomoney_client.request_config import request_config
 
+logger = logging.getLogger(__name__)
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+WRITE_STATEMENTS = ('INSERT', 'UPDATE', 'DELETE')
+ROUTING_COUNTERS_KEY = 'priyo-pay:db-routing-counters'
+CONNECTION_COUNTERS_KEY = 'priyo-pay:db-connection-counters'
+
 
 class SlaveDBMode(Enum):
     ALWAYS = 'always'
@@ -12,25 +29,252 @@ class SlaveDBMode(Enum):
     ONLY_GET = 'only_get'
 
 
+NOT_SAMPLED = object()  # ReplicaLagMonitor.get_lag of a replica without a fresh sample
+
+
+class ReplicaLagMonitor:
+    """
+    Replication lag of each replica as last sampled by ReplicaPool's refresher thread, so a request never runs the
+    lag query itself. Each replica has its own lock, a slow replica doesn't hold up sampling the others.
+    """
+    lag_query = ("SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+                 "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END")
+    # A sample older than this many intervals means the refresher is stuck, it is not trusted any more
+    max_sample_age_intervals = 3
+
+    def __init__(self):
+        self._locks_lock = threading.Lock()
+        self._locks = {}  # alias -> lock held while the replica is sampled
+        self._samples = {}  # alias -> (sampled_at, lag in seconds or None if the replica could not be queried)
+
+    def get_lock(self, alias):
+        with self._locks_lock:
+            return self._locks.setdefault(alias, threading.Lock())
+
+    def sample(self, alias):
+        with self.get_lock(alias):
+            try:
+                with connections[alias].cursor() as cursor:
+                    cursor.execute(self.lag_query)
+                    lag = float(cursor.fetchone()[0])
+            except Exception as ex:
+                logger.warning(f'Could not sample replication lag of {alias}: {ex}')
+                connections[alias].close()
+                lag = None
+            self._samples[alias] = (time.monotonic(), lag)
+            return lag
+
+    def get_lag(self, alias):
+        """Lag in seconds, None if the last sample failed or NOT_SAMPLED when there is no fresh sample yet"""
+        sampled_at, lag = self._samples.get(alias, (None, None))
+        max_age = settings.REPLICA_LAG_SAMPLE_INTERVAL * self.max_sample_age_intervals
+        if sampled_at is None or time.monotonic() - sampled_at > max_age:
+            return NOT_SAMPLED
+        return lag
+
+    def is_caught_up(self, alias):
+        lag = self.get_lag(alias)
+        return lag is not NOT_SAMPLED and lag is not None and lag <= settings.REPLICA_MAX_LAG_SECONDS
+
+    def get_samples(self):
+        return {alias: lag for alias, (_, lag) in self._samples.items()}
+
+
+class ReplicaPool:
+    """
+    Weighted pool of slave aliases (SLAVE_DB_WEIGHTS). A background thread samples the lag of every replica each
+    REPLICA_LAG_SAMPLE_INTERVAL seconds. A replica that fails a sample or a connection is ejected for
+    REPLICA_EJECT_SECONDS, a lagging one or one without a sample yet is skipped until it catches up.
+    """
+
+    def __init__(self, lag_monitor):
+        self.lag_monitor = lag_monitor
+        self._ejected_until = {}  # alias -> monotonic time the replica may be used again
+        self._refresher_lock = threading.Lock()
+        self._refresher_pid = None  # threads don't survive a fork, a worker starts its own
+
+    @property
+    def weights(self):
+        return settings.SLAVE_DB_WEIGHTS
+
+    def eject(self, alias):
+        if alias in self.weights:
+            logger.warning(f'Ejecting replica {alias} for {settings.REPLICA_EJECT_SECONDS}s')
+            self._ejected_until[alias] = time.monotonic() + settings.REPLICA_EJECT_SECONDS
+
+    def is_ejected(self, alias):
+        return self._ejected_until.get(alias, 0) > time.monotonic()
+
+    def refresh(self):
+        for alias, weight in self.weights.items():
+            if weight > 0 and self.lag_monitor.sample(alias) is None:
+                # A replica we couldn't even sample is most likely down
+                self.eject(alias)
+
+    def run_refresher(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception as ex:
+                logger.warning(f'Could not refresh the replica pool: {ex}')
+            time.sleep(settings.REPLICA_LAG_SAMPLE_INTERVAL)
+
+    def start_refresher(self):
+        if self._refresher_pid == os.getpid():
+            return
+        with self._refresher_lock:
+            if self._refresher_pid == os.getpid():
+                return
+            threading.Thread(target=self.run_refresher, name='replica-lag-refresher', daemon=True).start()
+            self._refresher_pid = os.getpid()
+
+    def is_available(self, alias):
+        return not self.is_ejected(alias) and self.lag_monitor.is_caught_up(alias)
+
+    def choose(self):
+        self.start_refresher()
+        available = {alias: weight for alias, weight in self.weights.items() if weight > 0 and self.is_available(alias)}
+        if not available:
+            return None
+        return random.choices(list(available), weights=list(available.values()))[0]
+
+    def get_status(self):
+        samples = self.lag_monitor.get_samples()
+        return {
+            alias: {
+                'weight': weight,
+                'ejected': self.is_ejected(alias),
+                'sampled': alias in samples,
+                'lag_seconds': samples.get(alias),
+            }
+            for alias, weight in self.weights.items()
+        }
+
+
+replica_lag_monitor = ReplicaLagMonitor()
+replica_pool = ReplicaPool(replica_lag_monitor)
+routing_counters = RedisCounters(ROUTING_COUNTERS_KEY)
+connection_counters = RedisCounters(CONNECTION_COUNTERS_KEY)
+
+
+@receiver(connection_created, dispatch_uid='count_db_connection_created')
+def count_connection_created(sender, connection, **kwargs):
+    connection_counters.increment(connection.alias, 'connects')
+
+
+def count_connections_used():
+    """Called at the end of a request, before Django closes connections that are not persistent"""
+    for connection in connections.all():
+        if connection.connection is not None:
+            connection_counters.increment(connection.alias, 'requests')
+    connection_counters.flush()
+
+
+def get_connection_stats():
+    """connects/requests per alias, a reuse ratio close to 1 means requests rarely pay for a new connection"""
+    stats = {}
+    for field, count in connection_counters.get_totals().items():
+        alias, _, name = field.rpartition(':')
+        stats.setdefault(alias, {'connects': 0, 'requests': 0})[name] = count
+    for alias_stats in stats.values():
+        requests = alias_stats['requests']
+        alias_stats['reuse_ratio'] = round(1 - min(alias_stats['connects'], requests) / requests, 3) if requests else None
+    return {'mode': settings.DB_CONNECTION_MODE} | stats
+
+
+def track_write(execute, sql, params, many, context):
+    """
+    execute_wrapper hook on master. Only a statement that changes rows makes the request a writing one, the SELECT of
+    a get_or_create that finds its row goes through db_for_write too but must not keep the request off the replica.
+    """
+    result = execute(sql, params, many, context)
+    if sql.lstrip()[:6].upper() in WRITE_STATEMENTS:
+        request_config.has_written = True
+    return result
+
+
+def install_write_tracking():
+    """Adds track_write to this thread's master connection, first so execute_wrapper blocks can still pop theirs"""
+    connection = connections[settings.MASTER_DB_KEY]
+    if track_write not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, track_write)
+
+
+def get_user_pin_key(user_id):
+    return f'db-master-pin:user:{user_id}'
+
+
+def pin_user_to_master(user_id):
+    """Sends the user's reads to master for a short while so the next requests see what this one wrote"""
+    cache.set(get_user_pin_key(user_id), True, timeout=settings.REPLICA_USER_PIN_SECONDS)
+
+
+def is_user_pinned_to_master(user_id):
+    return cache.get(get_user_pin_key(user_id), False)
+
+
+def is_pinned_to_master():
+    if request_config.has_written:
+        return True
+    if request_config.user_id is None:
+        return False
+    if request_config.is_user_pinned is None:
+        request_config.is_user_pinned = is_user_pinned_to_master(request_config.user_id)
+    return request_config.is_user_pinned
+
+
 class CustomRouter(object):
     """A router that sets up a simple master/slave configuration"""
     """And also allows to enable/disable slave db"""
+    """Reads stay on master after a write in the same request, for a pinned user, or while the slave is lagging"""
+
+    @staticmethod
+    def is_master_only():
+        return 'pytest' in sys.modules or 'migrate' in sys.argv
 
     @classmethod
     def is_slave_allowed(cls):
         if request_config.is_slave_allowed is not None:
             return request_config.is_slave_allowed
+        if settings.ENABLE_SLAVE_DB == SlaveDBMode.ONLY_GET.value:
+            return request_config.request_method in SAFE_METHODS
         return settings.ENABLE_SLAVE_DB == SlaveDBMode.ALWAYS.value
 
+    @classmethod
+    def get_replica(cls):
+        """
+        Picks a replica from the pool once per request and sticks to it, so one request never reads from two
+        replicas. If the chosen replica becomes unavailable the rest of the request reads from master.
+        """
+        if request_config.replica_alias is None:
+            request_config.replica_alias = replica_pool.choose() or ''
+        elif request_config.replica_alias and replica_pool.is_ejected(request_config.replica_alias):
+            request_config.replica_alias = ''
+        return request_config.replica_alias or None
+
     def db_for_read(self, model, **hints):
         """Point all read operations to slave, if _slave_allowed is True and not migrate"""
-        if 'pytest' in sys.modules or 'migrate' in sys.argv or not self.is_slave_allowed():
-            return 'default'
-        return 'priyo_pay_slave'
+        if self.is_master_only():
+            return settings.MASTER_DB_KEY
+
+        if not self.is_slave_allowed():
+            master_read_reason = 'not_allowed'
+        elif is_pinned_to_master():
+            master_read_reason = 'pinned'
+        else:
+            replica = self.get_replica()
+            if replica:
+                routing_counters.increment(replica, 'read')
+                return replica
+            master_read_reason = 'no_replica_available'
+
+        routing_counters.increment(settings.MASTER_DB_KEY, f'read_{master_read_reason}')
+        return settings.MASTER_DB_KEY
 
     def db_for_write(self, model, **hints):
-        """Point all write operations to the primary/default"""
-        return 'default'
+        """Point all write operations to the primary/default, has_written is set by track_write once a row changes"""
+        routing_counters.increment(settings.MASTER_DB_KEY, 'write')
+        return settings.MASTER_DB_KEY
 
     def allow_relation(self, obj1, obj2, **hints):
         """Allow any relation between two objects in the db pool"""
@@ -41,6 +41,7 @@ INSTALLED_APPS = [
     'django.contrib.contenttypes',
     'django.contrib.humanize',
     'django.contrib.messages',
+    'django.contrib.postgres',
     'django.contrib.sessions',
     'django.contrib.staticfiles',
     'django_celery_results',
@@ -96,7 +97,13 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 STATICFILES_STORAGE = "whitenoise.storage.CompressedManifestStaticFilesStorage"
 
 DATA_UPLOAD_MAX_MEMORY_SIZE = 24 * 1024 * 1024
-FILE_UPLOAD_MAX_MEMORY_SIZE = 24 * 1024 * 1024
+# Uploaded files above this are spooled to a temporary file instead of being kept in worker memory
+FILE_UPLOAD_MAX_MEMORY_SIZE = int(os.getenv('FILE_UPLOAD_MAX_MEMORY_SIZE', 2.5 * 1024 * 1024))
+FILE_UPLOAD_TEMP_DIR = os.getenv('FILE_UPLOAD_TEMP_DIR', None)
+FILE_UPLOAD_HANDLERS = [
+    'file_uploader.upload_handlers.ChecksumMemoryFileUploadHandler',
+    'file_uploader.upload_handlers.ChecksumTemporaryFileUploadHandler',
+]
 
 #firebase admin configuration
 FIREBASE_CREDENTIAL = os.getenv('FIREBASE_CREDENTIAL', None)
@@ -109,8 +116,19 @@ DEFAULT_FILE_STORAGE = 'storages.backends.gcloud.GoogleCloudStorage'
 GS_BUCKET_NAME = os.getenv('GS_BUCKET_NAME', 'priyo_pay_dev_docs')
 GS_BUCKET_CREDENTIAL = os.getenv('GS_BUCKET_CREDENTIAL', None)
 GS_EXPIRATION = timedelta(minutes=60)
+# Signed URLs are cached and reused until this many seconds before they expire
+GS_SIGNED_URL_REFRESH_MARGIN = int(os.getenv('GS_SIGNED_URL_REFRESH_MARGIN', 5 * 60))
+GS_SIGNING_WORKERS = int(os.getenv('GS_SIGNING_WORKERS', 8))
 # User provided file name will be kept 172 characters. We save the file name in DB with folder name.
 GS_BUCKET_FILE_NAME_MAX_CHAR = 172
+# Size of the resumable upload chunks sent to the bucket, must be a multiple of 256 KB
+GS_UPLOAD_CHUNK_SIZE = int(os.getenv('GS_UPLOAD_CHUNK_SIZE', 8 * 256 * 1024))
+# Lifetime in seconds of the signed URLs clients upload documents to the bucket with
+GS_UPLOAD_URL_EXPIRATION = int(os.getenv('GS_UPLOAD_URL_EXPIRATION', 15 * 60))
+# Returned for profile image thumbnails that are still being generated
+PROFILE_IMAGE_PLACEHOLDER_URL = os.getenv('PROFILE_IMAGE_PLACEHOLDER_URL', '')
+# Files of one multi-document submission uploaded at the same time
+DOCUMENT_UPLOAD_WORKERS = int(os.getenv('DOCUMENT_UPLOAD_WORKERS', 4))
 
 if GS_BUCKET_CREDENTIAL is None:
     GS_CREDENTIALS = None
@@ -130,8 +148,10 @@ MIDDLEWARE = [
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 
+    'middlewares.replica_routing.ReplicaRoutingMiddleware',
     'middlewares.database_router.DatabaseRouteSelectionMiddleware',
     'middlewares.authentication.AuthMiddleware',
+    'middlewares.request_profiling.RequestProfilingMiddleware',
     'middlewares.api_logger.LoggingMiddleware',
     'middlewares.country_guard.CountryGuardMiddleware',
     'middlewares.otp_guard.OTPGuardMiddleware',
@@ -200,9 +220,36 @@ DATABASES = {
     },
 }
 
+# Additional replicas of SLAVE_DB_KEY as 'host[:port]' separated by commas, added as priyo_pay_slave_2, _3, ...
+for index, replica_host in enumerate(filter(None, os.getenv('SLAVE_DB_EXTRA_HOSTS', '').split(',')), start=2):
+    replica_host, _, replica_port = replica_host.strip().partition(':')
+    DATABASES[f'{SLAVE_DB_KEY}_{index}'] = DATABASES[SLAVE_DB_KEY] | {
+        'HOST': replica_host,
+        'PORT': replica_port or DATABASES[SLAVE_DB_KEY]['PORT'],
+    }
+SLAVE_DB_KEYS = [alias for alias in DATABASES if alias.startswith(SLAVE_DB_KEY)]
+
+# 'per_request' (default) opens a connection per request. Opt in profiles: 'persistent' keeps them for
+# DB_CONN_MAX_AGE seconds with health checks, size max_connections for workers x threads x aliases before enabling it.
+# 'pgbouncer' is 'persistent' against a pgbouncer in transaction pooling mode. All select_for_update calls run inside
+# transaction.atomic so row locks live within one pooled transaction, server side cursors (iterator()) don't.
+DB_CONNECTION_MODE = os.getenv('DB_CONNECTION_MODE', 'per_request')
+DB_CONN_MAX_AGE = int(os.getenv('DB_CONN_MAX_AGE', 60))
+DB_CONNECTION_PROFILES = {
+    'per_request': {'CONN_MAX_AGE': 0},
+    'persistent': {'CONN_MAX_AGE': DB_CONN_MAX_AGE, 'CONN_HEALTH_CHECKS': True},
+    'pgbouncer': {'CONN_MAX_AGE': DB_CONN_MAX_AGE, 'CONN_HEALTH_CHECKS': True, 'DISABLE_SERVER_SIDE_CURSORS': True},
+}
+for db_config in DATABASES.values():
+    db_config.update(DB_CONNECTION_PROFILES[DB_CONNECTION_MODE])
+# Comma separated weights in SLAVE_DB_KEYS order, e.g. '1,3' sends 3 of 4 requests to the second replica
+SLAVE_DB_WEIGHTS = dict(zip(SLAVE_DB_KEYS, [int(weight) for weight in
+                                            filter(None, os.getenv('SLAVE_DB_WEIGHTS', '').split(','))] +
+                            [1] * len(SLAVE_DB_KEYS)))
+
 CACHES = {
     "default": {
-        "BACKEND": "django_redis.cache.RedisCache",
+        "BACKEND": "priyomoney_client.cache_backends.ProfiledRedisCache",  # RedisCache timed for request profiles
         "LOCATION": get_redis_url() + "/1",
         "KEY_PREFIX": 'priyo-pay',
         "TIMEOUT": None,
@@ -215,6 +262,18 @@ CACHES = {
 DEFAULT_AUTO_FIELD = 'django.db.models.AutoField'
 DATABASE_ROUTERS = ['priyomoney_client.routes.CustomRouter', ]
 ENABLE_SLAVE_DB = os.getenv('ENABLE_SLAVE_DB')   # 'always', 'never' or 'only_get', only used for CustomRouter
+REPLICA_LAG_SAMPLE_INTERVAL = float(os.getenv('REPLICA_LAG_SAMPLE_INTERVAL', 5))  # seconds between lag samples
+REPLICA_MAX_LAG_SECONDS = float(os.getenv('REPLICA_MAX_LAG_SECONDS', 2))  # reads go to master above this lag
+REPLICA_USER_PIN_SECONDS = int(os.getenv('REPLICA_USER_PIN_SECONDS', 10))  # a user reads from master after a write
+REPLICA_EJECT_SECONDS = int(os.getenv('REPLICA_EJECT_SECONDS', 30))  # a failed replica is skipped this long
+# Seconds between writes of counters.RedisCounters (routing, connection and cache fill counters) to Redis
+COUNTERS_FLUSH_INTERVAL = int(os.getenv('COUNTERS_FLUSH_INTERVAL', os.getenv('DB_ROUTING_COUNTERS_FLUSH_INTERVAL', 30)))
+
+# Share of requests profiled by RequestProfilingMiddleware (0 to 1), their per route totals are kept this many minutes
+REQUEST_PROFILE_SAMPLE_RATE = float(os.getenv('REQUEST_PROFILE_SAMPLE_RATE', 0.01))
+REQUEST_PROFILE_WINDOW_MINUTES = int(os.getenv('REQUEST_PROFILE_WINDOW_MINUTES', 60))
+# A profiled request repeating this many queries is logged as a warning
+REQUEST_PROFILE_DUPLICATE_QUERY_THRESHOLD = int(os.getenv('REQUEST_PROFILE_DUPLICATE_QUERY_THRESHOLD', 10))
 
 
 # Password validation
@@ -400,6 +459,10 @@ SEND_FAKE_OTP = os.environ['SEND_FAKE_OTP'].lower() == 'true'
 
 AUTH_API_BASE = os.environ['AUTH_API_BASE']
 AUTH_API_KEY = os.environ['AUTH_API_KEY']
+AUTH_API_POOL_SIZE = int(os.getenv('AUTH_API_POOL_SIZE', 20))  # keep-alive connections per process
+AUTH_API_CONNECT_TIMEOUT = float(os.getenv('AUTH_API_CONNECT_TIMEOUT', 3.05))
+AUTH_API_BATCH_WORKERS = int(os.getenv('AUTH_API_BATCH_WORKERS', 8))  # concurrent calls of one batch profile lookup
+AUTH_PROFILE_BY_UUID_TTL = int(os.getenv('AUTH_PROFILE_BY_UUID_TTL', 300))
 OWN_BASE_URL = os.environ['OWN_BASE_URL']
 CLIENT_SIDE_BASE_URL = os.environ['CLIENT_SIDE_BASE_URL']
 ADMIN_SIDE_BASE_URL = os.environ['ADMIN_SIDE_BASE_URL']
@@ -407,6 +470,13 @@ ADMIN_SIDE_BASE_URL = os.environ['ADMIN_SIDE_BASE_URL']
 SYNCTERA_TENANT = os.getenv('SYNCTERA_TENANT')
 SYNCTERA_BASE_URL = os.getenv('SYNCTERA_BASE_URL')
 SYNCTERA_API_KEY = os.getenv('SYNCTERA_API_KEY')
+SYNCTERA_POOL_SIZE = int(os.getenv('SYNCTERA_POOL_SIZE', 20))  # keep-alive connections per process
+SYNCTERA_CONNECT_TIMEOUT = float(os.getenv('SYNCTERA_CONNECT_TIMEOUT', 3.05))
+# Calls per second shared by all processes, and how many can go at once after a quiet period
+SYNCTERA_RATE_LIMIT = float(os.getenv('SYNCTERA_RATE_LIMIT', 20))
+SYNCTERA_RATE_LIMIT_BURST = int(os.getenv('SYNCTERA_RATE_LIMIT_BURST', 40))
+# Share of the burst that background (backfill) calls leave to interactive ones
+SYNCTERA_RATE_LIMIT_BACKGROUND_RESERVE = float(os.getenv('SYNCTERA_RATE_LIMIT_BACKGROUND_RESERVE', 0.3))
 SYNCTERA_SAVINGS_ACCOUNT_TEMPLATE = os.getenv('SYNCTERA_SAVINGS_ACCOUNT_TEMPLATE')
 SYNCTERA_CHECKING_ACCOUNT_TEMPLATE = os.getenv('SYNCTERA_CHECKING_ACCOUNT_TEMPLATE')
 
@@ -433,6 +503,20 @@ CELERY_CACHE_BACKEND = 'django-cache'
 CELERY_WORKER_MAX_RETRY = int(os.getenv('CELERY_WORKER_MAX_RETRY'))
 CELERY_WORKER_RETRY_COUNTDOWN = int(os.getenv('CELERY_WORKER_RETRY_COUNTDOWN'))
 CELERY_BEAT_SCHEDULER = 'django_celery_beat.schedulers:DatabaseScheduler'
+CELERY_BEAT_SCHEDULE = {
+    'refresh-auth-signing-keys': {
+        'task': 'core.tasks.refresh_auth_signing_keys',
+        'schedule': int(os.getenv('AUTH_SIGNING_KEYS_REFRESH_INTERVAL', 300)),
+    },
+    'flush-user-activity': {
+        'task': 'core.tasks.flush_user_activity',
+        'schedule': int(os.getenv('LAST_ACTIVE_AT_FLUSH_INTERVAL', 30)),  # upper bound of last_active_at staleness
+    },
+    'drain-email-outbox': {
+        'task': 'core.tasks.drain_email_outbox',
+        'schedule': int(os.getenv('EMAIL_OUTBOX_DRAIN_INTERVAL', 30)),  # picks up retries and missed drains
+    },
+}
 CELERY_WORKER_HIJACK_ROOT_LOGGER = False
 
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
@@ -449,6 +533,14 @@ TWILIO_PHONE_NUMBER = os.getenv('TWILIO_PHONE_NUMBER')
 SENDGRID_API_KEY = os.getenv('SENDGRID_API_KEY')
 SENDGRID_GENERAL_TEMPLATE_ID = os.getenv('SENDGRID_GENERAL_TEMPLATE_ID')
 SENDGRID_PROMOTIONAL_FROM_EMAIL = os.getenv('SENDGRID_PROMOTIONAL_FROM_EMAIL', 'info@priyo.com')
+
+# Email outbox, drained by core.tasks.drain_email_outbox after each commit that queued emails and periodically
+EMAIL_OUTBOX_BATCH_SIZE = int(os.getenv('EMAIL_OUTBOX_BATCH_SIZE', 50))
+EMAIL_OUTBOX_MAX_BATCHES = int(os.getenv('EMAIL_OUTBOX_MAX_BATCHES', 20))  # per task run
+EMAIL_OUTBOX_MAX_ATTEMPTS = int(os.getenv('EMAIL_OUTBOX_MAX_ATTEMPTS', 6))
+EMAIL_OUTBOX_RETRY_DELAY = int(os.getenv('EMAIL_OUTBOX_RETRY_DELAY', 30))  # seconds, doubled on every attempt
+EMAIL_OUTBOX_MAX_RETRY_DELAY = int(os.getenv('EMAIL_OUTBOX_MAX_RETRY_DELAY', 3600))
+EMAIL_OUTBOX_CLAIM_TIMEOUT = int(os.getenv('EMAIL_OUTBOX_CLAIM_TIMEOUT', 300))  # seconds before a stuck claim expires
 SENDGRID_INVEST_PROMO_FROM_EMAIL = os.getenv('SENDGRID_INVEST_PROMO_FROM_EMAIL', 'invest@priyo.com')
 SENDGRID_INVEST_PROMO_FROM_NAME = os.getenv('SENDGRID_INVEST_PROMO_FROM_NAME', 'Priyo Inc.')
 SENDGRID_MAIL_FROM_EMAIL = os.getenv('SENDGRID_MAIL_FROM_EMAIL', 'notify@priyo.com')
@@ -487,8 +579,18 @@ SECURE_CONTENT_TYPE_NOSNIFF = True
 OTP_SECRET = os.environ['OTP_SECRET']
 PROFILE_CACHE_PREFIX = "profile-"
 PROFILE_CACHE_TTL = int(os.getenv('PROFILE_CACHE_TTL', 0))
+# A cached profile this close to expiring (seconds) is served and refreshed in the background, 0 disables it
+PROFILE_CACHE_REFRESH_AHEAD = int(os.getenv('PROFILE_CACHE_REFRESH_AHEAD', 0))
 
 SESSION_EXPIRED_AFTER_LOGIN_SECONDS = int(os.getenv('SESSION_EXPIRED_AFTER_LOGIN_SECONDS', 1800))
+
+# 'remote' asks the auth service for the profile of every token not in the profile cache, 'local' verifies token
+# signatures against the auth service's cached public keys and only asks for the profile of users not seen before
+JWT_VERIFICATION_MODE = os.getenv('JWT_VERIFICATION_MODE', 'remote')
+AUTH_JWT_ALGORITHMS = os.getenv('AUTH_JWT_ALGORITHMS', 'RS256').split(',')
+AUTH_JWT_USER_ID_CLAIM = os.getenv('AUTH_JWT_USER_ID_CLAIM', 'uid')
+AUTH_SIGNING_KEYS_REFRESH_INTERVAL = int(os.getenv('AUTH_SIGNING_KEYS_REFRESH_INTERVAL', 300))
+LAST_ACTIVE_AT_UPDATE_INTERVAL = int(os.getenv('LAST_ACTIVE_AT_UPDATE_INTERVAL', 60))
 # SESSION_EXPIRED_AFTER_INACTIVE_SECONDS = int(os.getenv('SESSION_EXPIRED_AFTER_INACTIVE_SECONDS', 600))
 
 ADMIN_BUSINESS_SYNCTERA_ID = os.environ['ADMIN_BUSINESS_SYNCTERA_ID']
@@ -556,5 +658,7 @@ LEAST_AMOUNT_TO_HOLD_IN_CENTS = 100
 LEAST_AMOUNT_REMAINING_AFTER_DUE_CHARGE_IN_CENTS = 50
 
 PROFILE_APPROVAL_ADMIN_STEP = int(os.getenv('PROFILE_APPROVAL_ADMIN_STEP', 2))
+BULK_PROFILE_APPROVAL_LIMIT = int(os.getenv('BULK_PROFILE_APPROVAL_LIMIT', 500))  # people per bulk approval request
+PERSON_TRANSITION_SIDE_EFFECT_BATCH_SIZE = int(os.getenv('PERSON_TRANSITION_SIDE_EFFECT_BATCH_SIZE', 50))
 ADMIN_TRANSFER_CREATOR_ID = int(os.getenv('ADMIN_TRANSFER_CREATOR_ID', 3))
 MAX_INSUFFICIENT_DECLINES_TO_SUSPEND_CARD = int(os.getenv('MAX_INSUFFICIENT_DECLINES_TO_SUSPEND_CARD', 10))
\ No newline at end of file
@@ -14,6 +14,7 @@ if USE_SQLITE:
 
 PROFILE_CACHE_TTL = 0
 CELERY_TASK_ALWAYS_EAGER = True
+REQUEST_PROFILE_SAMPLE_RATE = 0
 LOGGING = {}
 AUTH_API_BASE = None
 OWN_BASE_URL = None
@@ -0,0 +1,20 @@
+from django.conf import settings
+
+from priyomoney_client.http_transport import PooledHttpTransport
+from priyomoney_client.rate_limit import RedisTokenBucket
+
+# Passed to every SyncteraClient of the process (SyncteraClient(transport=synctera_transport)), so calls reuse
+# keep-alive connections and take tokens from the one rate limit all workers share. Celery tasks take tokens with
+# BACKGROUND priority (see priyomoney_client.celery).
+synctera_rate_limiter = RedisTokenBucket(
+    'synctera',
+    rate=settings.SYNCTERA_RATE_LIMIT,
+    burst=settings.SYNCTERA_RATE_LIMIT_BURST,
+    background_reserve=settings.SYNCTERA_RATE_LIMIT_BACKGROUND_RESERVE,
+)
+synctera_transport = PooledHttpTransport(
+    name='synctera',
+    pool_size=settings.SYNCTERA_POOL_SIZE,
+    timeout=(settings.SYNCTERA_CONNECT_TIMEOUT, settings.EXTERNAL_API_TIMEOUT),
+    rate_limiter=synctera_rate_limiter,
+)
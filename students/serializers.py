@@ -1,3 +1,4 @@
+from django.db.models import Prefetch
 from rest_framework.serializers import ModelSerializer
 from core.models import UserEducation, UserExperience, UserForeignUniversity, UserFinancialInfo, UserFinancerInfo
 from students.models import StudentPrimaryInfo
@@ -74,10 +75,25 @@ class StudentUserSerializer(PriyoMoneyUserSerializer):
         else:
             fields = base_fields + ('university', 'department',)
 
+    @staticmethod
+    def setup_eager_loading(queryset):
+        queryset = PriyoMoneyUserSerializer.setup_eager_loading(queryset)
+        return queryset.prefetch_related(
+            Prefetch('educations', queryset=UserEducation.objects.order_by('-created_at'),
+                     to_attr='prefetched_educations')
+        )
+
+    @staticmethod
+    def get_latest_education(instance):
+        educations = getattr(instance, 'prefetched_educations', None)
+        if educations is not None:
+            return educations[0] if educations else None
+        return instance.educations.order_by('-created_at').first()
+
     def get_university(self, instance):
-        education = instance.educations.order_by('-created_at').first()
+        education = self.get_latest_education(instance)
         return education.institution_name if education else None
 
     def get_department(self, instance):
-        education = instance.educations.order_by('-created_at').first()
+        education = self.get_latest_education(instance)
         return education.field_of_study if education else None
@@ -117,4 +117,5 @@ class StudentUserViewSet(ReadOnlyModelViewSet):
         if getattr(self, "swagger_fake_view", False):
             return PriyoMoneyUser.objects.none()
 
-        return PriyoMoneyUser.objects.filter(student_primary_info__isnull=False).order_by('-created_at')
+        queryset = PriyoMoneyUser.objects.filter(student_primary_info__isnull=False).order_by('-created_at')
+        return self.get_serializer_class().setup_eager_loading(queryset)